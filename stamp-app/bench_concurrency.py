@@ -0,0 +1,71 @@
+# This script benchmarks the throughput of the Faststamps web app under concurrent load. It sends
+# requests for the same page from a number of concurrent clients for a while and reports the
+# requests per second and the median and 99th percentile latencies, for each level of concurrency.
+#
+# Start the catalog API and the app first, e.g. in two shells:
+#
+#   cd stamp-catalog-api && uvicorn main:app --port 8081
+#   cd stamp-app && uvicorn main:app --port 8080
+#
+# and then run it with:
+#
+#   python bench_concurrency.py [--url http://127.0.0.1:8080] [--path /stamp_image/Poste-1]
+#                               [--concurrency 1 10 50] [--duration 10]
+
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+
+async def client(http, path, until, latencies, errors):
+    """Request `path` one request at a time until the time `until`, and add the latency of each
+       successful request in milliseconds to `latencies` and count the others in `errors`."""
+    while time.perf_counter() < until:
+        tic = time.perf_counter_ns()
+        try:
+            r = await http.get(path)
+            r.raise_for_status()
+        except httpx.HTTPError:
+            errors.append(1)
+            continue
+        latencies.append((time.perf_counter_ns() - tic)/1000000)
+
+
+async def measure(url, path, concurrency, duration):
+    """Run `concurrency` clients requesting `path` of the app at `url` for `duration` seconds and
+       return the requests per second, the median and 99th percentile latencies and the number of
+       failed requests."""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as http:
+        # Warm up the app and its caches
+        await http.get(path)
+        latencies = []
+        errors = []
+        until = time.perf_counter() + duration
+        await asyncio.gather(*[client(http, path, until, latencies, errors)
+                               for i in range(concurrency)])
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return len(latencies)/duration, statistics.median(latencies), quantiles[98], len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app under concurrent load.")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="URL of the app.")
+    parser.add_argument("--path", default="/stamp_image/Poste-1", help="Page to request.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50],
+                        help="Numbers of concurrent clients to benchmark.")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Seconds to run each level of concurrency.")
+    args = parser.parse_args()
+    print("| Clients | Requests/s | Median (ms) | p99 (ms) | Errors |")
+    print("|---------|------------|-------------|----------|--------|")
+    for concurrency in args.concurrency:
+        throughput, median, p99, errors = asyncio.run(
+                measure(args.url, args.path, concurrency, args.duration))
+        print(f"| {concurrency} | {throughput:.0f} | {median:.1f} | {p99:.1f} | {errors} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# This module contains the cache of the responses of the catalog API in the Faststamps web app.
+# The app requests the same URLs over and over, e.g. the same search results for each page of
+# them and the same stamp for each time its variants are shown. An UpstreamCache keeps the
+# parsed JSON of the most recently used responses, bounded by their total size. A response is
+# fresh for the max-age of its Cache-Control header. After that it is revalidated with the
+# catalog API with If-None-Match if it has an ETag, which the catalog API answers with a cheap
+# 304 Not Modified if it hasn't changed. Concurrent requests for the same response that isn't
+# cached are coalesced into one call to the catalog API, so a burst of identical requests, e.g.
+# for a popular search, isn't passed on to the catalog API.
+
+from collections import OrderedDict
+import asyncio
+import time
+import httpx
+
+
+class UpstreamResponse:
+    """A successful response of the catalog API as cached: its status code, headers and parsed
+       JSON body, which is shared by all requests it is returned for, and must not be
+       modified."""
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def max_age(cache_control, default):
+    """The seconds a response with the Cache-Control header value `cache_control` is fresh,
+       `default` if it has no max-age, or None if it must not be stored."""
+    age = default
+    no_cache = False
+    for directive in (cache_control or "").split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+        if name in ("no-store", "private"):
+            return None
+        if name == "no-cache":
+            # Stored, but revalidated every time
+            no_cache = True
+        elif name == "max-age":
+            try:
+                age = int(value.strip('"'))
+            except ValueError:
+                age = 0
+    return 0 if no_cache else age
+
+
+class UpstreamCache:
+    """A least recently used cache of the JSON responses of the catalog API, bounded by the
+       total size in bytes of their bodies. Responses without a max-age are fresh for
+       `default_ttl` seconds. The responses are keyed by their URL, with the query parameters
+       sorted. Used by the requests of one event loop, so it needs no locks. While a response is
+       being fetched, the requests for it wait for that one call to the catalog API instead of
+       making their own."""
+
+    def __init__(self, max_bytes, default_ttl):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.coalesced = 0
+        # Each entry is an [UpstreamResponse, size, ETag, expiry time] list
+        self._entries = OrderedDict()
+        # The calls to the catalog API in progress, as asyncio.Tasks keyed like the entries
+        self._in_flight = {}
+
+    async def get(self, client, url, params=None):
+        """GET `url` with the query `params` with the httpx.AsyncClient `client`, or from the
+           cache. Returns an UpstreamResponse for a successful response, and otherwise the
+           httpx.Response. If the same response is already being fetched, waits for it, and gets
+           the same response or exception. A cancelled request doesn't cancel the call, which the
+           other requests may wait for."""
+        url = httpx.URL(url)
+        if params is not None:
+            url = url.copy_merge_params(params)
+        url = url.copy_with(params=sorted(url.params.multi_items()))
+        key = str(url)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if time.monotonic() < entry[3]:
+                self.hits += 1
+                return entry[0]
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._fetch(client, url, key, entry))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+        # Shielded, so cancelling this request doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def _fetch(self, client, url, key, entry):
+        """GET `url` with `client` and cache the response with `key`, revalidating the expired
+           `entry` if there's one with an ETag."""
+        headers = {}
+        if entry is not None and entry[2] is not None:
+            headers["If-None-Match"] = entry[2]
+        r = await client.get(url, headers=headers)
+        ttl = max_age(r.headers.get("cache-control"), self.default_ttl)
+        if r.status_code == 304 and entry is not None:
+            # Still the same, so it is fresh again
+            self.revalidations += 1
+            response, size, etag = entry[0], entry[1], r.headers.get("etag", entry[2])
+        else:
+            self.misses += 1
+            if r.status_code != 200:
+                return r
+            response = UpstreamResponse(r.status_code, r.headers, r.json())
+            size, etag = len(r.content), r.headers.get("etag")
+        if ttl is not None:
+            self.put(key, response, size, etag, ttl)
+        else:
+            self.remove(key)
+        return response
+
+    def _done(self, key, task):
+        """Forget the finished call `task` for `key`."""
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Retrieve the exception, which nobody may be waiting for
+            task.exception()
+
+    def put(self, key, response, size, etag, ttl):
+        """Cache `response` of `size` bytes with `key` for `ttl` seconds, evicting the least
+           recently used responses if needed. Responses larger than the cache are not cached."""
+        self.remove(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = [response, size, etag, time.monotonic() + ttl]
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted[1]
+
+    def remove(self, key):
+        """Remove the response cached with `key`, if any."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
@@ -1,15 +1,23 @@
-from fastapi import FastAPI, Request, Response, Query, Path, status  # Header
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Request, Response, Query, Path, Header, status
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+from starlette.routing import Match
+from contextlib import asynccontextmanager
 from fastapi.templating import Jinja2Templates
 from typing import Optional, Annotated  # List
 # from pydantic import BaseSettings
 from pydantic_settings import BaseSettings
 import os.path
+import email.utils
 import logging
 import logging.config
 import httpx
 import time
 import hashlib
+import cache
+import metrics
 import search
 
 
@@ -24,6 +32,31 @@ class Settings(BaseSettings):
     DATE_FORMAT: str = "Date: %a, %d %b %Y %H:%M:%S"
     CATALOGUE_API_URL: str = "http://127.0.0.1:8081/"
     RESULTS_PER_PAGE: int = 5
+    # Compress responses of at least this many bytes with gzip, if the browser accepts it. Images
+    # are not compressed.
+    GZIP_MIN_SIZE: int = 1024
+    # The pool of connections to the catalog API. Idle connections are kept alive for reuse for
+    # UPSTREAM_KEEPALIVE_EXPIRY seconds.
+    UPSTREAM_MAX_CONNECTIONS: int = 100
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 5.0
+    # Seconds to wait for a connection to the catalog API, and for it to respond
+    UPSTREAM_CONNECT_TIMEOUT: float = 2.0
+    UPSTREAM_TIMEOUT: float = 10.0
+    # Use HTTP/2 if the catalog API supports it (negotiated over https)
+    UPSTREAM_HTTP2: bool = True
+    # Max total size in bytes of the catalog API responses cached (see cache.py), and the seconds
+    # they are fresh if the catalog API doesn't say
+    UPSTREAM_CACHE_SIZE: int = 16 * 1024 * 1024
+    UPSTREAM_CACHE_TTL: float = 60
+    # Number of pages of search results to get from the catalog API at a time. The other pages
+    # are then served from the cache.
+    UPSTREAM_PAGES_PER_REQUEST: int = 10
+    # The Cache-Control of the stamp images, if the catalog API doesn't send one
+    IMAGE_CACHE_CONTROL: str = "public, max-age=86400"
+    # Stream the stamp images of at least this many bytes from the catalog API as they arrive.
+    # Smaller ones arrive in one read anyway, and are cheaper to send in one response body.
+    IMAGE_STREAM_MIN_SIZE: int = 64 * 1024
     LOGGING_LEVEL: str = "DEBUG"
     logger: logging.Logger = logging.getLogger(__name__)
     logger.setLevel(LOGGING_LEVEL)
@@ -36,6 +69,10 @@ settings = Settings()
 templates = Jinja2Templates(directory=settings.TEMPLATES_DIR)
 
 
+# The fields of the stamps rendered in the search results (see templates/search_results.html)
+RESULT_FIELDS = "id,color_fr,description_fr,issued,title_fr,value_fr,years"
+
+
 # Utility functions
 def md5_digest(file_name):
     """The md5 digest of the file `file_name`."""
@@ -46,14 +83,149 @@ def md5_digest(file_name):
     return f"\"{hash_md5.hexdigest()}\""
 
 
+def etag_matches(etag, if_none_match):
+    """True if the ETag `etag` matches the If-None-Match header value `if_none_match`, with the
+       weak comparison."""
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+    """True if a response with the validators `etag` and `last_modified` (or None) is not
+       modified according to the conditional request headers `if_none_match` and
+       `if_modified_since` (or None). If-Modified-Since is ignored if there's an
+       If-None-Match."""
+    if if_none_match is not None:
+        return etag is not None and etag_matches(etag, if_none_match)
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            return (email.utils.parsedate_to_datetime(last_modified) <=
+                    email.utils.parsedate_to_datetime(if_modified_since))
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def streamed_body(r):
+    """The raw body of the streamed httpx.Response `r`, closing it if the stream fails."""
+    try:
+        async for chunk in r.aiter_raw():
+            yield chunk
+    except BaseException:
+        await r.aclose()
+        raise
+
+
 def non_variant_stamps(stamps):
     """Return a list of the subset of `stamps` that are not variant stamps."""
     return [stamp for stamp in stamps if stamp["id"]["yt_variant"] == '']
 
 
+# The client calling the catalog API. All requests share its pool of connections. Created at
+# startup.
+upstream = None
+# The most recently used responses of the catalog API
+upstream_cache = cache.UpstreamCache(settings.UPSTREAM_CACHE_SIZE, settings.UPSTREAM_CACHE_TTL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global upstream
+    limits = httpx.Limits(max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+                          max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY)
+    timeout = httpx.Timeout(settings.UPSTREAM_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT)
+    upstream = httpx.AsyncClient(limits=limits, timeout=timeout, http2=settings.UPSTREAM_HTTP2)
+    yield
+    await upstream.aclose()
+
+
 app = FastAPI(
     title="The Faststamps web app",
-    version=settings.VERSION)
+    version=settings.VERSION,
+    lifespan=lifespan)
+# The pages are rendered for each request, so they are compressed on the fly. Added before
+# record_metrics(), so it runs inside it and the metrics have the compressed sizes. The stamp
+# images don't get smaller, and a compressed stream would lose its Content-Length, so no image is
+# compressed.
+app.add_middleware(GZipMiddleware, minimum_size=settings.GZIP_MIN_SIZE,
+                   exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + ("image/*",))
+
+# The metrics of the requests, exposed by /metrics. See metrics.py.
+request_durations = metrics.Histogram("faststamps_app_request_duration_seconds",
+                                      "Duration of the requests, in total and per phase.",
+                                      ("route", "phase"), metrics.LATENCY_BUCKETS)
+request_counts = metrics.Counter("faststamps_app_requests_total",
+                                 "Number of requests by route, method and status.",
+                                 ("route", "method", "status"))
+response_sizes = metrics.Histogram("faststamps_app_response_size_bytes",
+                                   "Size of the response bodies that have a Content-Length.",
+                                   ("route",), metrics.SIZE_BUCKETS)
+upstream_cache_requests = metrics.Collected(
+        "counter", "faststamps_app_upstream_cache_requests_total",
+        "Number of lookups in the cache of catalog API responses, by whether they were hits, "
+        "misses, revalidated with the catalog API or coalesced with a call in progress.",
+        ("result",),
+        lambda: {("hit",): upstream_cache.hits,
+                 ("miss",): upstream_cache.misses,
+                 ("revalidated",): upstream_cache.revalidations,
+                 ("coalesced",): upstream_cache.coalesced})
+upstream_cache_bytes = metrics.Collected(
+        "gauge", "faststamps_app_upstream_cache_bytes",
+        "Total size of the catalog API responses in the cache.", (),
+        lambda: {(): upstream_cache.bytes})
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """Record the duration of each request and of the phases its handler reports in the
+       Server-Timing header, and the size and status of its response. Also adds the duration of
+       the whole request, including FastAPI itself, to the Server-Timing header as "total"."""
+    tic = time.perf_counter_ns()
+    response = await call_next(request)
+    toc = time.perf_counter_ns()
+    route = request.scope.get("route")
+    if route is None:
+        # E.g. requests with a path that isn't handled
+        route = next((r for r in app.routes if r.matches(request.scope)[0] == Match.FULL), None)
+    path = route.path if route is not None else "unmatched"
+    timing = response.headers.get("server-timing")
+    if timing is not None:
+        for phase, duration in metrics.parsed_server_timing(timing):
+            request_durations.observe(duration/1000, path, phase)
+    request_durations.observe((toc - tic)/1000000000, path, "total")
+    request_counts.inc(path, request.method, str(response.status_code))
+    if "content-length" in response.headers:
+        response_sizes.observe(int(response.headers["content-length"]), path)
+    total = f"total;dur={(toc - tic)/1000000}"
+    response.headers["Server-timing"] = f"{timing}, {total}" if timing is not None else total
+    return response
+
+
+async def upstream_search_results(q, start):
+    """Get the page of search results beginning with result `start` (0-based) for the title `q`,
+       or for all stamps if `q` is empty, from the catalog API or the upstream_cache. The stamps
+       are requested in blocks of UPSTREAM_PAGES_PER_REQUEST pages, without the variants and
+       with only RESULT_FIELDS, together with the total number of stamps and of the variants
+       left out. Returns the block response and the position of the page in the block, see
+       search.stamp_search_results()."""
+    url = f"{settings.CATALOGUE_API_URL}stamps"
+    query = {"title": q} if q else {}
+    block_size = settings.RESULTS_PER_PAGE * settings.UPSTREAM_PAGES_PER_REQUEST
+    block_start = start - start % block_size
+    block = await upstream_cache.get(upstream, url,
+                                     params={**query, "variants": "false",
+                                             "start": block_start + 1, "count": block_size,
+                                             "total": "true", "fields": RESULT_FIELDS})
+    return block, start - block_start
+
+
+def upstream_time(timings):
+    """The time in seconds the request with `timings` spent getting search results from the
+       catalog API or the upstream_cache, i.e. in its "upstream" phase."""
+    return timings.phases.get("upstream", 0)/1000000000
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -61,35 +233,34 @@ async def get_index_file(request: Request,
                          start: int = Query(default=0,
                                             description="Start result")):
     """The main application page (index.html)."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
 
-    # Get all stamps from the API
-    url = f"{settings.CATALOGUE_API_URL}stamps"
-    settings.logger.debug(f"(get_index_file) url: {url}")
-    r = httpx.get(url)
-    settings.logger.debug(f"(get_index_file) r.status_code: {r.status_code}")
-    if r.status_code == 200:
-        ssr = search.stamp_search_results("",
-                                          r,
-                                          start,
-                                          settings.RESULTS_PER_PAGE)
-        rps = search.search_result_page_spec(ssr.stamps_count,
-                                             start,
-                                             settings.RESULTS_PER_PAGE,
-                                             linked_pages=10,
-                                             first_page=True,
-                                             last_page=True)
-        result = templates.TemplateResponse("index.html",
-                                            {"request": request,
-                                             "ssr": ssr,
-                                             "rps": rps})
+    # Get the page of stamps from the API
+    with timings.phase("upstream"):
+        block, offset = await upstream_search_results("", start)
+    settings.logger.debug(f"(get_index_file) block.status_code: {block.status_code}")
+    if block.status_code == 200:
+        with timings.phase("results"):
+            ssr = search.stamp_search_results("", block, offset,
+                                              settings.RESULTS_PER_PAGE, upstream_time(timings))
+            rps = search.search_result_page_spec(ssr.stamps_count,
+                                                 start,
+                                                 settings.RESULTS_PER_PAGE,
+                                                 linked_pages=10,
+                                                 first_page=True,
+                                                 last_page=True)
+        with timings.phase("render"):
+            result = templates.TemplateResponse("index.html",
+                                                {"request": request,
+                                                 "ssr": ssr,
+                                                 "rps": rps})
     else:
         rps = None
-        result = templates.TemplateResponse("index.html", {"request": request})
+        with timings.phase("render"):
+            result = templates.TemplateResponse("index.html", {"request": request})
 
-    toc = time.perf_counter_ns()
-    # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-    result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+    # Set Server-timing header (server excution time in ms, in total and per phase)
+    result.headers["Server-timing"] = timings.header()
     return result
 
 
@@ -100,34 +271,35 @@ async def get_search(request: Request, response: Response,
                      start: int = Query(default=0,
                                         description="Start result")):
     """The search page (search.hmtl)."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     if q:
-        url = f"{settings.CATALOGUE_API_URL}stamps?title={q}"
-        r = httpx.get(url)
-        if r.status_code == 200:
-            ssr = search.stamp_search_results(q,
-                                              r,
-                                              start,
-                                              settings.RESULTS_PER_PAGE)
-            rps = search.search_result_page_spec(ssr.stamps_count,
-                                                 start,
-                                                 settings.RESULTS_PER_PAGE,
-                                                 linked_pages=10,
-                                                 first_page=True,
-                                                 last_page=True)
-            result = templates.TemplateResponse("index.html",
-                                                {"request": request,
-                                                 "ssr": ssr,
-                                                 "rps": rps})
+        with timings.phase("upstream"):
+            block, offset = await upstream_search_results(q, start)
+        if block.status_code == 200:
+            with timings.phase("results"):
+                ssr = search.stamp_search_results(q, block, offset,
+                                                  settings.RESULTS_PER_PAGE,
+                                                  upstream_time(timings))
+                rps = search.search_result_page_spec(ssr.stamps_count,
+                                                     start,
+                                                     settings.RESULTS_PER_PAGE,
+                                                     linked_pages=10,
+                                                     first_page=True,
+                                                     last_page=True)
+            with timings.phase("render"):
+                result = templates.TemplateResponse("index.html",
+                                                    {"request": request,
+                                                     "ssr": ssr,
+                                                     "rps": rps})
             result.headers["HX-Push"] = f"/search?q={q}"
         else:
             result = response
     else:
         rps = None
-        result = templates.TemplateResponse("index.html", {"request": request})
-    toc = time.perf_counter_ns()
-    # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-    result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        with timings.phase("render"):
+            result = templates.TemplateResponse("index.html", {"request": request})
+    # Set Server-timing header (server excution time in ms, in total and per phase)
+    result.headers["Server-timing"] = timings.header()
     return result
 
 
@@ -138,32 +310,29 @@ async def get_search_results(request: Request, response: Response,
                              start: int = Query(default=0,
                                                 description="Start")):
     """HTML representation of the search results (search_results.html)."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     settings.logger.debug(f"get_search_results: q='{q}'")
     # Make sure to strip query string of leading and trailing white space.
     q = q.strip()
-    # Get search results from Catalogue API
-    if q:
-        url = f"{settings.CATALOGUE_API_URL}stamps?title={q}"
-    else:
-        url = f"{settings.CATALOGUE_API_URL}stamps"
-    r = httpx.get(url)
+    # Get the page of search results from Catalogue API
+    with timings.phase("upstream"):
+        block, offset = await upstream_search_results(q, start)
     # Set up the HTMX-response
-    if r.status_code == 200:
-        ssr = search.stamp_search_results(q,
-                                          r,
-                                          start,
-                                          settings.RESULTS_PER_PAGE)
-        rps = search.search_result_page_spec(ssr.stamps_count,
-                                             start,
-                                             settings.RESULTS_PER_PAGE,
-                                             linked_pages=10,
-                                             first_page=True,
-                                             last_page=True)
-        result = templates.TemplateResponse("search_results.html",
-                                            {"request": request,
-                                             "ssr": ssr,
-                                             "rps": rps})
+    if block.status_code == 200:
+        with timings.phase("results"):
+            ssr = search.stamp_search_results(q, block, offset,
+                                              settings.RESULTS_PER_PAGE, upstream_time(timings))
+            rps = search.search_result_page_spec(ssr.stamps_count,
+                                                 start,
+                                                 settings.RESULTS_PER_PAGE,
+                                                 linked_pages=10,
+                                                 first_page=True,
+                                                 last_page=True)
+        with timings.phase("render"):
+            result = templates.TemplateResponse("search_results.html",
+                                                {"request": request,
+                                                 "ssr": ssr,
+                                                 "rps": rps})
         # Set the URL for the returned page and make sure the browser is updated
         if q:
             path = f"/search?q={q}"
@@ -174,15 +343,13 @@ async def get_search_results(request: Request, response: Response,
             if start > 0:
                 path += f"?start={start}"
         result.headers["HX-Push"] = path
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        result.headers["Server-timing"] = timings.header()
         return result
     else:
         response.status_code = status.HTTP_404_NOT_FOUND
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        response.headers["Server-timing"] = timings.header()
         return response
 
 
@@ -190,60 +357,108 @@ async def get_search_results(request: Request, response: Response,
 async def get_stamp_variants(request: Request, response: Response,
                              stamp_id: Annotated[str, Path(title="Id of stamp")]):
     """HTML representation of a stamps variants."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     url = f"{settings.CATALOGUE_API_URL}stamps/{stamp_id}"
-    r = httpx.get(url)
+    with timings.phase("upstream"):
+        r = await upstream_cache.get(upstream, url)
     if r.status_code == 200:
         variants = r.json()["variants"]
         # Generated HTML variants result with appropriate Jinja2template
-        result = templates.TemplateResponse("stamp_variants.html",
-                                            {"request": request,
-                                             "variants": variants})
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        with timings.phase("render"):
+            result = templates.TemplateResponse("stamp_variants.html",
+                                                {"request": request,
+                                                 "variants": variants})
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        result.headers["Server-timing"] = timings.header()
         return result
     else:
         response.status_code = status.HTTP_404_NOT_FOUND
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        response.headers["Server-timing"] = timings.header()
 
 
 @app.get("/stamp_image/{stamp_id}", response_class=Response)
 async def get_stamp_image(response: Response,
-                          stamp_id: Annotated[str, Path(title="Id of stamp")]):
-    tic = time.perf_counter_ns()
+                          stamp_id: Annotated[str, Path(title="Id of stamp")],
+                          if_none_match: Optional[str] = Header(None),
+                          if_modified_since: Optional[str] = Header(None)):
+    """The JPEG image of a stamp, with its ETag, Last-Modified and Cache-Control. Images of at
+       least IMAGE_STREAM_MIN_SIZE bytes are streamed from the catalog API as they arrive.
+       Conditional requests are passed on to the catalog API, and answered with 304 Not
+       Modified if the browser's copy is still valid."""
+    timings = metrics.Timings()
     url = f"{settings.CATALOGUE_API_URL}stamps/{stamp_id}/image"
-    r = httpx.get(url)
-    if r.status_code == 200:
-        image = r.content
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
-        return Response(content=image, media_type="image/jpeg")
-    else:
+    conditions = {name: value for name, value in (("If-None-Match", if_none_match),
+                                                  ("If-Modified-Since", if_modified_since))
+                  if value is not None}
+    with timings.phase("upstream"):
+        # Only the headers are read here, the body below
+        r = await upstream.send(upstream.build_request("GET", url, headers=conditions),
+                                stream=True)
+    if r.status_code not in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        await r.aclose()
         response.status_code = status.HTTP_404_NOT_FOUND
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
-        return response
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        response.headers["Server-timing"] = timings.header()
+        return None
+    # Forward the validators of the image, or make a weak ETag from the others
+    etag = r.headers.get("etag")
+    last_modified = r.headers.get("last-modified")
+    if etag is None and r.status_code == status.HTTP_200_OK and \
+            (last_modified is not None or "content-length" in r.headers):
+        digest = hashlib.md5(f"{url} {last_modified} {r.headers.get('content-length')}"
+                             .encode()).hexdigest()
+        etag = f'W/"{digest}"'
+    headers = {"Cache-Control": r.headers.get("cache-control", settings.IMAGE_CACHE_CONTROL)}
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = last_modified
+    # Set Server-timing header (server excution time in ms, in total and per phase)
+    headers["Server-timing"] = timings.header()
+    if r.status_code == status.HTTP_304_NOT_MODIFIED or \
+            is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+        await r.aclose()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # The image is passed on as the catalog API encoded it
+    if "content-encoding" in r.headers:
+        headers["Content-Encoding"] = r.headers["content-encoding"]
+    if int(r.headers.get("content-length", settings.IMAGE_STREAM_MIN_SIZE)) < \
+            settings.IMAGE_STREAM_MIN_SIZE:
+        try:
+            image = b"".join([chunk async for chunk in r.aiter_raw()])
+        finally:
+            await r.aclose()
+        return Response(content=image, media_type="image/jpeg", headers=headers)
+    if "content-length" in r.headers:
+        headers["Content-Length"] = r.headers["content-length"]
+    # The upstream response is closed when it has been sent, or the browser has disconnected
+    return StreamingResponse(streamed_body(r), media_type="image/jpeg", headers=headers,
+                             background=BackgroundTask(r.aclose))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """The metrics of the app in the Prometheus text format: the duration of the requests per
+       route, in total and per phase as reported in the Server-Timing header, the sizes and
+       statuses of the responses, and the lookups in and size of the upstream cache."""
+    body = metrics.exposition([request_durations, request_counts, response_sizes,
+                               upstream_cache_requests, upstream_cache_bytes])
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/{file}", response_class=FileResponse)
 async def get_file(file: str, response: Response):
     """Return the file (binary contents) with the given name."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     path = os.path.join(file)
     if os.path.exists(path):
         result = FileResponse(path)
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        result.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        result.headers["Server-timing"] = timings.header()
         return result
     else:
         response.status_code = status.HTTP_404_NOT_FOUND
-        toc = time.perf_counter_ns()
-        # Set Server-timing header (server excution time in ms, not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Set Server-timing header (server excution time in ms, in total and per phase)
+        response.headers["Server-timing"] = timings.header()
         return response
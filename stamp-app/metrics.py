@@ -0,0 +1,171 @@
+# This module contains the metrics of the Faststamps web app. The request handlers time the phases
+# of each request, e.g. calling the catalog API and rendering the templates, with Timings and
+# report them in the Server-Timing response header. The app records them, together with the
+# latency, size and status of every response, in counters and histograms that /metrics exposes in
+# the Prometheus text format (https://prometheus.io/docs/instrumenting/exposition_formats/).
+#
+# This is a copy of the parts of metrics.py of the catalog API that the app uses. The app and the
+# API are built into separate Docker images, each from its own directory, so they can't share a
+# module. Keep the copied parts in sync, e.g. the Server-Timing format, which parsed_server_timing()
+# also reads from the API's responses.
+
+import bisect
+import contextlib
+import threading
+import time
+
+# The upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0]
+# The upper bounds of the buckets of the response size histograms, in bytes
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+
+class Timings:
+    """The durations of the phases of a request, e.g. "query" and "encode", timed from when the
+       Timings are created."""
+
+    def __init__(self):
+        self.start = time.perf_counter_ns()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the phase `name` while in the with statement. A phase can be timed in parts."""
+        tic = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter_ns() - tic
+
+    def header(self):
+        """The Server-Timing header value with the total duration of the request so far and the
+           duration of each phase, in milliseconds. The total comes first as "API", so clients
+           that only read the first metric still get it."""
+        total = time.perf_counter_ns() - self.start
+        return ", ".join([f"API;dur={total/1000000}"] +
+                         [f"{name};dur={duration/1000000}"
+                          for name, duration in self.phases.items()])
+
+
+def parsed_server_timing(value):
+    """Parse the Server-Timing header `value` and return a list of the (name, duration) tuples
+       of its metrics that have a duration, in milliseconds."""
+    timings = []
+    for metric in value.split(","):
+        name, *parameters = [item.strip() for item in metric.split(";")]
+        for parameter in parameters:
+            key, _, duration = parameter.partition("=")
+            if key.strip() == "dur":
+                try:
+                    timings.append((name, float(duration)))
+                except ValueError:
+                    pass
+    return timings
+
+
+class Counter:
+    """A counter with one value per combination of the values of its `labels`. It is safe to use
+       from multiple threads."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values):
+        """Add 1 to the counter with the given label values."""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def samples(self):
+        """The (name, labels, value) tuples of the counter, see exposition()."""
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, dict(zip(self.labels, label_values)), value)
+                for label_values, value in values]
+
+
+class Histogram:
+    """A histogram of observed values with the upper bounds `buckets`, with one series per
+       combination of the values of its `labels`. It is safe to use from multiple threads."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Each series is a [bucket counts, sum, count] list. The last bucket is +Inf.
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Add `value` to the series with the given label values."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """The (name, labels, value) tuples of the histogram, see exposition()."""
+        with self._lock:
+            series = [(label_values, list(counts), total, count)
+                      for label_values, (counts, total, count) in self._series.items()]
+        samples = []
+        for label_values, counts, total, count in series:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Collected:
+    """A counter or gauge (`kind`) whose values are collected when the metrics are exposed.
+       `collect` is a function returning a dict mapping each tuple of the values of the `labels`
+       to its value."""
+
+    def __init__(self, kind, name, help, labels, collect):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        """The (name, labels, value) tuples of the metric, see exposition()."""
+        return [(self.name, dict(zip(self.labels, label_values)), value)
+                for label_values, value in self.collect().items()]
+
+
+def exposition(metrics):
+    """The `metrics` in the Prometheus text format."""
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                pairs = ",".join(f'{label}="{escaped(str(label_value))}"'
+                                 for label, label_value in labels.items())
+                name = f"{name}{{{pairs}}}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def escaped(label_value):
+    """`label_value` escaped for the Prometheus text format."""
+    return label_value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
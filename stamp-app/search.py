@@ -131,19 +131,19 @@ def search_result_page_spec(count: int,
     return result
 
 
-def stamp_search_results(query, response, start, results_per_page) -> StampSearchResults:
-    """A StampSearchResults object based on the response from a call to the stamp-catalog
-       API, suitable for passing to the HTML rendering function."""
-    search_time = float(response.headers["server-timing"].split("=")[1])/1000
-    results = response.json()
-    # results["stamps"] contains a mixed list of stamps AND stamp variants, so we filter out the
-    # proper stamps.
-    stamps = [stamp for stamp in results["stamps"] if stamp["id"]["yt_variant"] == '']
-    stamps_count = len(stamps)
+def stamp_search_results(query, block, start, results_per_page,
+                         search_time) -> StampSearchResults:
+    """A StampSearchResults object based on the response from the stamp-catalog API, suitable
+       for passing to the HTML rendering function. `block` has a block of proper stamps, of which
+       the `results_per_page` beginning at position `start` are rendered, the total number of
+       proper stamps and the number of stamp variants (variants=false&total=true). `search_time`
+       is the time in seconds it took to get the response, which is next to nothing if it came
+       from the cache."""
+    results = block.json()
     result = StampSearchResults(query=query,
-                                count=results["count"],
-                                stamps_count=stamps_count,
-                                variant_stamps_count=results["count"] - stamps_count,
-                                stamps=stamps[start:start + results_per_page],
+                                count=results["total"] + results["variants_total"],
+                                stamps_count=results["total"],
+                                variant_stamps_count=results["variants_total"],
+                                stamps=results["stamps"][start:start + results_per_page],
                                 search_time=f"{search_time:.3}")
     return result
@@ -2,6 +2,12 @@
 import pytest
 from fastapi.testclient import TestClient
 from main import app
+import asyncio
+import gzip
+import httpx
+import cache
+import main
+import search
 
 
 # Constants
@@ -33,9 +39,10 @@ def test_app_index(client):
 def test_app_assets(client):
     resource = "/favicon.png"
     url = '%s%s' % (API_BASE_URL, resource)
-    r = client.get(url)
+    r = client.get(url, headers={"Accept-Encoding": "gzip"})
     assert r.status_code == 200
     assert "server-timing" in r.headers
+    assert "content-encoding" not in r.headers
     with open(FAVICON_FILE, 'rb') as f:
         data = f.read()
     assert r.read() == data
@@ -55,3 +62,231 @@ def test_app_assets(client):
     assert "server-timing" in r.headers
     with open(FASTSTAMPS_JS_FILE, 'rb') as f:
         data = f.read()
+
+
+def test_app_metrics(client):
+    r = client.get('%s%s' % (API_BASE_URL, "/stamp_image/Poste-1"))
+    assert r.status_code == 200
+    assert r.headers["server-timing"].startswith("API;dur=")
+    assert "upstream;dur=" in r.headers["server-timing"]
+    assert "total;dur=" in r.headers["server-timing"]
+    r = client.get('%s%s' % (API_BASE_URL, "/metrics"), headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip"
+    assert ('faststamps_app_request_duration_seconds_count{route="/stamp_image/{stamp_id}",'
+            'phase="upstream"} 1') in r.text
+
+
+def test_app_upstream_client():
+    # All requests share one client calling the catalog API, open while the app runs
+    with TestClient(app) as c:
+        upstream = main.upstream
+        for i in range(2):
+            r = c.get('%s%s' % (API_BASE_URL, "/stamp_image/Poste-1"))
+            assert r.status_code == 200
+            assert main.upstream is upstream
+        assert not upstream.is_closed
+    assert upstream.is_closed
+
+
+def test_app_search_results_page(client):
+    # Only a block of pages of stamps, without the variants, is requested from the catalog API
+    main.upstream_cache.clear()
+    misses = main.upstream_cache.misses
+    block, offset = client.portal.call(main.upstream_search_results, "", 5)
+    assert block.status_code == 200
+    assert offset == 5
+    ssr = search.stamp_search_results("", block, offset, 5, 0.00123)
+    # The search time is the time the app took, not the one the catalog API reported when the
+    # responses were cached
+    assert ssr.search_time == "0.00123"
+    assert ssr.count == ssr.stamps_count + ssr.variant_stamps_count
+    assert ssr.stamps_count < ssr.count
+    assert [stamp["id"]["yt_no"] for stamp in ssr.stamps] == ["6", "7", "8", "9", "10"]
+    assert all(stamp["id"]["yt_variant"] == "" for stamp in ssr.stamps)
+    assert set(ssr.stamps[0]) == set(main.RESULT_FIELDS.split(","))
+    # The other pages of the block come from the cache
+    for start in [0, 10, 45]:
+        assert client.portal.call(main.upstream_search_results, "", start)[0] is block
+    # One call to the catalog API per block, which has the totals too
+    assert main.upstream_cache.misses == misses + 1
+    block, offset = client.portal.call(main.upstream_search_results, "", 50)
+    assert offset == 0
+    assert main.upstream_cache.misses == misses + 2
+
+
+def test_app_upstream_cache():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        etag = '"%s"' % request.url.path
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"ETag": etag, "Cache-Control": "max-age=0"})
+        cache_control = "no-store" if request.url.path == "/private" else "max-age=0"
+        return httpx.Response(200, json={"path": request.url.path, "size": "x" * 100},
+                              headers={"ETag": etag, "Cache-Control": cache_control})
+
+    async def run():
+        upstream_cache = cache.UpstreamCache(200, 60)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            # max-age=0 is revalidated every time, with If-None-Match. The URL is the same
+            # whatever the order of the parameters.
+            r = await upstream_cache.get(client, "http://api/b?y=2&x=1")
+            assert r.json()["path"] == "/b"
+            assert await upstream_cache.get(client, "http://api/b", {"x": 1, "y": 2}) is r
+            assert requests[-1].headers["if-none-match"] == '"/b"'
+            assert (upstream_cache.misses, upstream_cache.revalidations) == (1, 1)
+            # Another URL is its own response
+            await upstream_cache.get(client, "http://api/c")
+            assert "if-none-match" not in requests[-1].headers
+            # no-store isn't cached, and the least recently used responses are evicted
+            await upstream_cache.get(client, "http://api/private")
+            await upstream_cache.get(client, "http://api/private")
+            assert "if-none-match" not in requests[-1].headers
+            assert upstream_cache.bytes <= 200
+            assert [key for key in upstream_cache._entries] == ["http://api/c"]
+        return upstream_cache
+
+    upstream_cache = asyncio.run(run())
+    assert upstream_cache.hits == 0
+
+
+def test_app_upstream_cache_ttl():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"stamps": []}, headers={"Cache-Control": "max-age=60"})
+
+    async def run():
+        upstream_cache = cache.UpstreamCache(1000, 0)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            first = await upstream_cache.get(client, "http://api/stamps")
+            for i in range(3):
+                assert await upstream_cache.get(client, "http://api/stamps") is first
+        return upstream_cache
+
+    upstream_cache = asyncio.run(run())
+    assert len(calls) == 1
+    assert (upstream_cache.hits, upstream_cache.misses) == (3, 1)
+    assert cache.max_age("public, max-age=60", 5) == 60
+    assert cache.max_age("public", 5) == 5
+    assert cache.max_age("no-cache, max-age=60", 5) == 0
+    assert cache.max_age("no-store", 5) is None
+
+
+def test_app_upstream_cache_coalescing():
+    calls = []
+    release = None
+
+    async def handler(request):
+        calls.append(request)
+        await release.wait()
+        if request.url.path == "/error":
+            raise httpx.ConnectError("Connection refused", request=request)
+        return httpx.Response(200, json={"path": request.url.path},
+                              headers={"Cache-Control": "no-store"})
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        upstream_cache = cache.UpstreamCache(1000, 60)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            # Concurrent identical requests make one call, and all get its response
+            waiters = [asyncio.ensure_future(upstream_cache.get(client, "http://api/stamps"))
+                       for i in range(5)]
+            await asyncio.sleep(0)
+            # Cancelling a request doesn't cancel the call the others wait for
+            waiters[0].cancel()
+            release.set()
+            responses = await asyncio.gather(*waiters[1:])
+            assert len(calls) == 1
+            assert all(r is responses[0] for r in responses)
+            assert responses[0].json() == {"path": "/stamps"}
+            assert waiters[0].cancelled()
+            # Once done, no-store responses are fetched again
+            await upstream_cache.get(client, "http://api/stamps")
+            assert len(calls) == 2
+            # The exception of the call is raised in every request
+            release.clear()
+            waiters = [asyncio.ensure_future(upstream_cache.get(client, "http://api/error"))
+                       for i in range(3)]
+            await asyncio.sleep(0)
+            release.set()
+            results = await asyncio.gather(*waiters, return_exceptions=True)
+            assert len(calls) == 3
+            assert all(isinstance(r, httpx.ConnectError) for r in results)
+            assert upstream_cache._in_flight == {}
+        return upstream_cache
+
+    upstream_cache = asyncio.run(run())
+    assert (upstream_cache.misses, upstream_cache.coalesced) == (2, 6)
+
+
+def test_app_stamp_image_encoded(client):
+    """A small image the catalog API sends gzip-encoded is passed on with its encoding."""
+    image = b"\xff\xd8" + bytes(range(256)) * 4
+    encoded = gzip.compress(image)
+
+    async def body():
+        yield encoded
+
+    def handler(request):
+        # Streamed, like the responses of the catalog API
+        return httpx.Response(200, content=body(),
+                              headers={"Content-Encoding": "gzip", "ETag": '"a"',
+                                       "Content-Length": str(len(encoded))})
+
+    upstream = main.upstream
+    main.upstream = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    try:
+        r = client.get('%s%s' % (API_BASE_URL, "/stamp_image/Poste-1"))
+    finally:
+        client.portal.call(main.upstream.aclose)
+        main.upstream = upstream
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip"
+    assert int(r.headers["content-length"]) == len(encoded)
+    assert r.content == image
+
+
+def test_app_stamp_image_validators(client):
+    url = '%s%s' % (API_BASE_URL, "/stamp_image/Poste-1")
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/jpeg"
+    assert r.headers["cache-control"].startswith("public, max-age=")
+    assert int(r.headers["content-length"]) == len(r.content)
+    assert r.content.startswith(b"\xff\xd8")
+    etag, last_modified = r.headers["etag"], r.headers["last-modified"]
+    # Conditional requests with the validators are answered with 304, without the image
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+    assert r.content == b""
+    r = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert r.status_code == 304
+    r = client.get(url, headers={"If-None-Match": '"other"', "If-Modified-Since": last_modified})
+    assert r.status_code == 200
+    r = client.get('%s%s' % (API_BASE_URL, "/stamp_image/Poste-99999"))
+    assert r.status_code == 404
+    # Images are not compressed by the app
+    r = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in r.headers
+    assert int(r.headers["content-length"]) == len(r.content)
+    # Large images are streamed, with the same headers, and are not compressed either
+    main.settings.IMAGE_STREAM_MIN_SIZE, size = 0, main.settings.IMAGE_STREAM_MIN_SIZE
+    try:
+        r = client.get(url, headers={"Accept-Encoding": "gzip"})
+    finally:
+        main.settings.IMAGE_STREAM_MIN_SIZE = size
+    assert r.status_code == 200
+    assert r.headers["etag"] == etag
+    assert "content-encoding" not in r.headers
+    assert int(r.headers["content-length"]) == len(r.content)
+    assert r.content.startswith(b"\xff\xd8")
+    assert main.is_not_modified('W/"a"', None, '"b", "a"', None)
+    assert main.is_not_modified(None, "Sun, 19 Jan 2025 11:57:56 GMT", None,
+                                "Sun, 19 Jan 2025 12:00:00 GMT")
+    assert not main.is_not_modified(None, "Sun, 19 Jan 2025 11:57:56 GMT", None, "invalid")
@@ -0,0 +1,82 @@
+# This script benchmarks the startup (catalog load) time of the Faststamps Catalog API. It builds
+# catalogs that are 1x, 10x and 100x the size of the French stamps catalog and compares the time it
+# takes to read them from the CSV file with the time it takes to read them from a snapshot.
+#
+# Run it with:
+#
+#   python bench_startup.py [--factors 1 10 100] [--repeat 3]
+
+import argparse
+import os.path
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import database
+
+CATALOG_CSV_FILE = "./data/french-stamps.csv"
+
+
+def scaled_csv(csv_file, factor, directory):
+    """Write a copy of `csv_file` with its stamps repeated `factor` times to `directory` and
+       return the name of the new file. The stamp type of each copy is made unique, so that each
+       stamp still has a unique id."""
+    db = pd.read_csv(csv_file, delimiter=';', dtype=str, keep_default_na=False)
+    copies = []
+    for i in range(factor):
+        copy = db.copy()
+        if i > 0:
+            copy["type_fr"] = copy["type_fr"] + f" {i}"
+        copies.append(copy)
+    file_name = os.path.join(directory, f"stamps-{factor}x.csv")
+    pd.concat(copies).to_csv(file_name, sep=';', index=False)
+    return file_name
+
+
+def legacy_read_csv(csv_file):
+    """Read `csv_file` the way the API did before there were snapshots, i.e. with a row-by-row
+       apply for the URL column."""
+    with open(csv_file) as f:
+        db = pd.read_csv(f, delimiter=';', dtype={'issued': str, 'id_yt_no': str})
+        db = db.replace({np.nan: ""})
+        db["url"] = db[["type_fr", "id_yt_no", "id_yt_var"]].apply(
+                lambda x: f"stamps/{x.iloc[0]}-{x.iloc[1]}-{x.iloc[2]}" if x.iloc[2]
+                          else f"stamps/{x.iloc[0]}-{x.iloc[1]}", axis=1)
+        indexed_db = db.set_index(["type_fr", "id_yt_no", "id_yt_var"])
+        indexed_db = indexed_db.sort_index()
+    return db, indexed_db
+
+
+def best_time(f, repeat):
+    """The best wall clock time in milliseconds of `repeat` calls to `f`."""
+    times = []
+    for i in range(repeat):
+        tic = time.perf_counter_ns()
+        f()
+        toc = time.perf_counter_ns()
+        times.append((toc - tic)/1000000)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark catalog load time.")
+    parser.add_argument("--factors", type=int, nargs="+", default=[1, 10, 100],
+                        help="Catalog size factors to benchmark.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement.")
+    args = parser.parse_args()
+    print("| Size | Stamps | Legacy CSV (ms) | CSV (ms) | Build snapshot (ms) | Snapshot (ms) |")
+    print("|------|--------|-----------------|----------|---------------------|---------------|")
+    with tempfile.TemporaryDirectory() as directory:
+        for factor in args.factors:
+            csv_file = scaled_csv(CATALOG_CSV_FILE, factor, directory)
+            rows = len(database.read_csv(csv_file).db)
+            legacy = best_time(lambda: legacy_read_csv(csv_file), args.repeat)
+            csv = best_time(lambda: database.read_csv(csv_file), args.repeat)
+            build = best_time(lambda: database.build_snapshot(csv_file), 1)
+            snapshot = best_time(lambda: database.load(csv_file), args.repeat)
+            print(f"| {factor}x | {rows} | {legacy:.0f} | {csv:.0f} | {build:.0f} | "
+                  f"{snapshot:.0f} |")
+
+
+if __name__ == "__main__":
+    main()
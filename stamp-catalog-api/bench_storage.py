@@ -0,0 +1,112 @@
+# This script benchmarks the storage engines of the Faststamps Catalog API (see storage.py). It
+# builds catalogs that are 1x, 10x and 100x the size of the French stamps catalog (about 6.6
+# thousand, 66 thousand and 660 thousand stamps; use --factors 1 10 100 300 for two million) and
+# compares the query latency and resident memory of the "pandas" and "sqlite" engines.
+#
+# Each engine is opened in its own process, so its memory can be measured. The "pandas" engine
+# holds the whole catalog in memory. The "sqlite" engine only opens the database file, which is
+# built beforehand, without reading the catalog into memory. Both are opened as the API does.
+#
+# Run it with:
+#
+#   python bench_storage.py [--factors 1 10 100] [--repeat 20]
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+import database
+import storage
+from bench_startup import CATALOG_CSV_FILE, scaled_csv
+from main import stamp_json_fields
+
+# The queries of the benchmark, as (name, StampStore method, arguments)
+QUERIES = [("list 100", "stamps", ([], 1000, 100)),
+           ("filter year", "stamps", ([("issued", ["1931"])],)),
+           ("filter 3 attrs", "stamps", ([("title_en", ["Ceres"]),
+                                          ("issued", ["1850", "1870", "1872"]),
+                                          ("color_en", ["Green", "Olive"])],)),
+           ("get by id", "stamp", (("Poste", "1", "a"),)),
+           ("colors", "values", ("color_en",)),
+           ("search", "search", ("marianne cheffer", []))]
+
+
+def resident_memory():
+    """The resident memory in bytes of this process."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def open_engine(engine, csv_file):
+    """Open the storage `engine` for the catalog `csv_file` the way the API does."""
+    fields = stamp_json_fields()
+    if engine == "pandas":
+        # The snapshot holds the registry the engine looks up stamps in
+        return storage.PandasStore(database.load(csv_file, fields=fields), fields)
+    return storage.load_sqlite(csv_file, fields).store
+
+
+def run_engine(engine, csv_file, repeat, results):
+    """Open `engine` and run the queries on it, `repeat` times each, and put the open time,
+       resident memory and median query latencies in the queue `results`."""
+    baseline = resident_memory()
+    tic = time.perf_counter_ns()
+    store = open_engine(engine, csv_file)
+    toc = time.perf_counter_ns()
+    latencies = {}
+    for name, method, arguments in QUERIES:
+        times = []
+        for i in range(repeat):
+            tic_query = time.perf_counter_ns()
+            getattr(store, method)(*arguments)
+            times.append((time.perf_counter_ns() - tic_query)/1000000)
+        latencies[name] = statistics.median(times)
+    results.put({"open": (toc - tic)/1000000,
+                 "memory": (resident_memory() - baseline)/(1024 * 1024),
+                 "latencies": latencies})
+
+
+def measure(engine, csv_file, repeat):
+    """Run the benchmark of `engine` in a new process and return its results."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_engine, args=(engine, csv_file, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the storage engines.")
+    parser.add_argument("--factors", type=int, nargs="+", default=[1, 10, 100],
+                        help="Catalog size factors to benchmark.")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of runs per query.")
+    args = parser.parse_args()
+    names = [name for name, _, _ in QUERIES]
+    print(f"| Size | Stamps | Engine | Open (ms) | Memory (MB) | "
+          f"{' | '.join(f'{name} (ms)' for name in names)} |")
+    print(f"|------|--------|--------|-----------|-------------|{'|'.join('---' for _ in names)}|")
+    with tempfile.TemporaryDirectory() as directory:
+        for factor in args.factors:
+            csv_file = scaled_csv(CATALOG_CSV_FILE, factor, directory)
+            catalog = database.read_csv(csv_file)
+            rows = len(catalog.db)
+            database.build_snapshot(csv_file, fields=stamp_json_fields())
+            tic = time.perf_counter_ns()
+            storage.build_sqlite(catalog, stamp_json_fields(), storage.sqlite_path(csv_file))
+            toc = time.perf_counter_ns()
+            del catalog
+            print(f"| {factor}x | {rows} | sqlite build | {(toc - tic)/1000000:.0f} | | "
+                  f"{' | '.join('' for _ in names)} |")
+            for engine in storage.ENGINES:
+                result = measure(engine, csv_file, args.repeat)
+                latencies = " | ".join(f"{result['latencies'][name]:.2f}" for name in names)
+                print(f"| {factor}x | {rows} | {engine} | {result['open']:.0f} | "
+                      f"{result['memory']:.0f} | {latencies} |")
+
+
+if __name__ == "__main__":
+    main()
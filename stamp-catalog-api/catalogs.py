@@ -0,0 +1,157 @@
+# This module contains the named stamp catalogs of the Faststamps Catalog API. Besides its default
+# catalog, the API serves every stamp catalog CSV file in a directory, named by the file name
+# without the ".csv" suffix. The named catalogs are loaded the first time they are used, and the
+# least recently used ones are evicted from memory when the catalogs use more memory than allowed.
+# The default catalog is pinned: it is always loaded and does not count against the memory budget.
+
+import os
+import os.path
+import threading
+import time
+from collections import OrderedDict
+
+
+class CatalogMetrics:
+    """Statistics on the use of a named catalog."""
+
+    def __init__(self):
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.last_load_time = None  # In milliseconds
+        self.memory = 0             # In bytes, while loaded. None until asked for if pinned.
+
+
+class Catalogs:
+    """The stamp catalogs in `directory`. `load` is a function that loads a stamp catalog CSV file
+       and returns a database.Catalog. The loaded catalogs are kept in memory as long as they use
+       at most `memory_budget` bytes in total. The most recently used catalog is always kept
+       though, even if it alone exceeds the budget. Pinned catalogs (see pin()) are never evicted
+       and are not counted. It is safe to use from multiple threads."""
+
+    def __init__(self, directory, memory_budget, load):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.load = load
+        self.metrics = {}
+        self._loaded = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+        # One lock per catalog name, so a catalog is only loaded once even if requested by
+        # many requests at the same time, while other catalogs can still be used.
+        self._load_locks = {}
+
+    def names(self):
+        """The sorted names of the pinned catalogs and the catalogs in the directory."""
+        try:
+            files = os.listdir(self.directory)
+        except OSError:
+            files = []
+        with self._lock:
+            pinned = list(self._pinned)
+        return sorted(set(pinned + [f[:-4] for f in files if f.endswith(".csv")]))
+
+    def pin(self, name, catalog):
+        """Make `catalog` the catalog `name`, replacing any catalog with that name. It stays
+           loaded until it is replaced by another pin(). Its memory doesn't count against the
+           budget, so it is only estimated when asked for, see memory()."""
+        with self._lock:
+            self._loaded.pop(name, None)
+            self._pinned[name] = catalog
+            metrics = self.metrics.setdefault(name, CatalogMetrics())
+            metrics.loads += 1
+            metrics.last_load_time = catalog.load_time
+            metrics.memory = None
+
+    def pinned(self, name):
+        """True if the catalog `name` is pinned."""
+        with self._lock:
+            return name in self._pinned
+
+    def csv_file(self, name):
+        """The CSV file of the catalog `name` in the directory, or None if there is no such
+           catalog. Only names of files in the directory are accepted, so `name` can't be used to
+           read other files."""
+        try:
+            files = os.listdir(self.directory)
+        except OSError:
+            return None
+        if f"{name}.csv" not in files:
+            return None
+        return os.path.join(self.directory, f"{name}.csv")
+
+    def loaded(self, name):
+        """The catalog `name` if it is loaded, without loading it. Otherwise None."""
+        with self._lock:
+            return self._pinned.get(name) or self._loaded.get(name)
+
+    def get(self, name):
+        """The catalog `name`, which is loaded if needed. Returns None if there is no catalog
+           with that name."""
+        with self._lock:
+            catalog = self._pinned.get(name)
+            if catalog is not None:
+                self.metrics[name].hits += 1
+                return catalog
+            catalog = self._loaded.get(name)
+            if catalog is not None:
+                self._loaded.move_to_end(name)
+                self.metrics[name].hits += 1
+                return catalog
+        csv_file = self.csv_file(name)
+        if csv_file is None:
+            return None
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            # Another request may have loaded it while we waited for the lock.
+            with self._lock:
+                catalog = self._loaded.get(name)
+                if catalog is not None:
+                    self._loaded.move_to_end(name)
+                    self.metrics[name].hits += 1
+                    return catalog
+            tic = time.perf_counter_ns()
+            catalog = self.load(csv_file)
+            toc = time.perf_counter_ns()
+            with self._lock:
+                metrics = self.metrics.setdefault(name, CatalogMetrics())
+                metrics.loads += 1
+                metrics.last_load_time = (toc - tic)/1000000
+                metrics.memory = catalog.memory_usage()
+                self._loaded[name] = catalog
+                self._evict()
+        return catalog
+
+    def memory(self, name):
+        """The memory in bytes used by the catalog `name`, or 0 if it is not loaded. The memory
+           of a pinned catalog is estimated the first time it is asked for."""
+        with self._lock:
+            catalog = self._pinned.get(name)
+            metrics = self.metrics.get(name)
+        if metrics is None:
+            return 0
+        memory = metrics.memory
+        if memory is None and catalog is not None:
+            memory = catalog.memory_usage()
+            with self._lock:
+                # Unless it has been replaced meanwhile
+                if self._pinned.get(name) is catalog:
+                    metrics.memory = memory
+        return memory or 0
+
+    def memory_usage(self):
+        """The total memory in bytes used by the loaded catalogs that are not pinned."""
+        with self._lock:
+            return sum(self.metrics[name].memory for name in self._loaded)
+
+    def _evict(self):
+        """Evict the least recently used catalogs until the loaded catalogs are within the
+           memory budget. Must be called with the lock held."""
+        total = sum(self.metrics[name].memory for name in self._loaded)
+        while total > self.memory_budget and len(self._loaded) > 1:
+            name, _ = self._loaded.popitem(last=False)
+            metrics = self.metrics[name]
+            metrics.evictions += 1
+            total -= metrics.memory
+            metrics.memory = 0
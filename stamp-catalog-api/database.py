@@ -0,0 +1,939 @@
+# This module contains the "database" of the Faststamps Catalog API. The stamp catalog CSV file is
+# read into Pandas dataFrames at startup. To avoid parsing the CSV file on every startup, the CSV
+# file can be compiled into a binary columnar snapshot, which is loaded without any parsing. The
+# snapshot also holds the indexes over the catalog and the JSON encoded stamps, so they aren't
+# rebuilt on every startup either.
+#
+# To build a snapshot of a stamp catalog CSV file, run:
+#
+#   python database.py ./data/french-stamps.csv
+#
+# The snapshot is written to a directory next to the CSV file, e.g. `data/french-stamps.snapshot`.
+
+import argparse
+import bisect
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+import time
+import unicodedata
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the snapshot directory changes. Snapshots with another format
+# version are ignored and the catalog is read from the CSV file instead.
+SNAPSHOT_FORMAT_VERSION = 2
+SNAPSHOT_MANIFEST_FILE = "manifest.json"
+SNAPSHOT_VALUES_FILE = "values.json"
+SNAPSHOT_ORDER_FILE = "order.npy"
+# The values of the indexes that aren't arrays, e.g. the distinct titles. The arrays are stored in
+# "{index}.{name}.npy" files, see save_index().
+SNAPSHOT_INDEXES_FILE = "indexes.json"
+
+# The columns that together uniquely identify a stamp in the catalog.
+ID_COLUMNS = ["type_fr", "id_yt_no", "id_yt_var"]
+
+# The columns that stamps can be filtered on. Each of them gets an inverted index when loaded.
+FILTER_COLUMNS = ["title_en", "title_fr", "issued", "color_en", "color_fr", "value_en", "value_fr",
+                  "type_fr", "id_yt_var"]
+
+NO_POSITIONS = np.empty(0, dtype=np.int64)
+
+# The filter columns with numbers, which stamps can also be filtered on with ranges of numbers. Each
+# of them gets a NumericIndex when loaded.
+RANGE_COLUMNS = ["issued"]
+
+# The columns with distinct values that stamps are counted on (facets) when the catalog is loaded.
+FACET_COLUMNS = ["issued", "color_en", "color_fr", "value_en", "value_fr", "type_fr"]
+
+# The orders stamps can be sorted in, and the columns each of them sorts on. See Catalog.sorted().
+SORT_KEYS = {"yt_no": ID_COLUMNS,
+             "issued": ["issued"],
+             "title_en": ["title_en"],
+             "title_fr": ["title_fr"]}
+
+# The columns of the full-text index and their weights. A word in a title counts twice as much as a
+# word in the description.
+TEXT_COLUMNS = {"title_en": 2.0, "title_fr": 2.0, "description_fr": 1.0}
+# The parameters of the BM25 ranking of full-text matches
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Encodes a value as JSON, the same way as FastAPI (Pydantic) does.
+json_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+# The accents that folded() removes from decomposed characters
+COMBINING_MARKS = re.compile("[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]")
+
+# Sorts after any other character, so that all strings with the prefix p are in [p, p + MAX_CHAR).
+MAX_CHAR = "\U0010ffff"
+
+
+class Catalog:
+    """A stamp catalog loaded into memory. `db` holds the stamps in the same order as in the
+       catalog CSV file and `indexed_db` holds the same stamps indexed and sorted on stamp type,
+       Yvert-Tellier number and variant. `id_order` are the row positions in `db` in that order
+       (see id_order()). `version` is the SHA-256 digest of the CSV file and `source` is either
+       "csv" or "snapshot", depending on where the catalog was read from. `indexes` are the
+       indexes over `db` as returned by build_indexes(), which are built if None."""
+
+    def __init__(self, db, indexed_db, version, source, id_order, indexes=None):
+        self.db = db
+        self.indexed_db = indexed_db
+        self.id_order = id_order
+        self.version = version
+        self.source = source
+        # The number of stamps
+        self.size = len(db)
+        self.loaded_at = datetime.datetime.now(datetime.timezone.utc)
+        # The row position in `db` of each stamp, by stamp id (type, Yt number, variant)
+        self.ids = dict(zip(zip(*(db[column].tolist() for column in ID_COLUMNS)), range(len(db))))
+        if indexes is None:
+            indexes = build_indexes(db)
+        self.postings = indexes["postings"]
+        self.ranges = indexes["ranges"]
+        self.facets = indexes["facets"]
+        self.titles = indexes["titles"]
+        self.text = indexes["text"]
+        # The rank of each stamp in each sort order, and all stamps in each sort order, ascending
+        # and descending. Stamps with the same rank are in catalog order.
+        self.sort_ranks = indexes["sort_ranks"]
+        self.sort_orders = {}
+        for key, ranks in self.sort_ranks.items():
+            self.sort_orders[(key, False)] = np.argsort(ranks, kind="stable")
+            self.sort_orders[(key, True)] = np.argsort(-ranks, kind="stable")
+        # The JSON representation of each stamp, see build_json_fragments()
+        self.json_fragments = None
+        # The stamps and their variants by stamp id, see build_registry()
+        self.registry = None
+        # The storage engine answering the stamp queries of the API, see storage.py
+        self.store = None
+        # The time in milliseconds the whole load took, including building the indexes. Set by
+        # the loader when the catalog is ready.
+        self.load_time = None
+
+    def build_json_fragments(self, fields):
+        """Encode each stamp in `db` as a JSON object once, so responses can be built by joining
+           the encoded stamps instead of converting and validating them on each request.
+           `fields` is a list of (name, column) tuples, in the order the JSON object members are
+           encoded. `column` may also be a list of (name, column) tuples, which is encoded as a
+           nested JSON object. The result is stored in `json_fragments` as an array of UTF-8
+           encoded JSON objects, one per row in `db`."""
+        self.json_fragments = encoded_json_objects(self.db, fields)
+
+    def build_registry(self, fields):
+        """Build `registry`, a dict mapping the id (type, Yvert-Tellier number, variant) of each
+           stamp to a (stamp, variants) tuple. `stamp` is the stamp encoded as a JSON object as
+           specified by `fields` (see build_json_fragments()), and `variants` is a JSON object
+           with all the variants of the stamp (including the stamp itself) keyed on their variant,
+           or JSON null if the stamp has no variants. A stamp and its variants share the same
+           `variants` object. The encoded stamps are also kept in `json_fragments`, if they
+           weren't already, so lists of stamps are built from the same encoding."""
+        if self.json_fragments is None:
+            # Costs only a reference per stamp, since the registry holds the same bytes
+            self.json_fragments = encoded_json_objects(self.db, fields)
+        fragments = self.json_fragments
+        types = self.db["type_fr"].to_numpy()
+        numbers = self.db["id_yt_no"].to_numpy()
+        variants = self.db["id_yt_var"].to_numpy()
+        registry = {}
+
+        def register(group):
+            if len(group) == 1:
+                encoded_variants = b"null"
+            else:
+                encoded_variants = b"{" + b",".join(
+                    [json_encode(variants[i]).encode() + b":" + fragments[i]
+                     for i in group]) + b"}"
+            for i in group:
+                registry[(types[i], numbers[i], variants[i])] = (fragments[i], encoded_variants)
+
+        # In id order, the variants of a stamp follow each other.
+        group = []
+        for i in self.id_order:
+            if group and (types[i] != types[group[0]] or numbers[i] != numbers[group[0]]):
+                register(group)
+                group = []
+            group.append(i)
+        if group:
+            register(group)
+        self.registry = registry
+
+    def memory_usage(self):
+        """An estimate of the memory in bytes used by the catalog: its DataFrames and its JSON
+           encoded stamps. The indexes are small in comparison and are not counted."""
+        usage = int(self.db.memory_usage(deep=True).sum())
+        usage += int(self.indexed_db.memory_usage(deep=True).sum())
+        if self.json_fragments is not None:
+            usage += sum(map(len, self.json_fragments))
+        if self.registry is not None:
+            # The variants objects are shared by all the variants of a stamp, and the stamps are
+            # shared with `json_fragments` if there are any
+            variants = {id(entry[1]): len(entry[1]) for entry in self.registry.values()}
+            usage += sum(variants.values())
+            if self.json_fragments is None:
+                usage += sum(len(entry[0]) for entry in self.registry.values())
+        return usage
+
+    def positions(self, column, values):
+        """The sorted row positions in `db` of the stamps that have one of the `values` in
+           `column`. For the RANGE_COLUMNS, a value may also be a (low, high) tuple, which matches
+           the stamps with a number from low to high in the column. Both are inclusive, and None
+           means no bound."""
+        postings = self.postings[column]
+        lists = []
+        for value in values:
+            if isinstance(value, tuple):
+                lists.append(self.ranges[column].between(*value))
+            else:
+                lists.append(postings.get(value, NO_POSITIONS))
+        if len(lists) == 1:
+            return lists[0]
+        # The posting lists of different values are disjoint, but ranges may overlap them.
+        return np.unique(np.concatenate(lists))
+
+    def query(self, filters):
+        """The sorted row positions in `db` of the stamps matching all `filters`, where `filters`
+           is a list of (column, values) tuples. A stamp matches a filter if it has one of the
+           values in the column. Returns None if there are no filters, i.e. all stamps match."""
+        result = None
+        # We intersect the shortest posting lists first, so the intermediate results stay small.
+        for positions in sorted((self.positions(column, values) for column, values in filters),
+                                key=len):
+            if result is None:
+                result = positions
+            else:
+                result = intersection(result, positions)
+        return result
+
+    def sorted(self, positions, key, descending=False):
+        """The row `positions` sorted on the sort `key` (see SORT_KEYS), ascending or
+           `descending`. Stamps with the same rank keep their order in `positions`. If `positions`
+           is None, all stamps are returned in the precomputed sort order. Otherwise only the
+           ranks of `positions` are sorted, never the whole catalog."""
+        if positions is None:
+            return self.sort_orders[(key, descending)]
+        ranks = self.sort_ranks[key][positions]
+        return positions[np.argsort(-ranks if descending else ranks, kind="stable")]
+
+    def sort_key(self, position, sort):
+        """The key of the stamp at row `position` in the order `sort`, which is None for catalog
+           order or a (key, descending) tuple as for sorted(). The stamps are in ascending order
+           of their keys, which are tuples of ints."""
+        if sort is None:
+            return (int(position),)
+        rank = int(self.sort_ranks[sort[0]][position])
+        return (-rank if sort[1] else rank, int(position))
+
+    def after(self, positions, key, sort):
+        """The index in `positions`, row positions in the order `sort`, of the first stamp whose
+           sort key (see sort_key()) is greater than `key`. Found with a binary search, so
+           resuming a listing after a given stamp costs the same wherever the stamp is."""
+        return bisect.bisect_right(positions, tuple(key),
+                                   key=lambda position: self.sort_key(position, sort))
+
+    def search(self, text, filters):
+        """The row positions of the stamps that contain all the words in the full-text query
+           `text` (see TextIndex.query()) and match `filters` (see query()), best match first.
+           Returns None if `text` has no words."""
+        positions = self.text.query(text)
+        if positions is not None and filters:
+            positions = positions[np.isin(positions, self.query(filters), assume_unique=True)]
+        return positions
+
+
+class Facet:
+    """The distinct values of a column, with the number of stamps that have each value. `values`
+       are the sorted distinct values and `counts` the number of stamps with each of them."""
+
+    def __init__(self, column):
+        self.codes, uniques = pd.factorize(column, use_na_sentinel=False)
+        uniques = uniques.tolist()
+        # The sort order of the distinct values
+        self.order = np.array(sorted(range(len(uniques)), key=uniques.__getitem__),
+                              dtype=np.int64)
+        self.values = [uniques[i] for i in self.order]
+        self.counts = np.bincount(self.codes, minlength=len(uniques))[self.order].tolist()
+
+    def state(self):
+        """The facet as a (values, arrays) tuple of a JSON serializable dict and a dict of numpy
+           arrays, from which from_state() restores it."""
+        return {"values": self.values, "counts": self.counts}, \
+            {"codes": self.codes, "order": self.order}
+
+    @classmethod
+    def from_state(cls, values, arrays):
+        """The facet with the `values` and `arrays` returned by state()."""
+        facet = cls.__new__(cls)
+        facet.codes = arrays["codes"]
+        facet.order = arrays["order"]
+        facet.values = values["values"]
+        facet.counts = values["counts"]
+        return facet
+
+    def counted(self, positions):
+        """The (values, counts) of the stamps at the row `positions` only, leaving out the values
+           no stamp has. If `positions` is None, all stamps are counted."""
+        if positions is None:
+            return self.values, self.counts
+        counts = np.bincount(self.codes[positions], minlength=len(self.values))[self.order]
+        present = np.flatnonzero(counts)
+        return [self.values[i] for i in present], counts[present].tolist()
+
+
+class TitleIndex:
+    """An index over the distinct stamp titles in one language, for wildcard title queries. The
+       titles are kept in the order they first occur in the catalog, and are identified by their
+       position (rank) in that order. Prefix queries are answered with a binary search in the
+       sorted titles and suffix queries with a binary search in the sorted reversed titles, which
+       serve the same purpose as a trie and a reversed trie. Infix queries are answered with an
+       index of the trigrams in the titles."""
+
+    def __init__(self, column):
+        self.titles = pd.unique(column).tolist()
+        # The sorted titles, which is also the answer to the unfiltered query
+        self.sorted_titles = sorted(self.titles)
+        ranks = sorted(range(len(self.titles)), key=self.titles.__getitem__)
+        self.prefix_ranks = np.array(ranks, dtype=np.int64)
+        ranks = sorted(range(len(self.titles)), key=lambda i: self.titles[i][::-1])
+        self.reversed_titles = [self.titles[i][::-1] for i in ranks]
+        self.suffix_ranks = np.array(ranks, dtype=np.int64)
+        trigrams = {}
+        for rank, title in enumerate(self.titles):
+            for trigram in {title[i:i+3] for i in range(len(title) - 2)}:
+                trigrams.setdefault(trigram, []).append(rank)
+        self.trigrams = {trigram: np.array(ranks, dtype=np.int64)
+                         for trigram, ranks in trigrams.items()}
+
+    def state(self):
+        """The index as a (values, arrays) tuple, see Facet.state(). The sorted and reversed
+           titles aren't stored, since they are quickly restored from the ranks."""
+        ranks, bounds = concatenated(list(self.trigrams.values()))
+        return {"titles": self.titles, "trigrams": list(self.trigrams)}, \
+            {"prefix_ranks": self.prefix_ranks, "suffix_ranks": self.suffix_ranks,
+             "trigram_ranks": ranks, "trigram_bounds": bounds}
+
+    @classmethod
+    def from_state(cls, values, arrays):
+        """The index with the `values` and `arrays` returned by state()."""
+        index = cls.__new__(cls)
+        index.titles = values["titles"]
+        index.prefix_ranks = arrays["prefix_ranks"]
+        index.sorted_titles = [index.titles[i] for i in index.prefix_ranks]
+        index.suffix_ranks = arrays["suffix_ranks"]
+        index.reversed_titles = [index.titles[i][::-1] for i in index.suffix_ranks]
+        index.trigrams = dict(zip(values["trigrams"],
+                                  split(arrays["trigram_ranks"], arrays["trigram_bounds"])))
+        return index
+
+    def with_prefix(self, prefix):
+        """The sorted ranks of the titles beginning with `prefix`."""
+        lo = bisect.bisect_left(self.sorted_titles, prefix)
+        hi = bisect.bisect_left(self.sorted_titles, prefix + MAX_CHAR, lo)
+        return np.sort(self.prefix_ranks[lo:hi])
+
+    def with_suffix(self, suffix):
+        """The sorted ranks of the titles ending with `suffix`."""
+        reversed_suffix = suffix[::-1]
+        lo = bisect.bisect_left(self.reversed_titles, reversed_suffix)
+        hi = bisect.bisect_left(self.reversed_titles, reversed_suffix + MAX_CHAR, lo)
+        return np.sort(self.suffix_ranks[lo:hi])
+
+    def containing(self, infix):
+        """The sorted ranks of the titles containing `infix`."""
+        if len(infix) < 3:
+            # Too short for the trigram index. There are far fewer titles than stamps though.
+            return np.array([rank for rank, title in enumerate(self.titles) if infix in title],
+                            dtype=np.int64)
+        candidates = None
+        for trigram in {infix[i:i+3] for i in range(len(infix) - 2)}:
+            ranks = self.trigrams.get(trigram, NO_POSITIONS)
+            candidates = ranks if candidates is None else intersection(candidates, ranks)
+        # All trigrams of the infix are in the candidates, but not necessarily in sequence.
+        return np.array([rank for rank in candidates if infix in self.titles[rank]],
+                        dtype=np.int64)
+
+    def query(self, q):
+        """The titles matching the query `q`, in the order they first occur in the catalog. `q`
+           may contain one wildcard star '*', e.g. 'Mari*', '*anne', '*ari*' or 'M*ne'."""
+        prefix = q[-1] == "*"
+        suffix = q[0] == "*"
+        if prefix and suffix:
+            ranks = self.containing(q[1:-1])
+        elif prefix:
+            ranks = self.with_prefix(q[0:-1])
+        elif suffix:
+            ranks = self.with_suffix(q[1:])
+        else:
+            starpos = q.find('*')
+            ranks = intersection(self.with_prefix(q[0:starpos]), self.with_suffix(q[starpos+1:]))
+        return [self.titles[rank] for rank in ranks]
+
+
+class NumericIndex:
+    """An index over the numbers in a column, for range queries. `numbers` are the sorted numbers
+       and `order` the row positions of the stamps in the same order. Values that are not
+       numbers, e.g. empty ones, are left out."""
+
+    def __init__(self, column):
+        numbers = pd.to_numeric(column, errors="coerce").to_numpy(dtype=np.float64)
+        # NaN sorts last, and a stable sort keeps the positions of each number in ascending order
+        order = np.argsort(numbers, kind="stable")
+        self.order = order[~np.isnan(numbers[order])]
+        self.numbers = numbers[self.order]
+
+    def state(self):
+        """The index as a (values, arrays) tuple, see Facet.state()."""
+        return {}, {"order": self.order, "numbers": self.numbers}
+
+    @classmethod
+    def from_state(cls, values, arrays):
+        """The index with the `values` and `arrays` returned by state()."""
+        index = cls.__new__(cls)
+        index.order = arrays["order"]
+        index.numbers = arrays["numbers"]
+        return index
+
+    def between(self, low, high):
+        """The sorted row positions of the stamps with a number from `low` to `high`, both
+           inclusive. None means no bound. Found with two binary searches."""
+        lo = 0 if low is None else np.searchsorted(self.numbers, low, side="left")
+        hi = len(self.numbers) if high is None else \
+            np.searchsorted(self.numbers, high, side="right")
+        return np.sort(self.order[lo:hi])
+
+
+class TextIndex:
+    """A full-text index over the `columns` of the dataFrame `db`, a dict mapping each column to
+       the weight of its words. The words are folded with folded_words(), and each (word, stamp)
+       pair is scored with BM25 when the index is built, so a query only has to add up scores.
+       `words` is the sorted vocabulary. The stamps with words[i] are at the row positions
+       `positions[bounds[i]:bounds[i+1]]`, with their scores in `scores`. Since the vocabulary is
+       sorted, the stamps of all words with a given prefix are in one contiguous range."""
+
+    def __init__(self, db, columns):
+        self.size = len(db)
+        vocabulary = {}
+        tokens = []
+        positions = []
+        weights = []
+        for column, weight in columns.items():
+            # Each distinct value is only split into words once
+            codes, uniques = pd.factorize(db[column], use_na_sentinel=False)
+            words = [folded_words(value).split() for value in uniques]
+            lengths = np.array([len(w) for w in words], dtype=np.int64)
+            flat = np.array([vocabulary.setdefault(word, len(vocabulary))
+                             for value_words in words for word in value_words], dtype=np.int64)
+            starts = np.cumsum(lengths) - lengths
+            # The words of each row, as ranges in `flat`
+            row_lengths = lengths[codes]
+            row_starts = np.cumsum(row_lengths) - row_lengths
+            within = np.arange(row_lengths.sum()) - np.repeat(row_starts, row_lengths)
+            tokens.append(flat[np.repeat(starts[codes], row_lengths) + within])
+            positions.append(np.repeat(np.arange(self.size), row_lengths))
+            weights.append(np.full(len(within), weight))
+        self.words = sorted(vocabulary)
+        ranks = np.empty(len(vocabulary), dtype=np.int64)
+        ranks[[vocabulary[word] for word in self.words]] = np.arange(len(self.words))
+        tokens = ranks[np.concatenate(tokens)]
+        # The weighted number of times each word occurs in each stamp, sorted on word and stamp
+        keys, inverse = np.unique(tokens * self.size + np.concatenate(positions),
+                                  return_inverse=True)
+        frequencies = np.bincount(inverse, weights=np.concatenate(weights))
+        tokens = keys // max(self.size, 1)
+        self.positions = keys % max(self.size, 1)
+        lengths = np.bincount(self.positions, weights=frequencies, minlength=self.size)
+        average_length = lengths.mean() if self.size and lengths.mean() > 0 else 1.0
+        stamps_with_word = np.bincount(tokens, minlength=len(self.words))
+        idf = np.log(1 + (self.size - stamps_with_word + 0.5) / (stamps_with_word + 0.5))
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths[self.positions] / average_length)
+        self.scores = idf[tokens] * frequencies * (BM25_K1 + 1) / (frequencies + norms)
+        self.bounds = np.searchsorted(tokens, np.arange(len(self.words) + 1))
+
+    def state(self):
+        """The index as a (values, arrays) tuple, see Facet.state()."""
+        return {"size": self.size, "words": self.words}, \
+            {"positions": self.positions, "scores": self.scores, "bounds": self.bounds}
+
+    @classmethod
+    def from_state(cls, values, arrays):
+        """The index with the `values` and `arrays` returned by state()."""
+        index = cls.__new__(cls)
+        index.size = values["size"]
+        index.words = values["words"]
+        index.positions = arrays["positions"]
+        index.scores = arrays["scores"]
+        index.bounds = arrays["bounds"]
+        return index
+
+    def matching(self, word, prefix):
+        """The range in `positions` and `scores` of the stamps with `word`, or with any word
+           beginning with `word` if `prefix` is True."""
+        lo = bisect.bisect_left(self.words, word)
+        if prefix:
+            hi = bisect.bisect_left(self.words, word + MAX_CHAR, lo)
+        else:
+            hi = lo + 1 if lo < len(self.words) and self.words[lo] == word else lo
+        return self.bounds[lo], self.bounds[hi]
+
+    def query(self, text):
+        """The row positions of the stamps that contain all the words in `text`, ignoring case
+           and accents, best match first. Equally good matches are in catalog order. A word
+           ending with a star '*' matches all words beginning with it, e.g. 'mari*'. Returns None
+           if `text` has no words."""
+        terms = search_terms(text)
+        if not terms:
+            return None
+        matched = np.ones(self.size, dtype=bool)
+        scores = np.zeros(self.size)
+        for word, prefix in terms:
+            start, end = self.matching(word, prefix)
+            positions = self.positions[start:end]
+            matched &= np.bincount(positions, minlength=self.size) > 0
+            scores += np.bincount(positions, weights=self.scores[start:end], minlength=self.size)
+        positions = np.flatnonzero(matched)
+        return positions[np.argsort(-scores[positions], kind="stable")]
+
+
+def folded(text):
+    """`text` in lower case and without accents."""
+    if text.isascii():
+        return text.lower()
+    return COMBINING_MARKS.sub("", unicodedata.normalize("NFKD", text.casefold()))
+
+
+def folded_words(text):
+    """The words in `text` in lower case and without accents, separated by spaces. This matches
+       how the SQLite FTS5 unicode61 tokenizer with remove_diacritics splits and folds words."""
+    return " ".join(re.findall(r"[^\W_]+", folded(text)))
+
+
+def natural_key(value):
+    """The key to sort `value` on in natural order: ignoring case and accents, and with numbers
+       in numerical order, e.g. "2" before "10" and "Cérès" next to "ceres". Empty values sort
+       first, e.g. the stamp without variant before its variants."""
+    return tuple((0, int(run), "") if run.isdigit() else (1, 0, run)
+                 for run in re.findall(r"\d+|\D+", folded(value))) + ((1, 0, value),)
+
+
+def sort_ranks(db, columns):
+    """The rank of each row of the dataFrame `db` when sorted on `columns` in natural order (see
+       natural_key()). Rows that sort equal have the same rank."""
+    column_ranks = []
+    for column in columns:
+        # Only the distinct values are sorted
+        codes, uniques = pd.factorize(db[column], use_na_sentinel=False)
+        order = sorted(range(len(uniques)), key=lambda i: natural_key(uniques[i]))
+        unique_ranks = np.empty(len(uniques), dtype=np.int64)
+        unique_ranks[order] = np.arange(len(uniques))
+        column_ranks.append(unique_ranks[codes])
+    order = np.lexsort(column_ranks[::-1])
+    # A new rank begins where any of the column ranks changes
+    changes = np.zeros(len(order), dtype=np.int64)
+    for ranks in column_ranks:
+        changes[1:] |= np.diff(ranks[order]) != 0
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.cumsum(changes)
+    return ranks
+
+
+def search_terms(text):
+    """The (word, prefix) terms of the full-text query `text`: its folded words, and whether each
+       is a prefix, i.e. ended with a star '*'. A word like "l'exposition" is folded into several
+       words, of which only the last one can be a prefix."""
+    terms = []
+    for query_word in text.split():
+        words = folded_words(query_word).split()
+        for i, word in enumerate(words):
+            terms.append((word, query_word.endswith("*") and i == len(words) - 1))
+    return terms
+
+
+def build_postings(db, columns):
+    """An inverted index of the stamps dataFrame `db`. For each of the `columns` it maps each
+       distinct value in the column to the sorted array of row positions that have that value."""
+    postings = {}
+    for column in columns:
+        codes, uniques = pd.factorize(db[column], use_na_sentinel=False)
+        # A stable sort keeps the positions for each value in ascending order.
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        postings[column] = {value: order[bounds[i]:bounds[i + 1]]
+                            for i, value in enumerate(uniques)}
+    return postings
+
+
+def build_indexes(db):
+    """The indexes over the stamps dataFrame `db` that Catalog queries, as a dict."""
+    return {"postings": build_postings(db, FILTER_COLUMNS),
+            "ranges": {column: NumericIndex(db[column]) for column in RANGE_COLUMNS},
+            "facets": {column: Facet(db[column]) for column in FACET_COLUMNS},
+            "titles": {"en": TitleIndex(db["title_en"]),
+                       "fr": TitleIndex(db["title_fr"])},
+            "text": TextIndex(db, TEXT_COLUMNS),
+            "sort_ranks": {key: sort_ranks(db, columns) for key, columns in SORT_KEYS.items()}}
+
+
+def concatenated(arrays):
+    """The list of numpy `arrays` as a (flat, bounds) tuple of one array and the bounds of each
+       array in it, so arrays[i] is flat[bounds[i]:bounds[i+1]]. See split()."""
+    flat = np.concatenate(arrays) if arrays else NO_POSITIONS
+    return flat, concatenated_bounds(arrays)
+
+
+def split(flat, bounds):
+    """The list of arrays that concatenated() returned as `flat` and `bounds`. The arrays are
+       views of `flat`, so nothing is copied."""
+    bounds = bounds.tolist()
+    return [flat[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def json_values(column):
+    """The values in the dataFrame `column` encoded as JSON. Each distinct value is only encoded
+       once."""
+    codes, uniques = pd.factorize(column, use_na_sentinel=False)
+    encoded = np.empty(len(uniques), dtype=object)
+    encoded[:] = [json_encode(value) for value in uniques]
+    return encoded[codes]
+
+
+def json_objects(db, fields):
+    """The rows of the dataFrame `db` encoded as compact JSON objects, as specified by `fields`.
+       See Catalog.build_json_fragments()."""
+    result = np.full(len(db), "{", dtype=object)
+    for i, (name, column) in enumerate(fields):
+        separator = "," if i > 0 else ""
+        result = result + f"{separator}{json.dumps(name)}:"
+        if isinstance(column, list):
+            result = result + json_objects(db, column)
+        else:
+            result = result + json_values(db[column])
+    return result + "}"
+
+
+def selected(db, positions, fields):
+    """A dataFrame with the rows at `positions` in the dataFrame `db` and the columns needed to
+       encode `fields` (see Catalog.build_json_fragments()). Only those rows and columns are
+       copied."""
+    columns = []
+    for _, column in fields:
+        columns.extend(c for _, c in column) if isinstance(column, list) else columns.append(column)
+    return pd.DataFrame({column: db[column].take(positions).to_numpy()
+                         for column in dict.fromkeys(columns)})
+
+
+def encoded_json_objects(db, fields):
+    """The rows of the dataFrame `db` as an array of UTF-8 encoded JSON objects, as specified by
+       `fields`. See Catalog.build_json_fragments()."""
+    objects = json_objects(db, fields)
+    result = np.empty(len(objects), dtype=object)
+    result[:] = [o.encode() for o in objects]
+    return result
+
+
+def intersection(a, b):
+    """The intersection of the sorted arrays of unique row positions `a` and `b`. The cost is
+       proportional to the length of the shorter array (times log of the longer)."""
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return a
+    i = np.searchsorted(b, a)
+    i[i == len(b)] = 0
+    return a[b[i] == a]
+
+
+def snapshot_dir(csv_file):
+    """The name of the snapshot directory for the catalog CSV file `csv_file`."""
+    return os.path.splitext(csv_file)[0] + ".snapshot"
+
+
+def file_digest(file_name):
+    """The SHA-256 hex digest of the file `file_name`."""
+    sha256 = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def add_url_column(db):
+    """Add the "url" column, e.g. 'stamps/Poste-1-a', to the stamps dataFrame `db`."""
+    variants = db["id_yt_var"]
+    db["url"] = ("stamps/" + db["type_fr"] + "-" + db["id_yt_no"]
+                 + np.where(variants != "", "-" + variants, ""))
+
+
+def id_order(db):
+    """The row positions of the stamps dataFrame `db` sorted on the stamp id columns."""
+    return db.sort_values(ID_COLUMNS, kind="stable").index.to_numpy(dtype=np.int64)
+
+
+def indexed(db, order):
+    """The stamps dataFrame `db` indexed on the stamp id columns, in the id `order` (see
+       id_order())."""
+    return db.take(order).set_index(ID_COLUMNS)
+
+
+def read_csv(csv_file):
+    """Read the stamp catalog CSV file `csv_file` and return a Catalog."""
+    tic = time.perf_counter_ns()
+    with open(csv_file, "rb") as f:
+        data = f.read()
+    db = pd.read_csv(io.BytesIO(data), delimiter=';', dtype={'issued': str, 'id_yt_no': str})
+    # We replace all np.NAN with an empty string ""
+    db = db.replace({np.nan: ""})
+    add_url_column(db)
+    order = id_order(db)
+    catalog = Catalog(db, indexed(db, order), hashlib.sha256(data).hexdigest(), "csv", order)
+    catalog.load_time = (time.perf_counter_ns() - tic)/1000000
+    return catalog
+
+
+def index_states(catalog):
+    """The state of each index of `catalog` by name, as a (values, arrays) tuple (see
+       Facet.state())."""
+    states = {}
+    for column, postings in catalog.postings.items():
+        positions, bounds = concatenated(list(postings.values()))
+        states[f"postings.{column}"] = {"values": list(postings)}, \
+            {"positions": positions, "bounds": bounds}
+    for column, index in catalog.ranges.items():
+        states[f"ranges.{column}"] = index.state()
+    for column, facet in catalog.facets.items():
+        states[f"facets.{column}"] = facet.state()
+    for language, index in catalog.titles.items():
+        states[f"titles.{language}"] = index.state()
+    states["text"] = catalog.text.state()
+    states["sort_ranks"] = {}, catalog.sort_ranks
+    return states
+
+
+def restored_indexes(states):
+    """The indexes as returned by build_indexes(), restored from their `states` as returned by
+       index_states()."""
+    indexes = {"postings": {}, "ranges": {}, "facets": {}, "titles": {}}
+    for name, (values, arrays) in states.items():
+        kind, _, key = name.partition(".")
+        if kind == "postings":
+            indexes["postings"][key] = dict(zip(values["values"],
+                                                split(arrays["positions"], arrays["bounds"])))
+        elif kind == "ranges":
+            indexes["ranges"][key] = NumericIndex.from_state(values, arrays)
+        elif kind == "facets":
+            indexes["facets"][key] = Facet.from_state(values, arrays)
+        elif kind == "titles":
+            indexes["titles"][key] = TitleIndex.from_state(values, arrays)
+        elif kind == "text":
+            indexes["text"] = TextIndex.from_state(values, arrays)
+        elif kind == "sort_ranks":
+            indexes["sort_ranks"] = arrays
+    return indexes
+
+
+def registry_state(catalog):
+    """The JSON encoded stamps and the registry of `catalog` (see Catalog.build_registry()) as a
+       dict of numpy arrays: the stamps and the distinct variants objects as bytes with their
+       bounds, and the variants object of each stamp, or -1 for null."""
+    fragments = catalog.json_fragments
+    groups = np.full(len(fragments), -1, dtype=np.int64)
+    variants = {}
+    for i, key in enumerate(zip(*(catalog.db[column].tolist() for column in ID_COLUMNS))):
+        encoded_variants = catalog.registry[key][1]
+        if encoded_variants != b"null":
+            groups[i] = variants.setdefault(id(encoded_variants), (len(variants),
+                                                                   encoded_variants))[0]
+    variants = [encoded_variants for _, encoded_variants in variants.values()]
+    return {"stamps": np.frombuffer(b"".join(fragments), dtype=np.uint8),
+            "stamp_bounds": concatenated_bounds(fragments),
+            "variants": np.frombuffer(b"".join(variants), dtype=np.uint8),
+            "variant_bounds": concatenated_bounds(variants),
+            "groups": groups}
+
+
+def restore_registry(catalog, arrays):
+    """Set the JSON encoded stamps and the registry of `catalog` from the `arrays` returned by
+       registry_state(). A stamp and its variants share the same variants object again."""
+    fragments = split_bytes(arrays["stamps"], arrays["stamp_bounds"])
+    # Group -1, i.e. the last one, is for the stamps without variants
+    variants = split_bytes(arrays["variants"], arrays["variant_bounds"]) + [b"null"]
+    catalog.json_fragments = np.empty(len(fragments), dtype=object)
+    catalog.json_fragments[:] = fragments
+    keys = zip(*(catalog.db[column].tolist() for column in ID_COLUMNS))
+    catalog.registry = dict(zip(keys, zip(fragments,
+                                          [variants[g] for g in arrays["groups"].tolist()])))
+
+
+def concatenated_bounds(items):
+    """The bounds of each of the `items`, arrays or bytes, in their concatenation. See
+       concatenated()."""
+    bounds = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in items], out=bounds[1:])
+    return bounds
+
+
+def split_bytes(data, bounds):
+    """The list of bytes objects that were concatenated into the uint8 array `data`, with their
+       `bounds` as returned by concatenated_bounds()."""
+    data = data.tobytes()
+    bounds = bounds.tolist()
+    return [data[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def save_arrays(directory, prefix, arrays):
+    """Save the dict of numpy `arrays` in `directory`, each in the file "{prefix}.{name}.npy".
+       Returns their names."""
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{prefix}.{name}.npy"), array)
+    return list(arrays)
+
+
+def load_arrays(directory, prefix, names):
+    """The numpy arrays with `names` saved by save_arrays(), as a dict."""
+    return {name: np.load(os.path.join(directory, f"{prefix}.{name}.npy")) for name in names}
+
+
+def build_snapshot(csv_file, directory=None, fields=None):
+    """Compile the stamp catalog CSV file `csv_file` into a snapshot in `directory`. If no
+       `directory` is given, the default snapshot directory for `csv_file` is used. Each column is
+       dictionary encoded: the distinct values of a column are stored in a JSON file and the rows
+       are stored as a numpy array of int32 codes into those values. The permutation that sorts
+       the stamps on their id and the indexes are stored as well, as numpy arrays and JSON. If
+       `fields` are given, the stamps are also stored encoded as JSON objects as specified by
+       `fields`, with their registry (see Catalog.build_registry()). Returns the directory."""
+    if directory is None:
+        directory = snapshot_dir(csv_file)
+    catalog = read_csv(csv_file)
+    db = catalog.db
+    stat = os.stat(csv_file)
+    # We write the snapshot to a temporary directory first and then move it in place, so that a
+    # loader never sees a half written snapshot.
+    tmp_directory = f"{directory}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    values = []
+    for i, column in enumerate(db.columns):
+        codes, uniques = pd.factorize(db[column], use_na_sentinel=False)
+        np.save(os.path.join(tmp_directory, f"{i}.npy"), codes.astype(np.int32))
+        values.append(uniques.tolist())
+    with open(os.path.join(tmp_directory, SNAPSHOT_VALUES_FILE), "w", encoding="utf-8") as f:
+        json.dump(values, f, ensure_ascii=False)
+    np.save(os.path.join(tmp_directory, SNAPSHOT_ORDER_FILE), catalog.id_order)
+    indexes = {}
+    for name, (index_values, arrays) in index_states(catalog).items():
+        indexes[name] = {"values": index_values,
+                         "arrays": save_arrays(tmp_directory, name, arrays)}
+    with open(os.path.join(tmp_directory, SNAPSHOT_INDEXES_FILE), "w", encoding="utf-8") as f:
+        json.dump(indexes, f, ensure_ascii=False)
+    registry = None
+    if fields is not None:
+        catalog.build_registry(fields)
+        registry = save_arrays(tmp_directory, "registry", registry_state(catalog))
+    manifest = {"format": SNAPSHOT_FORMAT_VERSION,
+                "source": {"file": os.path.basename(csv_file),
+                           "size": stat.st_size,
+                           "mtime_ns": stat.st_mtime_ns,
+                           "sha256": catalog.version},
+                "rows": len(db),
+                "columns": db.columns.tolist(),
+                "fields": fields,
+                "registry": registry}
+    # The manifest is written last. A snapshot directory without a manifest is never loaded.
+    with open(os.path.join(tmp_directory, SNAPSHOT_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmp_directory, directory)
+    return directory
+
+
+def snapshot_is_current(manifest, csv_file):
+    """True if the snapshot `manifest` was built from the current contents of `csv_file`."""
+    if manifest.get("format") != SNAPSHOT_FORMAT_VERSION:
+        return False
+    source = manifest["source"]
+    stat = os.stat(csv_file)
+    if stat.st_size != source["size"]:
+        return False
+    if stat.st_mtime_ns == source["mtime_ns"]:
+        return True
+    # The file has been touched (e.g. by a git checkout), so we have to compare the contents.
+    return file_digest(csv_file) == source["sha256"]
+
+
+def read_snapshot(directory, fields=None):
+    """Read the snapshot in `directory` and return a Catalog. Each column is decoded into an
+       object array of its values with a single numpy take, since the handlers and indexes work
+       on plain string columns. The indexes are restored rather than built. If the snapshot holds
+       the stamps encoded as JSON as specified by `fields`, the encoded stamps and the registry
+       are restored too, see build_snapshot()."""
+    tic = time.perf_counter_ns()
+    with open(os.path.join(directory, SNAPSHOT_MANIFEST_FILE), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format {manifest.get('format')}.")
+    with open(os.path.join(directory, SNAPSHOT_VALUES_FILE), encoding="utf-8") as f:
+        values = json.load(f)
+    columns = {}
+    for i, column in enumerate(manifest["columns"]):
+        codes = np.load(os.path.join(directory, f"{i}.npy"))
+        if len(codes) != manifest["rows"]:
+            raise ValueError(f"Column '{column}' in snapshot has the wrong number of rows.")
+        uniques = np.empty(len(values[i]), dtype=object)
+        uniques[:] = values[i]
+        columns[column] = uniques[codes]
+    db = pd.DataFrame(columns, columns=manifest["columns"])
+    # The id order is stored, so the stamps are never sorted on their id when loaded
+    order = np.load(os.path.join(directory, SNAPSHOT_ORDER_FILE))
+    with open(os.path.join(directory, SNAPSHOT_INDEXES_FILE), encoding="utf-8") as f:
+        indexes = json.load(f)
+    states = {name: (index["values"], load_arrays(directory, name, index["arrays"]))
+              for name, index in indexes.items()}
+    catalog = Catalog(db, indexed(db, order), manifest["source"]["sha256"], "snapshot", order,
+                      restored_indexes(states))
+    # The fields as they would be after a JSON round trip, i.e. with lists instead of tuples
+    if fields is not None and manifest["fields"] == json.loads(json.dumps(fields)):
+        restore_registry(catalog, load_arrays(directory, "registry", manifest["registry"]))
+    catalog.load_time = (time.perf_counter_ns() - tic)/1000000
+    return catalog
+
+
+def load(csv_file, use_snapshot=True, fields=None):
+    """Load the stamp catalog CSV file `csv_file` and return a Catalog. If `use_snapshot` is True
+       and there is a current snapshot of `csv_file`, the catalog is read from the snapshot.
+       Otherwise, or if the snapshot is stale or can't be read, it is read from the CSV file.
+       `fields` are the fields the stamps are encoded with, see read_snapshot()."""
+    if use_snapshot:
+        directory = snapshot_dir(csv_file)
+        manifest_file = os.path.join(directory, SNAPSHOT_MANIFEST_FILE)
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file, encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if snapshot_is_current(manifest, csv_file):
+                    return read_snapshot(directory, fields)
+                logger.warning(f"Snapshot '{directory}' is stale. Reading '{csv_file}' instead.")
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                logger.warning(f"Can't read snapshot '{directory}' ({e}). Reading '{csv_file}'.")
+    return read_csv(csv_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a snapshot of a stamp catalog CSV file.")
+    parser.add_argument("csv_file", help="The stamp catalog CSV file.")
+    parser.add_argument("-o", "--output", help="The snapshot directory. Defaults to the name of "
+                                               "the CSV file with the suffix '.snapshot'.")
+    args = parser.parse_args()
+    # The stamps are encoded the way the API encodes them, so it doesn't have to on startup
+    from main import stamp_json_fields
+    tic = time.perf_counter_ns()
+    directory = build_snapshot(args.csv_file, args.output, stamp_json_fields())
+    toc = time.perf_counter_ns()
+    print(f"Built snapshot '{directory}' in {(toc - tic)/1000000:.1f} ms.")
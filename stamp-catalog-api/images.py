@@ -0,0 +1,128 @@
+# This module contains the stamp images of the Faststamps Catalog API. The catalog has one image
+# per stamp, in the "large" size. Smaller renditions of the images are generated from them, either
+# lazily when they are first requested or all at once with:
+#
+#   python images.py ./data/images/large ./data/images
+#
+# which writes the renditions to `data/images/thumbnail` and `data/images/medium`.
+
+import argparse
+import email.utils
+import hashlib
+import os
+import os.path
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+
+# The maximum (width, height) of each rendition size. "large" is the original image.
+RENDITION_SIZES = {"thumbnail": (76, 90),
+                   "medium": (190, 225)}
+SIZES = ["thumbnail", "medium", "large"]
+JPEG_QUALITY = 85
+
+
+class StampImage:
+    """A stamp image file in memory, with the validators used in HTTP responses."""
+
+    def __init__(self, data, mtime):
+        self.data = data
+        self.etag = f"\"{hashlib.md5(data).hexdigest()}\""
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self.mtime = mtime
+
+
+class ImageCache:
+    """A least recently used cache of StampImages, bounded by the total size in bytes of the
+       images. It is safe to use from multiple threads."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The image cached with `key`, or None."""
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        """Cache `image` with `key`, evicting the least recently used images if needed. Images
+           larger than the cache are not cached."""
+        if len(image.data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old.data)
+            self._images[key] = image
+            self.bytes += len(image.data)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.bytes -= len(evicted.data)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.bytes = 0
+
+
+def rendition_path(images_dir, renditions_dir, image, size):
+    """The path of the `size` rendition of the image file `image`."""
+    if size == "large":
+        return os.path.join(images_dir, image)
+    return os.path.join(renditions_dir, size, image)
+
+
+def render(source, target, size):
+    """Write the `size` rendition of the image file `source` to `target`."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Write to a temporary file first, so concurrent readers never see a partial image.
+    tmp_target = f"{target}.tmp{os.getpid()}.{threading.get_ident()}"
+    with Image.open(source) as im:
+        im.thumbnail(RENDITION_SIZES[size])
+        im.convert("RGB").save(tmp_target, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmp_target, target)
+
+
+def read_image(images_dir, renditions_dir, image, size):
+    """Read the `size` rendition of the image file `image` and return a StampImage. Renditions
+       are generated if they don't exist or are older than the original image. Raises
+       FileNotFoundError if there is no such image."""
+    source = os.path.join(images_dir, image)
+    path = rendition_path(images_dir, renditions_dir, image, size)
+    if size != "large":
+        source_mtime = os.stat(source).st_mtime
+        if not os.path.exists(path) or os.stat(path).st_mtime < source_mtime:
+            render(source, path, size)
+    with open(path, "rb") as f:
+        data = f.read()
+        mtime = os.fstat(f.fileno()).st_mtime
+    return StampImage(data, mtime)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate renditions of stamp images.")
+    parser.add_argument("images_dir", help="The directory with the (large) stamp images.")
+    parser.add_argument("renditions_dir", help="The directory to write the renditions to.")
+    args = parser.parse_args()
+    tic = time.perf_counter_ns()
+    count = 0
+    for image in sorted(os.listdir(args.images_dir)):
+        if image.lower().endswith(".jpg"):
+            for size in RENDITION_SIZES:
+                render(os.path.join(args.images_dir, image),
+                       rendition_path(args.images_dir, args.renditions_dir, image, size), size)
+            count += 1
+    toc = time.perf_counter_ns()
+    print(f"Rendered {count} images in {(toc - tic)/1000000000:.1f} s.")
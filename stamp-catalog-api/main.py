@@ -1,15 +1,29 @@
-from fastapi import FastAPI, status, Request, Response, Path, Query, Header
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, status, Request, Response, Path, Query, Header, BackgroundTasks
+from fastapi import Depends, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Match
 from contextlib import asynccontextmanager
-from typing import Optional, List
+from typing import Optional, List, Literal
 from pydantic import BaseModel, HttpUrl
 from pydantic_settings import BaseSettings
 import logging
 import logging.config
-import pandas as pd
-import numpy as np
+import asyncio
+import base64
+import datetime
+import email.utils
+import hashlib
+import hmac
+import json
 import os.path
+import threading
 import time
+import catalogs
+import compression
+import database
+import images
+import metrics
+import storage
 
 description = """
 ## Faststamps Catalog API
@@ -28,6 +42,39 @@ class Settings(BaseSettings):
     VERSION: str = "0.0.1"
     STAMP_CATALOG_CSV_FILE: str = "./data/french-stamps.csv"
     STAMP_CATALOG_IMAGES_DIR: str = "./data/images/large"
+    # Directory with stamp catalog CSV files served under /catalogs/{name}, where name is the file
+    # name without ".csv". The default catalog is also served as /catalogs/{name}. The catalogs
+    # share the stamp images of the default catalog.
+    STAMP_CATALOGS_DIR: str = "./data"
+    # Max total memory in bytes of the catalogs loaded from STAMP_CATALOGS_DIR. When it is
+    # exceeded, the least recently used catalogs are unloaded until they are loaded again.
+    STAMP_CATALOGS_MEMORY_BUDGET: int = 512 * 1024 * 1024
+    # Where the thumbnail and medium renditions of the stamp images are stored (see images.py)
+    STAMP_CATALOG_RENDITIONS_DIR: str = "./data/images"
+    # Max total size in bytes of the stamp images cached in memory
+    IMAGE_CACHE_SIZE: int = 64 * 1024 * 1024
+    # Check the catalog CSV file for changes every this many seconds, and reload the catalog when
+    # it has changed. 0 means never.
+    STAMP_CATALOG_WATCH_INTERVAL: float = 0
+    # Token required in the X-Admin-Token header of admin requests. Admin requests are refused
+    # if no token is set.
+    ADMIN_TOKEN: str = ""
+    # The storage engine answering the stamp queries, "pandas" (in memory) or "sqlite" (see
+    # storage.py). With "sqlite" the catalog is only read into memory to build its database.
+    STAMP_CATALOG_STORAGE: Literal["pandas", "sqlite"] = "pandas"
+    # Read the catalog from its binary snapshot (see database.py) if there is a current one
+    STAMP_CATALOG_USE_SNAPSHOT: bool = True
+    # Max number of stamp ids in a /stamps/batch request
+    MAX_BATCH_SIZE: int = 1000
+    # Number of stamps per chunk in streamed /stamps responses
+    STREAM_CHUNK_SIZE: int = 500
+    # Cache-Control header of successful responses. The responses also get an ETag based on the
+    # catalog version, so clients and caches can revalidate them cheaply.
+    CACHE_CONTROL: str = "public, max-age=60"
+    # Compress response bodies of at least this many bytes, if the client accepts it
+    COMPRESSION_MIN_SIZE: int = 1024
+    # Max total size in bytes of the compressed responses cached in memory (see compression.py)
+    COMPRESSED_CACHE_SIZE: int = 32 * 1024 * 1024
     LOGGING_LEVEL: str = "DEBUG"
     logger: logging.Logger = logging.getLogger(__name__)
     logger.setLevel(LOGGING_LEVEL)
@@ -40,10 +87,42 @@ settings = Settings()
 
 
 # Globals. :-# OMG! What did I do!?
-# These "databases" are simply Pandas Dataframes. One holds the stamps CSV file and the other simply
-# is an indexed version of the former.
-db = None
-indexed_db = None
+# The "database" is a database.Catalog holding the stamps CSV file as Pandas Dataframes, together
+# with the indexes we build over them when the catalog is loaded. With the sqlite storage engine
+# it is a storage.StoredCatalog instead, which only has the store and the catalog's metadata.
+catalog = None
+# The named catalogs, see catalogs.py. Created at startup.
+named_catalogs = None
+# Only one catalog reload at a time, and the statistics of the reloads
+reload_lock = threading.Lock()
+reloads = {"count": 0,
+           "failed": 0,
+           "in_progress": False,
+           "last_reload": None,
+           "last_duration": None,
+           "last_error": None}
+# The most recently used stamp images
+image_cache = images.ImageCache(settings.IMAGE_CACHE_SIZE)
+# The most recently used compressed responses for the whole catalog and the stamp attributes
+compressed_cache = compression.CompressedCache(settings.COMPRESSED_CACHE_SIZE)
+# The metrics of the requests, exposed by /metrics together with the metrics of the caches and
+# catalogs. See metrics.py.
+request_durations = metrics.Histogram("faststamps_request_duration_seconds",
+                                      "Duration of the requests, in total and per phase.",
+                                      ("route", "phase"), metrics.LATENCY_BUCKETS)
+request_counts = metrics.Counter("faststamps_requests_total",
+                                 "Number of requests by route, method and status.",
+                                 ("route", "method", "status"))
+response_sizes = metrics.Histogram("faststamps_response_size_bytes",
+                                   "Size of the response bodies that have a Content-Length.",
+                                   ("route",), metrics.SIZE_BUCKETS)
+result_sizes = metrics.Histogram("faststamps_result_stamps",
+                                 "Number of stamps returned by the stamp queries.",
+                                 ("route",), metrics.RESULT_BUCKETS)
+revalidations = metrics.Counter("faststamps_revalidations_total",
+                                "Number of conditional GET requests, by whether they were "
+                                "answered with 304 Not Modified (a hit) or not (a miss).",
+                                ("result",))
 
 
 # Pydantic data classes used in the API
@@ -55,6 +134,54 @@ class ApiInfo(BaseModel):
     health: HttpUrl     # URL to resource with info on the health of the API
 
 
+class CatalogInfo(BaseModel):
+    """Represents information on the loaded stamp catalog."""
+    version: str        # SHA-256 digest of the catalog CSV file
+    source: str         # Where the catalog was read from, "csv", "snapshot" or "sqlite"
+    stamps: int         # Number of stamps in the catalog
+    loaded_at: datetime.datetime
+    load_time: float    # Time in milliseconds it took to load the catalog and build its indexes
+
+
+class ReloadInfo(BaseModel):
+    """Represents information on the reloads of the stamp catalog."""
+    count: int          # Number of successful reloads
+    failed: int         # Number of failed reloads
+    in_progress: bool
+    last_reload: Optional[datetime.datetime]
+    last_duration: Optional[float]  # Time in milliseconds the last reload took
+    last_error: Optional[str]
+
+
+class Health(BaseModel):
+    """Represents information on the health of the API."""
+    status: str         # "ok" or "no catalog"
+    catalog: Optional[CatalogInfo]
+    reloads: ReloadInfo
+
+
+class NamedCatalogInfo(BaseModel):
+    """Represents information on a named stamp catalog and its use."""
+    name: str           # Eg. 'french-stamps'
+    default: bool       # True for the default catalog, which is always loaded
+    loaded: bool
+    version: Optional[str]  # SHA-256 digest of the catalog CSV file, if loaded
+    stamps: Optional[int]   # Number of stamps in the catalog, if loaded
+    memory: int         # Estimated memory in bytes used by the catalog, if loaded
+    loads: int          # Number of times the catalog has been loaded
+    hits: int           # Number of requests served from the already loaded catalog
+    evictions: int      # Number of times the catalog has been unloaded to free memory
+    last_load_time: Optional[float]  # Time in milliseconds the last load took
+
+
+class CatalogList(BaseModel):
+    """Represents the named stamp catalogs and their memory use."""
+    count: int
+    memory: int         # Memory in bytes used by the loaded catalogs, except the default one
+    memory_budget: int  # Max memory in bytes the loaded catalogs, except the default one, may use
+    catalogs: List[NamedCatalogInfo]
+
+
 class StampId(BaseModel):
     """The attributes that uniquely identify a stamp."""
     type: str         # Eg. "Poste"
@@ -81,32 +208,321 @@ class Stamp(BaseModel):
 
 class StampWithVariants(Stamp):
     """Represents a stamp with information on its variants."""
-    variants: dict[str, Stamp]
+    variants: Optional[dict[str, Stamp]]  # None if the stamp has no variants
 
 
 class StampList(BaseModel):
     """Represents a list of stamps."""
     count: int
+    total: Optional[int] = None  # The number of stamps matching the query, if asked for
+    # The number of variant stamps left out of `total` with variants=false, if asked for
+    variants_total: Optional[int] = None
     stamps: List[Stamp]
 
 
+class StampIdList(BaseModel):
+    """Represents a list of stamp ids."""
+    ids: List[str]      # Eg. ['Poste-1', 'Poste-1-a']
+
+
+class StampBatch(BaseModel):
+    """Represents the stamps found for a list of stamp ids, and the ids that were not found."""
+    count: int
+    stamps: List[StampWithVariants]
+    missing: List[str]  # Eg. ['Poste-0']
+
+
 class StringValuesList(BaseModel):
     """Represents a list of string values."""
     count: int
     values: List[str]
 
 
+class ValueCountsList(StringValuesList):
+    """Represents a list of string values, with the number of stamps that have each value."""
+    counts: List[int]
+
+
+class FacetCounts(BaseModel):
+    """Represents the values of a stamp attribute and the number of stamps with each value."""
+    values: List[str]
+    counts: List[int]
+
+
+class StampFacets(BaseModel):
+    """Represents the number of stamps matching a query, and the values of the stamp attributes
+       (facets) of the matching stamps with their number of stamps."""
+    count: int
+    facets: dict[str, FacetCounts]   # Eg. {'issued': {'values': ['1849'], 'counts': [5]}}
+
+
+# The routes of a named catalog are the routes of the default catalog with this prefix
+CATALOG_PREFIX = "/catalogs/{catalog_name}"
+# OpenAPI parameters of the routes of a named catalog. Their handlers get the catalog through the
+# requested_catalog() dependency, so they don't have a catalog_name parameter of their own.
+CATALOG_ROUTE_EXTRA = {"parameters": [{"name": "catalog_name",
+                                       "in": "path",
+                                       "required": True,
+                                       "description": "The name of the stamp catalog, e.g. "
+                                                      "'french-stamps'. See `/catalogs`.",
+                                       "schema": {"type": "string"}}]}
+
+# The values of the /stamps sort parameter, and the sort key of each (see database.SORT_KEYS).
+# "{lang}" is replaced by the language of the request.
+SORT_PARAMETERS = {"yt_no": "yt_no",
+                   "issued": "issued",
+                   "title": "title_{lang}"}
+
+# The routes that report the state of the API rather than the catalog, e.g. its health, metrics
+# and the use of the named catalogs. Their responses change without the catalog changing, so they
+# get no ETag and are never cached. So are the routes under /admin/.
+UNCACHED_PATHS = ["/", "/health", "/metrics", "/catalogs"]
+
+# The stamp DB columns holding the attributes of a StampId
+STAMP_ID_COLUMNS = {"yt_no": "id_yt_no",
+                    "yt_variant": "id_yt_var",
+                    "type": "type_fr"}
+
+
 # Utility functions
-def convert_db_stamp_to_api_stamp(d: dict):
-    """Convert the stamp dict `d` from the stamp DB to an API stamp dict that can be parsed to a
-       Stamp model object."""
-    id = {"yt_no": d["id_yt_no"],
-          "yt_variant": d["id_yt_var"],
-          "type": d["type_fr"]}
-    d["id"] = id
-    del d["id_yt_no"]
-    del d["id_yt_var"]
-    del d["type_fr"]
+def stamp_json_fields():
+    """The (name, column) specification of how to encode a stamp DB row as a Stamp JSON object.
+       See database.Catalog.build_json_fragments()."""
+    fields = []
+    for name in Stamp.model_fields:
+        if name == "id":
+            fields.append((name, [(id_name, STAMP_ID_COLUMNS[id_name])
+                                  for id_name in StampId.model_fields]))
+        else:
+            fields.append((name, name))
+    return fields
+
+
+def projected_fields(names):
+    """The (name, column) specification, see stamp_json_fields(), of the Stamp fields in the
+       comma-separated list of field `names`, e.g. 'id,title_en,issued'. A field of the stamp id
+       is given as e.g. 'id.yt_no', and 'id' alone is all of them. The fields are in the order of
+       the Stamp model, whatever their order in `names`. Returns None if a name is not a field."""
+    selected = set()
+    for name in names.split(','):
+        name = name.strip()
+        if name == "id":
+            selected.update(f"id.{id_name}" for id_name in StampId.model_fields)
+        elif name in Stamp.model_fields or \
+                (name.startswith("id.") and name[3:] in StampId.model_fields):
+            selected.add(name)
+        else:
+            return None
+    fields = []
+    for name, column in stamp_json_fields():
+        if isinstance(column, list):
+            column = [(id_name, id_column) for id_name, id_column in column
+                      if f"{name}.{id_name}" in selected]
+            if column:
+                fields.append((name, column))
+        elif name in selected:
+            fields.append((name, column))
+    return fields
+
+
+def parsed_ranges(values):
+    """Parse a comma-separated list of `values` and ranges of numbers, e.g. '1849,1931..1940' or
+       '1990..', and return a list with the values and (low, high) tuples for the ranges, as
+       expected by database.Catalog.positions(). The low or high end of a range can be left out.
+       Returns None if a range is not valid."""
+    result = []
+    for value in values.split(','):
+        if ".." not in value:
+            result.append(value)
+            continue
+        low, _, high = value.partition("..")
+        try:
+            result.append((int(low) if low else None, int(high) if high else None))
+        except ValueError:
+            return None
+    return result
+
+
+def stamp_filters(language, title, issued, color, value, stamp_type, variants=True):
+    """The filters for a stamp query as a dict mapping each given query parameter to a (column,
+       values) tuple, as expected by database.Catalog.query(). The title, color and value filters
+       apply to the columns of the given `language`. `issued` is the list returned by
+       parsed_ranges(). If not `variants`, the variant stamps are filtered out."""
+    lang = "fr" if language[0:2] == "fr" else "en"
+    filters = {}
+    if title is not None:
+        filters["title"] = (f"title_{lang}", [title])
+    if issued is not None:
+        filters["issued"] = ("issued", issued)
+    if color is not None:
+        filters["color"] = (f"color_{lang}", color.split(','))
+    if value is not None:
+        filters["value"] = (f"value_{lang}", [value])
+    if stamp_type is not None:
+        filters["stamp-type"] = ("type_fr", stamp_type.split(','))
+    if not variants:
+        filters["variants"] = ("id_yt_var", [""])
+    return filters
+
+
+def query_totals(store, filters, text, total):
+    """The (total, variants_total) of a /stamps query with the `filters` returned by
+       stamp_filters() and the search `text`, in the storage.StampStore `store`: the number of
+       matching stamps, and the number of matching variant stamps left out by the "variants"
+       filter if there is one, or None. Both are None unless `total`."""
+    if not total:
+        return None, None
+    matching = store.total(list(filters.values()), text)
+    if "variants" not in filters:
+        return matching, None
+    others = [f for name, f in filters.items() if name != "variants"]
+    return matching, store.total(others, text) - matching
+
+
+def ndjson_stamps(chunks):
+    """Generate the stamps in `chunks`, lists of UTF-8 encoded Stamp JSON objects as returned by
+       storage.StampStore.stream(), as newline delimited JSON, one chunk of stamps at a time."""
+    for chunk in chunks:
+        yield b"".join([stamp + b"\n" for stamp in chunk])
+
+
+def stamp_list_head(count, total=None, variants_total=None):
+    """The beginning of a StampList JSON document with `count` stamps, up to its first stamp. The
+       `total` and `variants_total` are included if not None."""
+    return b"".join([b'{"count":', str(count).encode(),
+                     b',"total":' + str(total).encode() if total is not None else b"",
+                     b',"variants_total":' + str(variants_total).encode()
+                     if variants_total is not None else b"",
+                     b',"stamps":['])
+
+
+def json_stamp_list(count, chunks, total=None, variants_total=None):
+    """Generate a StampList JSON document with the `count` stamps in `chunks` (see
+       ndjson_stamps()), one chunk of stamps at a time. The `total` and `variants_total` are
+       included if not None."""
+    yield stamp_list_head(count, total, variants_total)
+    separator = b""
+    for chunk in chunks:
+        yield separator + b",".join(chunk)
+        separator = b","
+    yield b"]}"
+
+
+def parsed_sort(sort, language):
+    """Parse the /stamps `sort` parameter, e.g. 'issued' or '-title', and return the tuple (key,
+       descending) as expected by database.Catalog.sorted(). Returns None if `sort` is None or
+       not valid."""
+    if sort is None:
+        return None
+    descending = sort.startswith("-")
+    key = SORT_PARAMETERS.get(sort.removeprefix("-"))
+    if key is None:
+        return None
+    lang = "fr" if language[0:2] == "fr" else "en"
+    return key.format(lang=lang), descending
+
+
+def cursor_query(filters, sort, search):
+    """A short digest identifying a /stamps query with the given `filters`, `sort` and `search`,
+       so a cursor can only be used to continue the query it was issued for."""
+    return hashlib.sha256(repr((filters, sort, search)).encode()).hexdigest()[:16]
+
+
+def encoded_cursor(version, query, after):
+    """An opaque /stamps cursor for the page after the stamp with the sort key `after` (see
+       storage.StampStore.page()), or after the first `after` stamps of a search, in the catalog
+       with the given `version` and for the query with the digest `query`."""
+    data = json.dumps([version, query, after], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decoded_cursor(cursor):
+    """Decode a cursor made by encoded_cursor() and return its (version, query, after) tuple.
+       Returns None if `cursor` is not a valid cursor."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        version, query, after = json.loads(data)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(version, str) or not isinstance(query, str):
+        return None
+    if isinstance(after, list) and after and all(type(item) is int for item in after):
+        return version, query, tuple(after)
+    if type(after) is int and after >= 0:
+        return version, query, after
+    return None
+
+
+def cursor_fits(after, searching, sort):
+    """True if `after`, as decoded by decoded_cursor(), can continue a /stamps query that is
+       `searching` or not, in the order `sort`. The cursor of a search holds the number of stamps
+       already returned, and the cursors of other queries hold a sort key as made by
+       database.Catalog.sort_key(), which has one item in catalog order and two otherwise."""
+    if searching:
+        return type(after) is int
+    return type(after) is tuple and len(after) == (1 if sort is None else 2) and after[-1] >= 0
+
+
+def parsed_stamp_id(stamp_id):
+    """Parse the `stamp_id` string 'T-N-V' or 'T-N' and return the tuple (T, N, V) identifying
+       the stamp in the catalog, where V is "" if not given. Returns None if `stamp_id` is not a
+       valid stamp id."""
+    items = stamp_id.split("-")
+    if len(items) == 2:
+        return (items[0], items[1], "")
+    elif len(items) == 3:
+        return tuple(items)
+    else:
+        return None
+
+
+def stamp_with_variants_json(entry):
+    """The StampWithVariants JSON object of the (stamp, variants) `entry` returned by
+       storage.StampStore.stamp()."""
+    stamp, variants = entry
+    # Add the variants as the last member of the stamp JSON object
+    return b"".join([stamp[:-1], b',"variants":', variants, b"}"])
+
+
+def values_list(store, column, counts, timings):
+    """A StringValuesList dict of the values of `column` in the storage.StampStore `store`, which
+       is also a ValueCountsList dict with the number of stamps with each value if `counts` is
+       True. Its "query" and "encode" phases are timed in the metrics.Timings `timings`."""
+    with timings.phase("query"):
+        values, value_counts = store.values(column)
+    with timings.phase("encode"):
+        result = {"count": len(values),
+                  "values": values}
+        if counts:
+            result["counts"] = value_counts
+    return result
+
+
+def representation_etag(version, request):
+    """A strong ETag for the representation of the resource requested with `request` in the
+       catalog with the given `version`. Since the catalog is read-only, the representation only
+       depends on the catalog version, the resource path, the query parameters, and the language,
+       media type and content coding negotiated from the request headers."""
+    language = parsed_accept_language(request.headers.get("accept-language"))[0][0]
+    lang = "fr" if language[0:2] == "fr" else "en"
+    media_type = "ndjson" if "application/x-ndjson" in request.headers.get("accept", "") else "json"
+    encoding = compression.negotiated_encoding(request.headers.get("accept-encoding"))
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    key = "\n".join([version, str(request.base_url), request.url.path, query, lang, media_type,
+                     encoding or "identity"])
+    return f'"{hashlib.sha256(key.encode()).hexdigest()[:32]}"'
+
+
+def etag_matches(etag, if_none_match):
+    """True if `etag` matches any of the entity tags in the If-None-Match header value
+       `if_none_match`."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so we ignore any weakness indicator W/
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags
 
 
 def parsed_accept_language(accept_language):
@@ -128,27 +544,164 @@ def parsed_accept_language(accept_language):
         return result
 
 
+def load_catalog(csv_file=None):
+    """Load the stamp catalog CSV file `csv_file`, by default the default catalog, and build all
+       the indexes and encodings the request handlers use. Returns the database.Catalog, which is
+       not modified after this. Its load_time is the time all of this took. With the sqlite
+       storage engine, the catalog is served from its SQLite database instead, and a
+       storage.StoredCatalog is returned."""
+    if csv_file is None:
+        csv_file = settings.STAMP_CATALOG_CSV_FILE
+    load_tic = time.perf_counter_ns()
+    if settings.STAMP_CATALOG_STORAGE == "sqlite":
+        # The catalog is only read into memory if the database has to be (re)built
+        cat = storage.load_sqlite(csv_file, stamp_json_fields(),
+                                  use_snapshot=settings.STAMP_CATALOG_USE_SNAPSHOT)
+        toc = time.perf_counter_ns()
+        settings.logger.info(f"Opened {cat.store.name} storage in {(toc - load_tic)/1000000} ms.")
+        cat.load_time = (toc - load_tic)/1000000
+        return cat
+    # A snapshot may hold the stamps encoded with these fields, and their registry
+    cat = database.load(csv_file, use_snapshot=settings.STAMP_CATALOG_USE_SNAPSHOT,
+                        fields=stamp_json_fields())
+    settings.logger.info(f"Loaded catalog from {cat.source} in {cat.load_time} ms.")
+    tic = time.perf_counter_ns()
+    # The pandas engine builds the registry it looks up stamps in
+    cat.store = storage.open_store(settings.STAMP_CATALOG_STORAGE, cat, csv_file,
+                                   stamp_json_fields())
+    toc = time.perf_counter_ns()
+    settings.logger.info(f"Opened {cat.store.name} storage in {(toc - tic)/1000000} ms.")
+    cat.load_time = (toc - load_tic)/1000000
+    return cat
+
+
+def reload_catalog():
+    """Load the stamp catalog CSV file again and swap in the new catalog. The new catalog is
+       completely built before it replaces the old one in a single assignment, so request
+       handlers always see either the old or the new catalog. Only one reload runs at a time.
+       Returns False if a reload was already running."""
+    global catalog
+    if not reload_lock.acquire(blocking=False):
+        return False
+    try:
+        reloads["in_progress"] = True
+        tic = time.perf_counter_ns()
+        try:
+            new_catalog = load_catalog()
+        except Exception as e:
+            settings.logger.exception("Reloading the catalog failed.")
+            reloads["failed"] += 1
+            reloads["last_error"] = str(e)
+        else:
+            catalog = new_catalog
+            named_catalogs.pin(default_catalog_name(), new_catalog)
+            reloads["count"] += 1
+            reloads["last_error"] = None
+        toc = time.perf_counter_ns()
+        reloads["last_duration"] = (toc - tic)/1000000
+        reloads["last_reload"] = datetime.datetime.now(datetime.timezone.utc)
+        settings.logger.info(f"Reloaded catalog in {reloads['last_duration']} ms.")
+    finally:
+        reloads["in_progress"] = False
+        reload_lock.release()
+    return True
+
+
+def default_catalog_name():
+    """The name of the default catalog: the name of its CSV file without ".csv"."""
+    return os.path.basename(settings.STAMP_CATALOG_CSV_FILE).removesuffix(".csv")
+
+
+def requested_catalog(request: Request):
+    """The catalog requested with `request`, which is a named catalog (loaded if needed) if the
+       route has a catalog_name path parameter and the default catalog otherwise. Used as a
+       dependency by the request handlers, so all through a request they use the same catalog,
+       even if it is reloaded or unloaded meanwhile."""
+    name = request.path_params.get("catalog_name")
+    if name is None:
+        return catalog
+    cat = named_catalogs.get(name)
+    if cat is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"There is no stamp catalog '{name}'.")
+    return cat
+
+
+def is_uncached(path):
+    """True if the responses for the request `path` must not be cached, see UNCACHED_PATHS."""
+    return path in UNCACHED_PATHS or path.startswith("/admin/")
+
+
+def is_compression_cached(request):
+    """True if the response to `request` is to be compressed once per catalog version and cached:
+       the whole catalog and the lists of stamp attributes. Only requests without query parameters
+       are, since filtered and queried responses are too many and too rarely repeated."""
+    if len(request.query_params) > 0:
+        return False
+    path = request.url.path
+    if path.startswith("/catalogs/"):
+        path = "/" + "/".join(path.split("/")[3:])
+    return path in ("/stamps", "/stamp_titles", "/stamp_years", "/stamp_colors", "/stamp_values",
+                    "/stamp_facets")
+
+
+async def compressed_chunks(chunks, compressor):
+    """Generate the `chunks` of a streamed body compressed with `compressor`, one at a time."""
+    async for chunk in chunks:
+        yield await asyncio.to_thread(compressor.compress, chunk)
+    yield compressor.finish()
+
+
+def loaded_catalog_version(path):
+    """The version of the catalog of the request `path` if it is loaded, otherwise None."""
+    if not path.startswith("/catalogs/"):
+        return catalog.version if catalog is not None else None
+    name = path.split("/")[2]
+    cat = named_catalogs.loaded(name) if named_catalogs is not None else None
+    return cat.version if cat is not None else None
+
+
+def catalog_file_signature():
+    """The size and modification time of the stamp catalog CSV file, or None if it is missing."""
+    try:
+        stat = os.stat(settings.STAMP_CATALOG_CSV_FILE)
+        return (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return None
+
+
+async def watch_catalog_file(interval):
+    """Check the stamp catalog CSV file for changes every `interval` seconds, and reload the
+       catalog in a worker thread when it has changed."""
+    signature = catalog_file_signature()
+    while True:
+        await asyncio.sleep(interval)
+        new_signature = catalog_file_signature()
+        if new_signature is not None and new_signature != signature:
+            settings.logger.info("The catalog CSV file has changed. Reloading it.")
+            signature = new_signature
+            await asyncio.to_thread(reload_catalog)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code here
     settings.logger.info("Starting up and initializing stuff.")
-    global db, indexed_db
+    global catalog, named_catalogs
+    watcher = None
+    named_catalogs = catalogs.Catalogs(settings.STAMP_CATALOGS_DIR,
+                                       settings.STAMP_CATALOGS_MEMORY_BUDGET, load_catalog)
     if os.path.exists(settings.STAMP_CATALOG_CSV_FILE):
-        with open(settings.STAMP_CATALOG_CSV_FILE) as f:
-            db = pd.read_csv(f, delimiter=';', dtype={'issued': str, 'id_yt_no': str})
-            # We replace all np.NAN with an empty string "" and create a multindex
-            # consisting of the stamp type, Yt no and variant.
-            db = db.replace({np.nan: ""})
-            # Add URL column
-            db["url"] = db[["type_fr", "id_yt_no", "id_yt_var"]].apply(
-                    lambda x: f"stamps/{x[0]}-{x[1]}-{x[2]}" if x[2]
-                              else f"stamps/{x[0]}-{x[1]}", axis=1)
-            # Create index of db and sort the index
-            indexed_db = db.set_index(["type_fr", "id_yt_no", "id_yt_var"])
-            indexed_db = indexed_db.sort_index()
+        catalog = load_catalog()
+        named_catalogs.pin(default_catalog_name(), catalog)
+        if settings.STAMP_CATALOG_WATCH_INTERVAL > 0:
+            watcher = asyncio.create_task(
+                watch_catalog_file(settings.STAMP_CATALOG_WATCH_INTERVAL))
     yield
     # Clean up code here
     settings.logger.info("Shutting down and cleaning up.")
+    if watcher is not None:
+        watcher.cancel()
 
 
 app = FastAPI(
@@ -158,31 +711,304 @@ app = FastAPI(
     lifespan=lifespan)
 
 
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    """Add ETag and Cache-Control headers to all successful GET responses, and answer GET
+       requests with a matching If-None-Match header with 304 Not Modified, without running the
+       request handler. A named catalog that is not loaded is first loaded by the request
+       handler, so such requests always run the handler. The responses of the routes that
+       report the state of the API (see is_uncached()) get "Cache-Control: no-store" instead."""
+    if is_uncached(request.url.path):
+        response = await call_next(request)
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    if request.method not in ("GET", "HEAD"):
+        return await call_next(request)
+    timings = metrics.Timings()
+    version = loaded_catalog_version(request.url.path)
+    if version is not None:
+        with timings.phase("validate"):
+            etag = representation_etag(version, request)
+        if etag_matches(etag, request.headers.get("if-none-match")):
+            # Return server execution time in milliseconds, in total and per phase
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                            headers={"ETag": etag,
+                                     "Cache-Control": settings.CACHE_CONTROL,
+                                     "Vary": "Accept, Accept-Encoding, Accept-Language",
+                                     "Server-Timing": timings.header()})
+    response = await call_next(request)
+    # Responses that have their own validators, e.g. images, keep them
+    if response.status_code == status.HTTP_200_OK and "etag" not in response.headers:
+        if version is None:
+            version = loaded_catalog_version(request.url.path)
+            if version is None:
+                return response
+        response.headers.update({"ETag": representation_etag(version, request),
+                                 "Cache-Control": settings.CACHE_CONTROL,
+                                 "Vary": "Accept, Accept-Encoding, Accept-Language"})
+    return response
+
+
+@app.middleware("http")
+async def compress_responses(request: Request, call_next):
+    """Compress the bodies of successful GET responses with the content coding negotiated from
+       the Accept-Encoding header, if they are at least settings.COMPRESSION_MIN_SIZE bytes (see
+       compression.py). The responses for the whole catalog and the lists of stamp attributes are
+       compressed once per catalog version, and then answered from the compressed_cache without
+       running the request handler. Other bodies are compressed for each request, and streamed
+       bodies one chunk at a time."""
+    encoding = compression.negotiated_encoding(request.headers.get("accept-encoding"))
+    if encoding is None or request.method != "GET":
+        return await call_next(request)
+    timings = metrics.Timings()
+    key = None
+    if is_compression_cached(request):
+        version = loaded_catalog_version(request.url.path)
+        # Conditional GETs are answered by conditional_get() with 304 Not Modified
+        if version is not None:
+            key = representation_etag(version, request)
+            if not etag_matches(key, request.headers.get("if-none-match")):
+                with timings.phase("cache"):
+                    cached = compressed_cache.get(key)
+                if cached is not None:
+                    body, headers = cached
+                    # Return server execution time in milliseconds, in total and per phase
+                    return Response(content=body,
+                                    headers={**headers, "Server-Timing": timings.header()})
+    response = await call_next(request)
+    if response.status_code != status.HTTP_200_OK or "content-encoding" in response.headers or \
+            not compression.is_compressible(response.headers.get("content-type")):
+        return response
+    vary = response.headers.get("vary")
+    if vary is None or "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+    if "content-length" not in response.headers:
+        # A streamed body
+        compressor = compression.Compressor(encoding, compression.ON_THE_FLY_LEVELS[encoding])
+        response.body_iterator = compressed_chunks(response.body_iterator, compressor)
+        response.headers["Content-Encoding"] = encoding
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = {name: value for name, value in response.headers.items()
+               if name != "content-length"}
+    if len(body) >= settings.COMPRESSION_MIN_SIZE:
+        levels = compression.CACHED_LEVELS if key is not None else compression.ON_THE_FLY_LEVELS
+        with timings.phase("compress"):
+            body = await asyncio.to_thread(compression.compressed, body, encoding,
+                                           levels[encoding])
+        headers["content-encoding"] = encoding
+        if key is not None and headers.get("etag") == key:
+            compressed_cache.put(key, body, {name: value for name, value in headers.items()
+                                             if name != "server-timing"})
+        # Add the compression to the server execution time of the request handler
+        compress = f"compress;dur={timings.phases['compress']/1000000}"
+        timing = headers.get("server-timing")
+        headers["server-timing"] = f"{timing}, {compress}" if timing is not None else compress
+    return Response(content=body, status_code=response.status_code, headers=headers)
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """Record the duration of each request and of the phases its handler reports in the
+       Server-Timing header, the size and status of its response, and whether a conditional GET
+       was answered with 304 Not Modified. Also adds the duration of the whole request, including
+       the validation and serialization by FastAPI and the other middleware, to the Server-Timing
+       header as "total". Runs around all other middleware."""
+    tic = time.perf_counter_ns()
+    response = await call_next(request)
+    toc = time.perf_counter_ns()
+    route = request.scope.get("route")
+    if route is None:
+        # The request never reached the router, e.g. if answered with 304 Not Modified
+        route = next((r for r in app.routes if r.matches(request.scope)[0] == Match.FULL), None)
+    # The routes of the default catalog and of the named catalogs are recorded together
+    path = route.path.removeprefix(CATALOG_PREFIX) if route is not None else "unmatched"
+    timing = response.headers.get("server-timing")
+    if timing is not None:
+        for phase, duration in metrics.parsed_server_timing(timing):
+            request_durations.observe(duration/1000, path, phase)
+    request_durations.observe((toc - tic)/1000000000, path, "total")
+    request_counts.inc(path, request.method, str(response.status_code))
+    if "content-length" in response.headers:
+        response_sizes.observe(int(response.headers["content-length"]), path)
+    if "if-none-match" in request.headers or "if-modified-since" in request.headers:
+        revalidations.inc("hit" if response.status_code == status.HTTP_304_NOT_MODIFIED
+                          else "miss")
+    total = f"total;dur={(toc - tic)/1000000}"
+    response.headers["Server-Timing"] = f"{timing}, {total}" if timing is not None else total
+    return response
+
+
 @app.get("/", tags=["stamps"])
 def api_root_resource(request: Request, response: Response) -> ApiInfo:
     """The root resource. Returns the name of this API, its version, and an URL where the OpenAPI
        specification of this API can be found. The version number identifies the implementation
        version and not the interface version."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     result = {"name": "Faststamps Catalog API.",
               "version": settings.VERSION,
               "openapi_specification": str(request.url) + "docs",
               "health": str(request.url) + "health"}
-    toc = time.perf_counter_ns()
-    # Return total server xecution time in milliseconds (not including FastAPI itself)
-    response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
+    return result
+
+
+@app.get("/health", tags=["admin"])
+def get_health(response: Response) -> Health:
+    """Return the health of the API: the version of the loaded stamp catalog and statistics on
+       the catalog reloads."""
+    timings = metrics.Timings()
+    cat = catalog
+    if cat is None:
+        result = {"status": "no catalog", "catalog": None, "reloads": reloads}
+    else:
+        result = {"status": "ok",
+                  "catalog": {"version": cat.version,
+                              "source": cat.source,
+                              "stamps": cat.size,
+                              "loaded_at": cat.loaded_at,
+                              "load_time": cat.load_time},
+                  "reloads": reloads}
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
+    return result
+
+
+@app.post("/admin/reload", status_code=status.HTTP_202_ACCEPTED, tags=["admin"])
+async def post_reload(request: Request, response: Response,
+                      background_tasks: BackgroundTasks,
+                      wait: bool = Query(False,
+                                         description="""Wait until the catalog has been reloaded
+                                                        before responding."""),
+                      x_admin_token: Optional[str] = Header(None)) -> ReloadInfo | str:
+    """Reload the stamp catalog CSV file. The new catalog is loaded in the background and swapped
+       in when it is ready. Until then, requests are served from the current catalog, and
+       `/health`, which the Location header links to, shows the reload in progress. Requires the
+       admin token in the X-Admin-Token header."""
+    timings = metrics.Timings()
+    if not settings.ADMIN_TOKEN or x_admin_token is None or \
+            not hmac.compare_digest(x_admin_token, settings.ADMIN_TOKEN):
+        response.status_code = status.HTTP_403_FORBIDDEN
+        result = "Admin token missing or not valid."
+    elif reloads["in_progress"]:
+        response.status_code = status.HTTP_409_CONFLICT
+        result = "The catalog is already being reloaded."
+    elif wait:
+        with timings.phase("reload"):
+            await asyncio.to_thread(reload_catalog)
+        response.status_code = status.HTTP_200_OK
+        result = reloads
+    else:
+        # In progress from now on, so the response and /health say so, and another reload is
+        # refused until this one is done
+        reloads["in_progress"] = True
+        background_tasks.add_task(reload_catalog)
+        response.headers["Location"] = str(request.url_for("get_health"))
+        result = reloads
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
+    return result
+
+
+def collected_metrics():
+    """The metrics of the caches and catalogs of the API, collected when /metrics is requested."""
+    def cache_requests():
+        catalog_metrics = list(named_catalogs.metrics.values()) if named_catalogs else []
+        return {("image", "hit"): image_cache.hits,
+                ("image", "miss"): image_cache.misses,
+                ("compressed", "hit"): compressed_cache.hits,
+                ("compressed", "miss"): compressed_cache.misses,
+                ("catalog", "hit"): sum(m.hits for m in catalog_metrics),
+                ("catalog", "miss"): sum(m.loads for m in catalog_metrics)}
+
+    def catalog_memory():
+        names = list(named_catalogs.metrics) if named_catalogs else []
+        return {(name,): named_catalogs.memory(name) for name in names}
+
+    def catalog_values(attribute, scale=1):
+        catalog_metrics = dict(named_catalogs.metrics) if named_catalogs else {}
+        return {(name,): getattr(m, attribute) * scale for name, m in catalog_metrics.items()
+                if getattr(m, attribute) is not None}
+
+    return [metrics.Collected("counter", "faststamps_cache_requests_total",
+                              "Number of lookups in the image cache, the compressed response "
+                              "cache and the loaded catalogs, by whether they were hits or "
+                              "misses.",
+                              ("cache", "result"), cache_requests),
+            metrics.Collected("counter", "faststamps_catalog_loads_total",
+                              "Number of times each catalog has been loaded.",
+                              ("catalog",), lambda: catalog_values("loads")),
+            metrics.Collected("counter", "faststamps_catalog_evictions_total",
+                              "Number of times each catalog has been evicted from memory.",
+                              ("catalog",), lambda: catalog_values("evictions")),
+            metrics.Collected("gauge", "faststamps_catalog_load_seconds",
+                              "Duration of the last load of each catalog.",
+                              ("catalog",), lambda: catalog_values("last_load_time", 1/1000)),
+            metrics.Collected("gauge", "faststamps_catalog_memory_bytes",
+                              "Estimated memory used by each loaded catalog.",
+                              ("catalog",), catalog_memory),
+            metrics.Collected("counter", "faststamps_catalog_reloads_total",
+                              "Number of reloads of the default catalog, by whether they failed.",
+                              ("result",), lambda: {("ok",): reloads["count"],
+                                                    ("failed",): reloads["failed"]})]
+
+
+@app.get("/metrics", tags=["admin"], response_class=PlainTextResponse)
+def get_metrics():
+    """Return the metrics of the API in the Prometheus text format: the duration of the requests
+       per route, in total and per phase as reported in the Server-Timing header, the sizes of
+       the responses and of the stamp query results, the number of requests per status, the hits
+       and misses of the caches, and the load times and memory of the catalogs."""
+    body = metrics.exposition([request_durations, request_counts, response_sizes, result_sizes,
+                               revalidations] + collected_metrics())
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/catalogs", tags=["catalogs"])
+def get_catalogs(response: Response) -> CatalogList:
+    """Return the named stamp catalogs, whether they are loaded, and statistics on their loads,
+       hits and evictions. A catalog is loaded the first time it is requested, e.g. with
+       `/catalogs/{catalog_name}/stamps`, and unloaded when the catalogs use more memory than
+       `STAMP_CATALOGS_MEMORY_BUDGET`. The default catalog is always loaded."""
+    timings = metrics.Timings()
+    infos = []
+    for name in named_catalogs.names():
+        cat = named_catalogs.loaded(name)
+        catalog_metrics = named_catalogs.metrics.get(name, catalogs.CatalogMetrics())
+        infos.append({"name": name,
+                      "default": named_catalogs.pinned(name),
+                      "loaded": cat is not None,
+                      "version": cat.version if cat is not None else None,
+                      "stamps": cat.size if cat is not None else None,
+                      "memory": named_catalogs.memory(name),
+                      "loads": catalog_metrics.loads,
+                      "hits": catalog_metrics.hits,
+                      "evictions": catalog_metrics.evictions,
+                      "last_load_time": catalog_metrics.last_load_time})
+    result = {"count": len(infos),
+              "memory": named_catalogs.memory_usage(),
+              "memory_budget": named_catalogs.memory_budget,
+              "catalogs": infos}
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
     return result
 
 
 @app.get("/stamps", tags=["stamps"])
-def get_stamps(response: Response,
+@app.get(CATALOG_PREFIX + "/stamps", tags=["catalogs"],
+         openapi_extra=CATALOG_ROUTE_EXTRA)
+def get_stamps(request: Request, response: Response,
+               cat: database.Catalog = Depends(requested_catalog),
                title: Optional[str] = Query(None,
                                             description="""Return stamps that have the given
                                             `title`."""),
                issued: Optional[str] = Query(None,
                                              description="""Return stamps that were 'issued' in
                                                             that year. `issued` can be a comma-
-                                                            separated list of years."""),
+                                                            separated list of years and ranges
+                                                            of years, e.g. '1931..1940', '1990..'
+                                                            or '..1870'."""),
                color: Optional[str] = Query(None,
                                             description="""Return stamps with the given `color`.
                                                            `color` can be a comma-separated list
@@ -197,6 +1023,24 @@ def get_stamps(response: Response,
                                                                 be a comma-separated list of
                                                                 values.""",
                                                  alias="stamp-type"),
+               variants: bool = Query(True,
+                                      description="""Also return the variant stamps. With
+                                                     `variants=false` only the stamps that are
+                                                     not variants of another stamp are
+                                                     returned."""),
+               search: Optional[str] = Query(None,
+                                             description="""Return the stamps whose titles or
+                                                            description contain all the words in
+                                                            `search`, best match first. Case and
+                                                            accents are ignored, and a word ending
+                                                            with a star '*' matches all words
+                                                            beginning with it."""),
+               sort: Optional[str] = Query(None,
+                                           description="""Return the stamps sorted on `sort`,
+                                                          which is 'yt_no' (stamp type, Yvert-
+                                                          Tellier number and variant), 'issued' or
+                                                          'title'. Prefix it with '-' to sort in
+                                                          descending order, e.g. '-issued'."""),
                start: Optional[int] = Query(None,
                                             description="""Return the stamps beginning with stamp
                                                            at `start` position in the list of
@@ -207,18 +1051,58 @@ def get_stamps(response: Response,
                                                            the list of stamps. If not given,
                                                            `count` is implicitly 'all'. Must
                                                            be >= 1."""),
+               total: bool = Query(False,
+                                   description="""Also return the `total` number of stamps
+                                                  matching the query, whatever `start`, `count` or
+                                                  `cursor`. With `variants=false`, also return the
+                                                  number of variant stamps left out of it, as
+                                                  `variants_total`."""),
+               cursor: Optional[str] = Query(None,
+                                             description="""Return the page of `count` stamps
+                                                            following the previous page. The
+                                                            cursor of the next page is in the
+                                                            'next' link of the Link header of a
+                                                            response with `count` and without
+                                                            `start`."""),
+               fields: Optional[str] = Query(None,
+                                             description="""Return the stamps with only the
+                                                            given `fields`, a comma-separated list
+                                                            of Stamp fields, e.g. 'id,title_en'.
+                                                            Use e.g. 'id.yt_no' for a single field
+                                                            of the stamp id."""),
+               stream: bool = Query(False,
+                                    description="""Stream the stamps in chunks as they are
+                                                   encoded, instead of building the whole response
+                                                   before sending it."""),
+               accept: Optional[str] = Header(None),
                accept_language: Optional[str] = Header(None)) \
                -> StampList | None:
     """Return the catalog of stamps. If no query parameter is specified all stamps in the
        catalog are returned. All query parameters can be combined.
 
-NOTE: THIS VERSION IS DONE WITH PYDANTIC CLASSES.
-
 The query parameters `title`, `year`, `color`, `value` and `stamp_type` can be used to filter
 which stamps to return from the catalog.
 
+The query parameter `search` searches the English and French titles and the French description of
+the stamps for words, and returns the matching stamps ranked by relevance instead of in catalog
+order. It can be combined with the other filters.
+
+The query parameter `sort` sorts the, possibly filtered, stamps. Numbers are sorted numerically,
+and case and accents are ignored. Stamps that sort equal are in catalog order, or best match first
+with `search`.
+
 The query parameters `start`and `count` control which and how many number of the, possibly
-filtered, stamps in the catalog to return.
+filtered, stamps in the catalog to return. With `total=true` the response also has the total
+number of stamps matching the query, e.g. to show the number of pages.
+
+To page through the stamps, use `count` without `start`. The response has a Link header with a
+'next' link to the next page, which has a `cursor` query parameter, until there are no more
+stamps. A cursor resumes the listing right after the previous page, so every page costs the same.
+If the catalog changes while paging, the cursor expires and 410 Gone is returned.
+
+The query parameter `fields` limits the stamps to the given fields, in the order of the Stamp
+model. The other fields are never read nor encoded, so list views that only show a few fields get
+much smaller responses, faster.
 
 Examples:
 
@@ -227,74 +1111,166 @@ Examples:
 * Accept-language to denote the language of the title. 'en' (English) and 'fr' (French) are
 * supported If none is specified, or if the language is none of the supported, English is assumed.
 * `/stamps?issued=1931,1932,1933` will return all stamps issued in 1931, 1932 or 1933.
+* `/stamps?issued=1931..1940` will return all stamps issued from 1931 to 1940, inclusive.
+* `/stamps?issued=..1870,1990..` will return all stamps issued until 1870 or from 1990.
 * `/stamps?color=Green,Olive` will return all stamps that are colored "Green" or "Olive".
 * `/stamps?value=1 French centime` will return all stamps with the printed value of "1 French
 centime".
 * `/stamps?stamp_type=timbre` will return all stamps of typ "timbre".
+* `/stamps?search=ceres 1849` will return all stamps with the words "Cérès" (or "ceres") and
+"1849" in their titles or description, best match first.
+* `/stamps?search=mari*` will return all stamps with words beginning with "mari", e.g. "Marianne".
+* `/stamps?sort=-issued` will return all stamps, the most recently issued first.
+* `/stamps?sort=yt_no&count=100` will return the first 100 stamps in Yvert-Tellier number order.
 * `/stamps?start=1000` will return all stamps beginning with the 1000:th stamp.
 * `/stamps?count=100` will return a maximum of 100 stamps.
+* `/stamps?count=100&cursor=...` will return the 100 stamps following the previous page.
+* `/stamps?fields=id,title_en,image` will return the id, English title and image of all stamps.
+* `/stamps?fields=id.yt_no,issued` will return the Yvert-Tellier number and year of all stamps.
+* `/stamps?variants=false` will return all stamps that are not variants.
+* `/stamps?variants=false&start=6&count=5&total=true` will return the second page of 5 stamps
+that are not variants, the total number of stamps that are not variants, and the number of
+variants.
+* `/stamps?stream=true` will stream all stamps in chunks.
+
+If the HTTP header Accept is 'application/x-ndjson' the stamps are streamed as newline delimited
+JSON, with one stamp per line.
     """
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     language = parsed_accept_language(accept_language)[0][0]
     if start is not None and start <= 0:
         response.status_code = status.HTTP_400_BAD_REQUEST
         response.body = "Query parameter 'start' must be >= 1."
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
         return None
     if count is not None and count <= 0:
         response.status_code = status.HTTP_400_BAD_REQUEST
         response.body = "Query parameter 'count' must be >= 1."
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
         return None
-    # We apply successive filters on the pandas dataFrame `db`
-    stamps = db
-    if title is not None:
-        if language[0:2] == "fr":
-            stamps = stamps[stamps["title_fr"] == title]
-        else:
-            stamps = stamps[stamps["title_en"] == title]
-    if issued is not None:
-        issued_years = [item for item in issued.split(',')]
-        stamps = stamps[stamps["issued"].isin(issued_years)]
-    if color is not None:
-        colors = color.split(',')
-        if language[0:2] == "fr":
-            stamps = stamps[stamps["color_fr"].isin(colors)]
-        else:
-            stamps = stamps[stamps["color_en"].isin(colors)]
-    if value is not None:
-        if language[0:2] == "fr":
-            stamps = stamps[stamps["value_fr"] == value]
-        else:
-            stamps = stamps[stamps["value_en"] == value]
-    if stamp_type is not None:
-        types = stamp_type.split(',')
-        stamps = stamps[stamps["type_fr"].isin(types)]
-    if start is not None:
+    stamp_sort = parsed_sort(sort, language)
+    if sort is not None and stamp_sort is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        response.body = f"Query parameter 'sort' must be one of {', '.join(SORT_PARAMETERS)}, " \
+                        f"optionally prefixed with '-'."
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
+        return None
+    issued_ranges = parsed_ranges(issued) if issued is not None else None
+    if issued is not None and issued_ranges is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        response.body = "Query parameter 'issued' must be years or ranges of years, e.g. " \
+                        "'1931..1940'."
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
+        return None
+    stamp_fields = projected_fields(fields) if fields is not None else None
+    if fields is not None and stamp_fields is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        response.body = "Query parameter 'fields' must be a comma-separated list of the fields " \
+                        "of a stamp, e.g. 'id,title_en' or 'id.yt_no'."
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
+        return None
+    named_filters = stamp_filters(language, title, issued_ranges, color, value, stamp_type,
+                                  variants)
+    filters = list(named_filters.values())
+    # A search without words is no search
+    searching = search is not None and len(database.search_terms(search)) > 0
+    # `start` is only used together with `count`
+    if start is not None and count is not None:
         i = start - 1
     else:
         i = 0
-    if count is not None:
-        stamps = stamps[i:i+count]
-
-    # Convert all items in stamps to dicts that can be validated as Stamp model objects.
-    apistamps = stamps.to_dict(orient='records')
-    for d in apistamps:
-        convert_db_stamp_to_api_stamp(d)
-    result = {"count": len(apistamps),
-              "stamps": apistamps}
-    toc = time.perf_counter_ns()
-    # Return total server xecution time in milliseconds (not including FastAPI itself)
-    response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
-    return result
+
+    ndjson = accept is not None and "application/x-ndjson" in accept
+    query = cursor_query(filters, stamp_sort, search if searching else None)
+    after = None
+    if cursor is not None:
+        decoded = decoded_cursor(cursor)
+        if count is None or start is not None or stream or ndjson:
+            error = (status.HTTP_400_BAD_REQUEST,
+                     "Query parameter 'cursor' requires 'count' and can't be combined with "
+                     "'start' or streaming.")
+        elif decoded is None or decoded[1] != query:
+            error = (status.HTTP_400_BAD_REQUEST,
+                     "Query parameter 'cursor' is not a cursor for this query.")
+        elif not cursor_fits(decoded[2], searching, stamp_sort):
+            error = (status.HTTP_400_BAD_REQUEST, "Invalid cursor.")
+        elif decoded[0] != cat.version:
+            error = (status.HTTP_410_GONE,
+                     "The catalog has changed since the cursor was issued. Start over without "
+                     "'cursor'.")
+        else:
+            error = None
+            after = decoded[2]
+        if error is not None:
+            response.status_code, response.body = error
+            # Return server execution time in milliseconds, in total and per phase
+            response.headers["Server-Timing"] = timings.header()
+            return None
+    if stream or ndjson:
+        # Streamed stamps are read and encoded by the storage engine one chunk at a time, so only
+        # one chunk is ever held in memory.
+        text = search if searching else None
+        with timings.phase("query"):
+            streamed, chunks = cat.store.stream(filters, text, i, count, stamp_sort, stamp_fields,
+                                                settings.STREAM_CHUNK_SIZE)
+            matching, variants_total = query_totals(cat.store, named_filters, text, total)
+        result_sizes.observe(streamed, "/stamps")
+        if ndjson:
+            body = ndjson_stamps(chunks)
+            media_type = "application/x-ndjson"
+        else:
+            body = json_stamp_list(streamed, chunks, matching, variants_total)
+            media_type = "application/json"
+        # Return server execution time in milliseconds until the stream starts, also per phase
+        return StreamingResponse(body, media_type=media_type,
+                                 headers={"Server-Timing": timings.header()})
+
+    # The storage engine returns the stamps already encoded as JSON, so we just join them into a
+    # StampList JSON document.
+    headers = {}
+    # The storage engine queries, sorts and encodes the stamps in one go
+    with timings.phase("store"):
+        if count is not None and start is None:
+            # Paging with cursors. A search has to rank all matching stamps anyway, so its cursor
+            # just holds the number of stamps already returned. Other cursors hold the sort key of
+            # the last stamp returned, so the next page resumes right after it.
+            if searching:
+                offset = after or 0
+                stamps = cat.store.search(search, filters, offset, count + 1, stamp_sort,
+                                          stamp_fields)
+                last = offset + count if len(stamps) > count else None
+                stamps = stamps[:count]
+            else:
+                stamps, last = cat.store.page(filters, count, stamp_sort, after, stamp_fields)
+            if last is not None:
+                next_url = request.url.include_query_params(
+                        cursor=encoded_cursor(cat.version, query, last))
+                headers["Link"] = f'<{next_url}>; rel="next"'
+        elif searching:
+            stamps = cat.store.search(search, filters, i, count, stamp_sort, stamp_fields)
+        else:
+            stamps = cat.store.stamps(filters, i, count, stamp_sort, stamp_fields)
+        matching, variants_total = query_totals(cat.store, named_filters,
+                                                search if searching else None, total)
+    with timings.phase("body"):
+        body = b"".join([stamp_list_head(len(stamps), matching, variants_total),
+                         b",".join(stamps), b"]}"])
+    result_sizes.observe(len(stamps), "/stamps")
+    # Return server execution time in milliseconds, in total and per phase
+    headers["Server-Timing"] = timings.header()
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.get("/stamps/{stamp_id}", status_code=status.HTTP_200_OK, tags=["stamps"])
+@app.get(CATALOG_PREFIX + "/stamps/{stamp_id}", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
 def get_stamp(response: Response,
+              cat: database.Catalog = Depends(requested_catalog),
               stamp_id: str = Path(description="""`stamp_id` is the unique id of the stamp in the
                                                   format T-N-V or T-N, where T is type, N is the
                                                   Yvert-Tellier catalog number and V is the
@@ -304,113 +1280,126 @@ def get_stamp(response: Response,
                                                   '/stamps/Pour la poste Aérienne-65'""")) \
               -> StampWithVariants | None:
     """Return the stamp with the given `stamp_id`."""
-    global indexed_db
-    tic = time.perf_counter_ns()
-    # First we check that we have a valid stamp_id
-    items = stamp_id.split("-")
-    if len(items) < 2 or len(items) > 3:
+    timings = metrics.Timings()
+    # First we check that we have a valid stamp_id, and then we look up the stamp and its
+    # variants, which are already encoded as JSON
+    with timings.phase("lookup"):
+        key = parsed_stamp_id(stamp_id)
+        entry = cat.store.stamp(key) if key is not None else None
+    if entry is None:
         response.status_code = status.HTTP_404_NOT_FOUND
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
         return None
-    elif len(items) == 2:
-        yt_type, yt_no = items
-        yt_variant = ""
-    else:  # len(items) == 3:
-        yt_type, yt_no, yt_variant = items
-    # Now we look up the stamp
-    try:
-        # Get the stamp
-        stamp = indexed_db.loc[(yt_type, yt_no, yt_variant)]
-        d = stamp.to_dict()
-        # Add the stamp id attributes to the stamp
-        d["id"] = {"yt_no": yt_no,
-                   "yt_variant": yt_variant,
-                   "type": yt_type}
-        # Add the URL to the stamp
-        d["url"] = f"stamps/{stamp_id}"
-        # Get all variants of the stamp
-        df = indexed_db.loc[(yt_type, yt_no)]
-        variants = df.to_dict('index')
-        if len(variants) == 1:
-            d["variants"] = None
-        else:
-            d["variants"] = variants
-            # Add the stamp id attributes to all the stamp variants
-            for var, varstamp in variants.items():
-                if var == " ":
-                    varstamp["id"] = {"yt_no": yt_no,
-                                      "yt_variant": "",
-                                      "type": yt_type}
-                else:
-                    varstamp["id"] = {"yt_no": yt_no,
-                                      "yt_variant": var,
-                                      "type": yt_type}
-        result = StampWithVariants.model_validate(d)
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
-        return result
+    with timings.phase("encode"):
+        body = stamp_with_variants_json(entry)
+    # Return server execution time in milliseconds, in total and per phase
+    return Response(content=body, media_type="application/json",
+                    headers={"Server-Timing": timings.header()})
 
-    except KeyError:
-        response.status_code = status.HTTP_404_NOT_FOUND
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
-        return None
+
+@app.post("/stamps/batch", status_code=status.HTTP_200_OK, tags=["stamps"])
+@app.post(CATALOG_PREFIX + "/stamps/batch", status_code=status.HTTP_200_OK,
+          tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
+def get_stamp_batch(response: Response,
+                    batch: StampIdList,
+                    cat: database.Catalog = Depends(requested_catalog)) -> StampBatch | str:
+    """Return the stamps with the given `ids`, in the same order, together with the ids of the
+       stamps that were not found. The ids have the same format as in `/stamps/{stamp_id}`. At
+       most `MAX_BATCH_SIZE` ids can be given.
+
+Example request body:
+
+    {"ids": ["Poste-1", "Poste-1-a", "Pour la poste Aérienne-65"]}
+    """
+    timings = metrics.Timings()
+    if len(batch.ids) > settings.MAX_BATCH_SIZE:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
+        return f"At most {settings.MAX_BATCH_SIZE} ids can be given."
+    store = cat.store
+    stamps = []
+    missing = []
+    with timings.phase("lookup"):
+        for stamp_id in batch.ids:
+            key = parsed_stamp_id(stamp_id)
+            entry = store.stamp(key) if key is not None else None
+            if entry is None:
+                missing.append(stamp_id)
+            else:
+                stamps.append(stamp_with_variants_json(entry))
+    with timings.phase("body"):
+        body = b"".join([b'{"count":', str(len(stamps)).encode(), b',"stamps":[',
+                         b",".join(stamps), b'],"missing":', database.json_encode(missing).encode(),
+                         b"}"])
+    result_sizes.observe(len(stamps), "/stamps/batch")
+    # Return server execution time in milliseconds, in total and per phase
+    return Response(content=body, media_type="application/json",
+                    headers={"Server-Timing": timings.header()})
 
 
 @app.get("/stamps/{stamp_id}/image", status_code=status.HTTP_200_OK, tags=["stamps"])
-def get_stamp_image(response: Response, stamp_id: str = Path(description="""`stamp_id` is a unique
-                                                                            id of the stamp in the
-                                                                            format T-N-V, where T is
-                                                                            type, N is the Yvert-
-                                                                            Tellier catalog
-                                                                            number. Note that it may
-                                                                            contain whitespaces.
-                                                                            E.g. '/stamps/Pour la
-                                                                            poste Aérienne-65'""")):
+@app.get(CATALOG_PREFIX + "/stamps/{stamp_id}/image", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
+def get_stamp_image(response: Response,
+                    cat: database.Catalog = Depends(requested_catalog),
+                    stamp_id: str = Path(description="""`stamp_id` is a unique id of the stamp
+                                                        in the format T-N-V, where T is type, N is
+                                                        the Yvert-Tellier catalog number. Note
+                                                        that it may contain whitespaces. E.g.
+                                                        '/stamps/Pour la poste Aérienne-65'"""),
+                    size: Literal["thumbnail", "medium", "large"] = Query(
+                        "large",
+                        description="""The size of the image. 'thumbnail' and 'medium' are
+                                       smaller renditions of the 'large' image."""),
+                    if_none_match: Optional[str] = Header(None),
+                    if_modified_since: Optional[str] = Header(None)):
     """Return the image of the stamp with the given `stamp_id`."""
-    global indexed_db
-    tic = time.perf_counter_ns()
-    if os.path.exists(settings.STAMP_CATALOG_IMAGES_DIR):
-        # First we check that we have a valid stamp_id
-        items = stamp_id.split("-")
-        if len(items) < 2 or len(items) > 3:
-            response.status_code = status.HTTP_404_NOT_FOUND
-            toc = time.perf_counter_ns()
-            # Return total server xecution time in milliseconds (not including FastAPI itself)
-            response.headers["Server-timing"] = f"API;dur={(toc - tic)/1000000}"
-            return None
-        elif len(items) == 2:
-            yt_type, yt_no = items
-            yt_variant = ""
-        else:  # len(items) == 3:
-            yt_type, yt_no, yt_variant = items
-        # Now we look up the stamp
+    timings = metrics.Timings()
+    # First we check that we have a valid stamp_id, then we look up the stamp's image, first in
+    # the image cache
+    key = parsed_stamp_id(stamp_id)
+    image_file = (cat.store.image(key) if key is not None else None) or ""
+    image = image_cache.get((image_file, size))
+    if image is None and image_file:
+        with timings.phase("read"):
+            try:
+                image = images.read_image(settings.STAMP_CATALOG_IMAGES_DIR,
+                                          settings.STAMP_CATALOG_RENDITIONS_DIR, image_file, size)
+                image_cache.put((image_file, size), image)
+            except OSError:
+                image = None
+    if image is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
+        return None
+    headers = {"ETag": image.etag,
+               "Last-Modified": image.last_modified,
+               "Cache-Control": "public, max-age=31536000, immutable"}
+    if if_none_match is not None:
+        not_modified = etag_matches(image.etag, if_none_match)
+    elif if_modified_since is not None:
         try:
-            # Get the stamp
-            stamp = indexed_db.loc[(yt_type, yt_no, yt_variant)]
-            d = stamp.to_dict()
-            image_path = (os.path.join(settings.STAMP_CATALOG_IMAGES_DIR, d["image"]))
-            toc = time.perf_counter_ns()
-            # Return total server xecution time in milliseconds (not including FastAPI itself)
-            msecs = f"API;dur={(toc-tic)/1000000}"
-            return FileResponse(image_path,
-                                media_type="image/jpeg",
-                                headers={"Server-timing": msecs})
-
-        except KeyError:
-            response.status_code = status.HTTP_404_NOT_FOUND
-            toc = time.perf_counter_ns()
-            # Return total server xecution time in milliseconds (not including FastAPI itself)
-            response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
-            return None
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            not_modified = int(image.mtime) <= since
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    # Return server execution time in milliseconds, in total and per phase
+    headers["Server-Timing"] = timings.header()
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=image.data, media_type="image/jpeg", headers=headers)
 
 
 @app.get("/stamp_titles", status_code=status.HTTP_200_OK, tags=["stamp attributes"])
+@app.get(CATALOG_PREFIX + "/stamp_titles", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
 def get_stamp_titles(response: Response,
+                     cat: database.Catalog = Depends(requested_catalog),
                      q: Optional[str] = Query(None,
                                               description="""Query string for stamp titles."""),
                      start: Optional[int] = Query(None,
@@ -425,105 +1414,160 @@ def get_stamp_titles(response: Response,
                                                                  given, `count` is implicitly 'all'.
                                                                  Must be >= 1."""),
                      accept_language: Optional[str] = Header(None)) -> StringValuesList | str:
-    """Return all stamp titles matching the query string `q`."""
-    tic = time.perf_counter_ns()
+    """Return all stamp titles matching the query string `q`. `q` may contain one wildcard star
+       '*', e.g. 'Mari*', '*anne' or 'M*ne', or a star at both ends, e.g. '*ari*'."""
+    timings = metrics.Timings()
     language = parsed_accept_language(accept_language)[0][0]
-    stamps = db
-    if language[0:2] == "fr":
-        titles_lang = stamps['title_fr']
-        response.headers["Content-Language"] = "fr"
-    else:
-        titles_lang = stamps['title_en']
-        response.headers["Content-Language"] = "en"
-    # We assume only one star '*' in q
-    if q is None or q == "*":
-        titles = titles_lang.unique().tolist()
+    lang = "fr" if language[0:2] == "fr" else "en"
+    response.headers["Content-Language"] = lang
+    # We assume only one star '*' in q, or a star at both ends of q
+    if q == "" or q == "*":
+        # All titles
+        q = None
+    if q is not None:
+        infix = len(q) > 2 and q[0] == "*" and q[-1] == "*" and q.count('*') == 2
+        if q.count('*') > 1 and not infix:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            # Return server execution time in milliseconds, in total and per phase
+            response.headers["Server-Timing"] = timings.header()
+            return "Multiple wildcard stars '*' in query is not supported."
+    with timings.phase("query"):
+        titles = cat.store.titles(lang, q)
+    with timings.phase("encode"):
         result = {"count": len(titles),
-                  "values": sorted(titles)}
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
-        return result
-    if q.count('*') > 1:
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        toc = time.perf_counter_ns()
-        # Return total server xecution time in milliseconds (not including FastAPI itself)
-        response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
-        return "Multiple wildcard stars '*' in query is not supported."
-    # titles = pd.Series(db['title'].unique())
-    prefix = q[-1] == "*"
-    suffix = q[0] == "*"
-    if prefix and suffix:
-        titles = titles_lang[titles_lang.str.contains(q[1:-1], na=False)].unique().tolist()
-    elif prefix:
-        titles = titles_lang[titles_lang.str.startswith(q[0:-1], na=False)].unique().tolist()
-    elif suffix:
-        titles = titles_lang[titles_lang.str.endswith(q[1:], na=False)].unique().tolist()
-    else:
-        starpos = q.find('*')
-        titles = titles_lang[titles_lang.str.startswith(q[0:starpos], na=False)]
-        titles = titles[titles.str.endswith(q[starpos+1:], na=False)].unique().tolist()
-    result = {"count": len(titles),
-              "values": titles}
-    toc = time.perf_counter_ns()
-    # Return total server xecution time in milliseconds (not including FastAPI itself)
-    response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
+                  "values": titles}
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
     return result
 
 
 @app.get("/stamp_years", status_code=status.HTTP_200_OK, tags=["stamp attributes"])
-def get_stamp_years(response: Response):
+@app.get(CATALOG_PREFIX + "/stamp_years", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
+def get_stamp_years(response: Response,
+                    cat: database.Catalog = Depends(requested_catalog),
+                    counts: bool = Query(False,
+                                         description="""Also return the number of stamps issued
+                                                        each year.""")) \
+                    -> ValueCountsList | StringValuesList:
     """Return all the years that stamps in the catalog have been issued."""
-    tic = time.perf_counter_ns()
-    stamps = db
-    years = stamps['issued'].unique().tolist()
-    result = {"count": len(years),
-              "values": sorted(years)}
-    toc = time.perf_counter_ns()
-    # Return total server xecution time in milliseconds (not including FastAPI itself)
-    response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
+    timings = metrics.Timings()
+    result = values_list(cat.store, "issued", counts, timings)
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
     return result
 
 
 @app.get("/stamp_colors", status_code=status.HTTP_200_OK, tags=["stamp attributes"])
+@app.get(CATALOG_PREFIX + "/stamp_colors", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
 def get_stamp_colors(response: Response,
-                     accept_language: Optional[str] = Header(None)):
+                     cat: database.Catalog = Depends(requested_catalog),
+                     counts: bool = Query(False,
+                                          description="""Also return the number of stamps with
+                                                         each color."""),
+                     accept_language: Optional[str] = Header(None)) \
+                     -> ValueCountsList | StringValuesList:
     """Return all the colors that stamps in the catalog can have."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     language = parsed_accept_language(accept_language)[0][0]
-    stamps = db
     if language[0:2] == "fr":
-        colors_lang = stamps['color_fr']
+        result = values_list(cat.store, "color_fr", counts, timings)
         response.headers["Content-Language"] = "fr"
     else:
-        colors_lang = stamps['color_en']
+        result = values_list(cat.store, "color_en", counts, timings)
         response.headers["Content-Language"] = "en"
-    colors_lang = colors_lang.unique().tolist()
-    result = {"count": len(colors_lang),
-              "values": sorted(colors_lang)}
-    toc = time.perf_counter_ns()
-    # Return total server xecution time in milliseconds (not including FastAPI itself)
-    response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
     return result
 
 
 @app.get("/stamp_values", status_code=status.HTTP_200_OK, tags=["stamp attributes"])
+@app.get(CATALOG_PREFIX + "/stamp_values", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
 def get_stamp_values(response: Response,
-                     accept_language: Optional[str] = Header(None)):
+                     cat: database.Catalog = Depends(requested_catalog),
+                     counts: bool = Query(False,
+                                          description="""Also return the number of stamps with
+                                                         each printed value."""),
+                     accept_language: Optional[str] = Header(None)) \
+                     -> ValueCountsList | StringValuesList:
     """Return all the printed values that stamps in the catalog can have."""
-    tic = time.perf_counter_ns()
+    timings = metrics.Timings()
     language = parsed_accept_language(accept_language)[0][0]
-    stamps = db
     if language[0:2] == "fr":
-        values_lang = stamps['value_fr']
+        result = values_list(cat.store, "value_fr", counts, timings)
         response.headers["Content-Language"] = "fr"
     else:
-        values_lang = stamps['value_en']
+        result = values_list(cat.store, "value_en", counts, timings)
         response.headers["Content-Language"] = "en"
-    values_lang = values_lang.unique().tolist()
-    result = {"count": len(values_lang),
-              "values": sorted(values_lang)}
-    toc = time.perf_counter_ns()
-    # Return total server xecution time in milliseconds (not including FastAPI itself)
-    response.headers["Server-Timing"] = f"API;dur={(toc - tic)/1000000}"
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
+    return result
+
+
+@app.get("/stamp_facets", status_code=status.HTTP_200_OK, tags=["stamp attributes"])
+@app.get(CATALOG_PREFIX + "/stamp_facets", status_code=status.HTTP_200_OK,
+         tags=["catalogs"], openapi_extra=CATALOG_ROUTE_EXTRA)
+def get_stamp_facets(response: Response,
+                     cat: database.Catalog = Depends(requested_catalog),
+                     title: Optional[str] = Query(None,
+                                                  description="""Count stamps that have the given
+                                                                 `title`."""),
+                     issued: Optional[str] = Query(None,
+                                                   description="""Count stamps that were 'issued'
+                                                                  in that year. `issued` can be a
+                                                                  comma-separated list of years
+                                                                  and ranges of years, e.g.
+                                                                  '1931..1940'."""),
+                     color: Optional[str] = Query(None,
+                                                  description="""Count stamps with the given
+                                                                 `color`. `color` can be a comma-
+                                                                 separated list of colors."""),
+                     value: Optional[str] = Query(None,
+                                                  description="""Count stamps with the given
+                                                                 printed `value`. `value` can be a
+                                                                 comma-separated list of
+                                                                 values."""),
+                     stamp_type: Optional[str] = Query(None,
+                                                       description="""Count stamps of the given
+                                                                      `stamp_type`. `stamp_type`
+                                                                      can be a comma-separated
+                                                                      list of values.""",
+                                                       alias="stamp-type"),
+                     accept_language: Optional[str] = Header(None)) -> StampFacets | str:
+    """Return the number of stamps matching the filters, which are the same as for `/stamps`, and
+       for each of the stamp attributes (facets) `issued`, `color`, `value` and `stamp-type`, the
+       values the matching stamps have and the number of stamps with each value.
+
+The counts of a facet take all filters into account except the filter on the facet itself. E.g.
+`/stamp_facets?issued=1931&color=Green` returns the colors of the stamps issued in 1931 and the
+years in which green stamps were issued. This is what a filter UI needs to show the alternatives
+for each filter."""
+    timings = metrics.Timings()
+    language = parsed_accept_language(accept_language)[0][0]
+    lang = "fr" if language[0:2] == "fr" else "en"
+    response.headers["Content-Language"] = lang
+    issued_ranges = parsed_ranges(issued) if issued is not None else None
+    if issued is not None and issued_ranges is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        # Return server execution time in milliseconds, in total and per phase
+        response.headers["Server-Timing"] = timings.header()
+        return "Query parameter 'issued' must be years or ranges of years, e.g. '1931..1940'."
+    filters = stamp_filters(language, title, issued_ranges, color, value, stamp_type)
+    with timings.phase("query"):
+        count = cat.store.total(list(filters.values()))
+    facets = {}
+    for name, column in [("issued", "issued"),
+                         ("color", f"color_{lang}"),
+                         ("value", f"value_{lang}"),
+                         ("stamp-type", "type_fr")]:
+        # Leave out the facet's own filter
+        other_filters = [f for other, f in filters.items() if other != name]
+        with timings.phase("count"):
+            values, counts = cat.store.values(column, other_filters)
+        facets[name] = {"values": values, "counts": counts}
+    result = {"count": count, "facets": facets}
+    # Return server execution time in milliseconds, in total and per phase
+    response.headers["Server-Timing"] = timings.header()
     return result
@@ -0,0 +1,584 @@
+# This module contains the storage engines of the Faststamps Catalog API. A storage engine answers
+# the stamp queries of the API: listing and filtering stamps, getting a stamp with its variants or
+# its image, listing and counting the values of a stamp attribute, querying the titles, and
+# searching the titles and descriptions of the stamps. There are two engines:
+#
+# * "pandas" answers the queries from the catalog in memory (see database.py).
+# * "sqlite" answers them from an SQLite database file next to the catalog CSV file, e.g.
+#   `data/french-stamps.sqlite`, with an index on each filter column and an FTS5 table over the
+#   titles and descriptions. The database file is built from the catalog when it is missing or
+#   was built from another version of the catalog. Otherwise the catalog isn't read into memory
+#   at all, see load_sqlite().
+#
+# Both engines return the stamps as UTF-8 encoded Stamp JSON objects, so the API can build its
+# responses without converting them.
+
+import abc
+import datetime
+import os
+import os.path
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import database
+
+ENGINES = ["pandas", "sqlite"]
+# Bump this whenever the schema of the SQLite database changes. Databases with another format
+# version are rebuilt.
+SQLITE_FORMAT_VERSION = 4
+# The columns stored in the SQLite database, besides the position and JSON encoding of each stamp
+SQLITE_COLUMNS = database.ID_COLUMNS + \
+    [column for column in database.FILTER_COLUMNS if column not in database.ID_COLUMNS] + \
+    ["description_fr", "image"]
+# The rank of each stamp in each sort order is stored in the column "sort_{key}"
+SORT_COLUMNS = [f"sort_{key}" for key in database.SORT_KEYS]
+# The number in each of the database.RANGE_COLUMNS is stored in the column "{column}_number"
+NUMBER_COLUMNS = [f"{column}_number" for column in database.RANGE_COLUMNS]
+# The columns searched by StampStore.search(), and their weights
+SEARCH_COLUMNS = list(database.TEXT_COLUMNS)
+
+
+class StampStore(abc.ABC):
+    """The interface of the storage engines. `filters` is a list of (column, values) tuples as
+       expected by database.Catalog.query(). `sort` is None or a (key, descending) tuple, where
+       key is one of database.SORT_KEYS. A stamp id `key` is a (type, Yvert-Tellier number,
+       variant) tuple. `fields` is None for stamps with all their fields, or the fields to encode,
+       a subset of the fields the engine was opened with (see
+       database.Catalog.build_json_fragments()) in the same order. Only those fields are read."""
+
+    name = None
+
+    @abc.abstractmethod
+    def stamps(self, filters, start=0, count=None, sort=None, fields=None):
+        """The stamps matching all `filters`, in `sort` order or else catalog order, as a list of
+           UTF-8 encoded Stamp JSON objects. Returns at most `count` stamps (all if None),
+           beginning with the stamp at the 0-based position `start` of the matching stamps."""
+
+    @abc.abstractmethod
+    def page(self, filters, count, sort=None, after=None, fields=None):
+        """A page of at most `count` of the stamps matching all `filters`, in `sort` order or
+           else catalog order, beginning after the stamp with the sort key `after` (see
+           database.Catalog.sort_key()), or with the first stamp if None. Returns a (stamps,
+           last) tuple of the stamps as UTF-8 encoded Stamp JSON objects and the sort key of the
+           last stamp, or None if there are no more stamps. Unlike stamps() with `start`, it costs
+           the same for every page."""
+
+    @abc.abstractmethod
+    def stamp(self, key):
+        """The stamp `key` as a (stamp, variants) tuple as in database.Catalog.build_registry(),
+           or None if there is no such stamp."""
+
+    @abc.abstractmethod
+    def image(self, key):
+        """The file name of the image of the stamp `key`, or None if there is no such stamp. The
+           file name is empty if the stamp has no image."""
+
+    @abc.abstractmethod
+    def titles(self, language, q=None):
+        """The distinct stamp titles in `language` ("en" or "fr") matching the title query `q`
+           (see database.TitleIndex.query()), in the order they first occur in the catalog. If
+           `q` is None, all titles are returned, sorted."""
+
+    @abc.abstractmethod
+    def values(self, column, filters=None):
+        """The sorted distinct values of `column` and the number of stamps with each value, as a
+           (values, counts) tuple of lists. If `filters` are given, only the stamps matching all
+           of them are counted, and the values none of them has are left out."""
+
+    @abc.abstractmethod
+    def search(self, text, filters, start=0, count=None, sort=None, fields=None):
+        """The stamps whose titles or description contain all the words in `text` and that match
+           all `filters`, in `sort` order or else best match first, as a list of UTF-8 encoded
+           Stamp JSON objects. The words are matched ignoring case and accents, and a word ending
+           with a star '*' matches all words beginning with it. `start` and `count` are as for
+           stamps(). Returns an empty list if `text` has no words."""
+
+    @abc.abstractmethod
+    def total(self, filters, text=None):
+        """The number of stamps matching all `filters`, and whose titles or description contain
+           all the words in `text` if not None, as for search()."""
+
+    def stream(self, filters, text=None, start=0, count=None, sort=None, fields=None,
+               chunk_size=500):
+        """The stamps stamps() returns, or search() if `text` is not None, as a (count, chunks)
+           tuple of the number of stamps and a generator of lists of at most `chunk_size` of
+           them. Only one chunk at a time is read and held in memory, each with its own query."""
+        total = self.total(filters, text)
+        end = total if count is None else min(total, start + count)
+
+        def chunks():
+            for offset in range(start, end, chunk_size):
+                size = min(chunk_size, end - offset)
+                if text is None:
+                    yield self.stamps(filters, offset, size, sort, fields)
+                else:
+                    yield self.search(text, filters, offset, size, sort, fields)
+
+        return max(end - start, 0), chunks()
+
+
+class PandasStore(StampStore):
+    """The storage engine that answers the queries from the database.Catalog `catalog`, using
+       its indexes, registry and JSON fragments. `fields` specifies how a stamp is encoded as JSON
+       (see database.Catalog.build_json_fragments()). The registry is built if the catalog
+       doesn't have one yet."""
+
+    name = "pandas"
+
+    def __init__(self, catalog, fields):
+        self.catalog = catalog
+        self.fields = fields
+        if catalog.registry is None:
+            catalog.build_registry(fields)
+
+    def stamps(self, filters, start=0, count=None, sort=None, fields=None):
+        cat = self.catalog
+        positions = cat.query(filters)
+        if sort is not None:
+            positions = cat.sorted(positions, *sort)
+        end = start + count if count is not None else None
+        if positions is None:
+            positions = range(len(cat.db))[start:end]
+        else:
+            positions = positions[start:end]
+        return self.encoded(positions, fields)
+
+    def page(self, filters, count, sort=None, after=None, fields=None):
+        cat = self.catalog
+        positions = cat.query(filters)
+        if sort is not None:
+            positions = cat.sorted(positions, *sort)
+        if positions is None:
+            positions = range(len(cat.db))
+        start = 0 if after is None else cat.after(positions, after, sort)
+        # One stamp more than asked for tells if there are more stamps
+        positions = positions[start:start + count + 1]
+        last = cat.sort_key(positions[count - 1], sort) if len(positions) > count else None
+        return self.encoded(positions[:count], fields), last
+
+    def encoded(self, positions, fields=None):
+        """The stamps at the row `positions` as UTF-8 encoded Stamp JSON objects with `fields`,
+           or all fields if None."""
+        cat = self.catalog
+        if fields is None:
+            # The same encoded stamps as in the registry
+            return list(cat.json_fragments[positions])
+        # Only the rows and columns to encode are read from `db`
+        db = database.selected(cat.db, positions, fields)
+        return [stamp.encode() for stamp in database.json_objects(db, fields)]
+
+    def stamp(self, key):
+        return self.catalog.registry.get(key)
+
+    def image(self, key):
+        position = self.catalog.ids.get(key)
+        return self.catalog.db["image"].iat[position] if position is not None else None
+
+    def titles(self, language, q=None):
+        index = self.catalog.titles[language]
+        return index.sorted_titles if q is None else index.query(q)
+
+    def values(self, column, filters=None):
+        facet = self.catalog.facets.get(column)
+        if facet is None:
+            facet = database.Facet(self.catalog.db[column])
+        if not filters:
+            return facet.values, facet.counts
+        return facet.counted(self.catalog.query(filters))
+
+    def search(self, text, filters, start=0, count=None, sort=None, fields=None):
+        positions = self.catalog.search(text, filters)
+        if positions is None:
+            return []
+        if sort is not None:
+            positions = self.catalog.sorted(positions, *sort)
+        end = start + count if count is not None else None
+        return self.encoded(positions[start:end], fields)
+
+    def total(self, filters, text=None):
+        if text is not None:
+            positions = self.catalog.search(text, filters)
+            return len(positions) if positions is not None else 0
+        positions = self.catalog.query(filters)
+        return len(self.catalog.db) if positions is None else len(positions)
+
+    def stream(self, filters, text=None, start=0, count=None, sort=None, fields=None,
+               chunk_size=500):
+        # The matching stamps are only looked up and sorted once, and their positions kept
+        cat = self.catalog
+        if text is not None:
+            positions = cat.search(text, filters)
+            if positions is None:
+                positions = database.NO_POSITIONS
+        else:
+            positions = cat.query(filters)
+        if sort is not None:
+            positions = cat.sorted(positions, *sort)
+        if positions is None:
+            positions = range(len(cat.db))
+        end = start + count if count is not None else None
+        positions = positions[start:end]
+
+        def chunks():
+            for i in range(0, len(positions), chunk_size):
+                yield self.encoded(positions[i:i + chunk_size], fields)
+
+        return len(positions), chunks()
+
+
+class SQLiteStore(StampStore):
+    """The storage engine that answers the queries from the SQLite database file `path`, see
+       build_sqlite(). Each thread gets its own read-only connection to the database."""
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        """The connection of the calling thread to the database."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+
+    def stamps(self, filters, start=0, count=None, sort=None, fields=None):
+        conditions, parameters = filter_conditions(filters)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        parameters.extend([count if count is not None else -1, start])
+        cursor = self.connection().execute(
+                f"SELECT {json_projection(fields)} FROM stamps{where} "
+                f"ORDER BY {sort_terms(sort)}position LIMIT ? OFFSET ?", parameters)
+        return [row[0] for row in cursor]
+
+    def page(self, filters, count, sort=None, after=None, fields=None):
+        conditions, parameters = filter_conditions(filters)
+        if after is not None:
+            condition, after_parameters = after_condition(sort, after)
+            conditions.append(condition)
+            parameters.extend(after_parameters)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rank = f"sort_{sort[0]}" if sort is not None else "NULL"
+        # One stamp more than asked for tells if there are more stamps
+        rows = self.connection().execute(
+                f"SELECT {rank}, position, {json_projection(fields)} FROM stamps{where} "
+                f"ORDER BY {sort_terms(sort)}position LIMIT ?", parameters + [count + 1]).fetchall()
+        last = None
+        if len(rows) > count:
+            rank, position, _ = rows[count - 1]
+            last = (position,) if sort is None else (-rank if sort[1] else rank, position)
+        return [row[2] for row in rows[:count]], last
+
+    def stamp(self, key):
+        rows = self.connection().execute(
+                "SELECT id_yt_var, json FROM stamps WHERE type_fr = ? AND id_yt_no = ? "
+                "ORDER BY id_yt_var, position", key[:2]).fetchall()
+        stamps = [stamp for variant, stamp in rows if variant == key[2]]
+        if not stamps:
+            return None
+        if len(rows) == 1:
+            return stamps[-1], b"null"
+        variants = b"{" + b",".join([database.json_encode(variant).encode() + b":" + stamp
+                                     for variant, stamp in rows]) + b"}"
+        return stamps[-1], variants
+
+    def image(self, key):
+        row = self.connection().execute(
+                "SELECT image FROM stamps WHERE type_fr = ? AND id_yt_no = ? AND id_yt_var = ?",
+                key).fetchone()
+        return row[0] if row is not None else None
+
+    def titles(self, language, q=None):
+        column = f"title_{language}"
+        if column not in SQLITE_COLUMNS:
+            raise ValueError(f"No titles in language '{language}'.")
+        if q is None:
+            # The BINARY collation sorts UTF-8 text in code point order, as Python does
+            rows = self.connection().execute(
+                    f"SELECT DISTINCT {column} FROM stamps ORDER BY {column}")
+        else:
+            patterns = title_patterns(q)
+            rows = self.connection().execute(
+                    f"SELECT {column} FROM stamps "
+                    f"WHERE {' AND '.join(f'{column} GLOB ?' for _ in patterns)} "
+                    f"GROUP BY {column} ORDER BY MIN(position)", patterns)
+        return [row[0] for row in rows]
+
+    def values(self, column, filters=None):
+        if column not in SQLITE_COLUMNS:
+            raise ValueError(f"No such column '{column}'.")
+        conditions, parameters = filter_conditions(filters or [])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection().execute(
+                f"SELECT {column}, COUNT(*) FROM stamps{where} GROUP BY {column} "
+                f"ORDER BY {column}", parameters)
+        values = []
+        counts = []
+        for value, count in rows:
+            values.append(value)
+            counts.append(count)
+        return values, counts
+
+    def search(self, text, filters, start=0, count=None, sort=None, fields=None):
+        query = fts_query(text)
+        if query is None:
+            return []
+        conditions, parameters = filter_conditions(filters)
+        where = "".join(f" AND {condition}" for condition in conditions)
+        weights = ", ".join(str(weight) for weight in database.TEXT_COLUMNS.values())
+        cursor = self.connection().execute(
+                f"SELECT {json_projection(fields)} FROM stamps_fts "
+                f"JOIN stamps ON position = stamps_fts.rowid "
+                f"WHERE stamps_fts MATCH ?{where} "
+                f"ORDER BY {sort_terms(sort)}bm25(stamps_fts, {weights}), position "
+                f"LIMIT ? OFFSET ?",
+                [query] + parameters + [count if count is not None else -1, start])
+        return [row[0] for row in cursor]
+
+    def total(self, filters, text=None):
+        conditions, parameters = filter_conditions(filters)
+        if text is None:
+            where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+            return self.connection().execute(f"SELECT COUNT(*) FROM stamps{where}",
+                                             parameters).fetchone()[0]
+        query = fts_query(text)
+        if query is None:
+            return 0
+        where = "".join(f" AND {condition}" for condition in conditions)
+        return self.connection().execute(
+                f"SELECT COUNT(*) FROM stamps_fts JOIN stamps ON position = stamps_fts.rowid "
+                f"WHERE stamps_fts MATCH ?{where}", [query] + parameters).fetchone()[0]
+
+
+def fts_query(text):
+    """The FTS5 query for the words in the full-text query `text` (see database.search_terms()),
+       or None if it has no words."""
+    terms = database.search_terms(text)
+    if not terms:
+        return None
+    # Quoted words are matched as is, so words like AND or NOT are not FTS5 operators
+    return " ".join(f'"{word}"*' if prefix else f'"{word}"' for word, prefix in terms)
+
+
+def glob_escaped(text):
+    """`text` as a GLOB pattern that only matches `text` itself."""
+    return "".join(f"[{c}]" if c in "*?[" else c for c in text)
+
+
+def title_patterns(q):
+    """The GLOB patterns a title has to match all of to match the title query `q`, with the same
+       result as database.TitleIndex.query()."""
+    if q[0] == "*" and q[-1] == "*":
+        return [f"*{glob_escaped(q[1:-1])}*"]
+    if q[-1] == "*":
+        return [f"{glob_escaped(q[:-1])}*"]
+    if q[0] == "*":
+        return [f"*{glob_escaped(q[1:])}"]
+    starpos = q.find("*")
+    return [f"{glob_escaped(q[0:starpos])}*", f"*{glob_escaped(q[starpos+1:])}"]
+
+
+def filter_conditions(filters):
+    """The SQL conditions on the stamps table and their parameters for `filters`, a list of
+       (column, values) tuples. See database.Catalog.positions() for the values."""
+    conditions = []
+    parameters = []
+    for column, values in filters:
+        if column not in SQLITE_COLUMNS:
+            raise ValueError(f"Can't filter on column '{column}'.")
+        # The table is named, since the FTS5 table has columns with the same names
+        exact = [value for value in values if not isinstance(value, tuple)]
+        alternatives = [f"stamps.{column} IN ({','.join('?' * len(exact))})"] if exact else []
+        parameters.extend(exact)
+        for low, high in (value for value in values if isinstance(value, tuple)):
+            if column not in database.RANGE_COLUMNS:
+                raise ValueError(f"Can't filter on a range of column '{column}'.")
+            bounds = [f"stamps.{column}_number IS NOT NULL"]
+            if low is not None:
+                bounds.append(f"stamps.{column}_number >= ?")
+                parameters.append(low)
+            if high is not None:
+                bounds.append(f"stamps.{column}_number <= ?")
+                parameters.append(high)
+            alternatives.append(f"({' AND '.join(bounds)})")
+        conditions.append(f"({' OR '.join(alternatives)})")
+    return conditions, parameters
+
+
+def sort_terms(sort):
+    """The first terms of the SQL ORDER BY clause for `sort`, a (key, descending) tuple, or ""
+       if `sort` is None. Stamps with the same rank are ordered by the following terms."""
+    if sort is None:
+        return ""
+    key, descending = sort
+    if key not in database.SORT_KEYS:
+        raise ValueError(f"Can't sort on '{key}'.")
+    return f"sort_{key} DESC, " if descending else f"sort_{key}, "
+
+
+def json_projection(fields, path="$"):
+    """The SQL expression for the stamps as JSON objects with `fields` (see StampStore), built
+       from their JSON encoding with all fields. Just the JSON encoding if `fields` is None. The
+       JSON functions of SQLite encode the objects exactly like database.json_objects()."""
+    if fields is None:
+        return "json"
+    members = []
+    for name, column in fields:
+        if not name.isidentifier():
+            raise ValueError(f"Not a field name: '{name}'.")
+        if isinstance(column, list):
+            members.append(f"'{name}', {json_projection(column, f'{path}.{name}')}")
+        else:
+            members.append(f"'{name}', json -> '{path}.{name}'")
+    if path != "$":
+        return f"json_object({', '.join(members)})"
+    return f"CAST(json_object({', '.join(members)}) AS BLOB)"
+
+
+def after_condition(sort, after):
+    """The SQL condition on the stamps table and its parameters for the stamps after the stamp
+       with the sort key `after` in the order `sort` (see database.Catalog.sort_key()). Both are
+       answered by the (sort_{key}, position) indexes."""
+    if sort is None:
+        return "position > ?", [after[0]]
+    key, descending = sort
+    if key not in database.SORT_KEYS:
+        raise ValueError(f"Can't sort on '{key}'.")
+    column = f"sort_{key}"
+    if descending:
+        # The key of a stamp in descending order is (-rank, position)
+        return f"({column} < ? OR ({column} = ? AND position > ?))", \
+            [-after[0], -after[0], after[1]]
+    return f"({column}, position) > (?, ?)", list(after)
+
+
+def sqlite_path(csv_file):
+    """The name of the SQLite database file for the catalog CSV file `csv_file`."""
+    return os.path.splitext(csv_file)[0] + ".sqlite"
+
+
+def sqlite_is_current(path, version):
+    """True if the SQLite database file `path` was built from the catalog with `version`."""
+    if not os.path.exists(path):
+        return False
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            meta = dict(connection.execute("SELECT key, value FROM meta"))
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+    return meta.get("format") == str(SQLITE_FORMAT_VERSION) and meta.get("version") == version
+
+
+def build_sqlite(catalog, fields, path):
+    """Write the database.Catalog `catalog` to the SQLite database file `path`, with the stamps
+       encoded as JSON as specified by `fields`. Each stamp is stored with its position in the
+       catalog, so the stamps can be returned in catalog order."""
+    db = catalog.db
+    ranks = [catalog.sort_ranks[key].tolist() for key in database.SORT_KEYS]
+    numbers = [[None if np.isnan(number) else number for number in
+                pd.to_numeric(db[column], errors="coerce").tolist()]
+               for column in database.RANGE_COLUMNS]
+    if catalog.json_fragments is not None:
+        fragments = catalog.json_fragments
+    else:
+        fragments = database.encoded_json_objects(db, fields)
+    # We write the database to a temporary file first and then move it in place, so that a
+    # reader never sees a half written database.
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        with connection:
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute(f"CREATE TABLE stamps (position INTEGER PRIMARY KEY, "
+                               f"{', '.join(f'{column} TEXT' for column in SQLITE_COLUMNS)}, "
+                               f"{', '.join(f'{column} INTEGER' for column in SORT_COLUMNS)}, "
+                               f"{', '.join(f'{column} REAL' for column in NUMBER_COLUMNS)}, "
+                               f"json BLOB)")
+            columns = len(SQLITE_COLUMNS) + len(SORT_COLUMNS) + len(NUMBER_COLUMNS) + 2
+            connection.executemany(
+                    f"INSERT INTO stamps VALUES ({','.join('?' * columns)})",
+                    zip(range(len(db)), *(db[column].tolist() for column in SQLITE_COLUMNS),
+                        *ranks, *numbers, fragments))
+            # The indexes are created after the rows are inserted, which is a lot faster
+            connection.execute(f"CREATE INDEX stamps_id ON stamps "
+                               f"({', '.join(database.ID_COLUMNS)})")
+            for column in database.FILTER_COLUMNS:
+                # The id columns are indexed together in stamps_id
+                if column not in database.ID_COLUMNS:
+                    connection.execute(f"CREATE INDEX stamps_{column} ON stamps ({column})")
+            for column in SORT_COLUMNS:
+                connection.execute(f"CREATE INDEX stamps_{column} ON stamps ({column}, position)")
+            for column in NUMBER_COLUMNS:
+                connection.execute(f"CREATE INDEX stamps_{column} ON stamps ({column})")
+            connection.execute(f"CREATE VIRTUAL TABLE stamps_fts USING fts5("
+                               f"{', '.join(SEARCH_COLUMNS)}, content='stamps', "
+                               f"content_rowid='position', "
+                               f"tokenize='unicode61 remove_diacritics 2')")
+            connection.execute("INSERT INTO stamps_fts(stamps_fts) VALUES('rebuild')")
+            connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                                   [("format", str(SQLITE_FORMAT_VERSION)),
+                                    ("version", catalog.version)])
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+
+
+def sqlite_store(catalog, csv_file, fields):
+    """An SQLiteStore for the database.Catalog `catalog` read from `csv_file`. The SQLite
+       database file is (re)built first if it is not current."""
+    path = sqlite_path(csv_file)
+    if not sqlite_is_current(path, catalog.version):
+        database.logger.info(f"Building SQLite database '{path}'.")
+        build_sqlite(catalog, fields, path)
+    return SQLiteStore(path)
+
+
+class StoredCatalog:
+    """A stamp catalog that is only stored by the StampStore `store`, and not held in memory. It
+       has the attributes of a database.Catalog that the API uses besides its store: `version`,
+       `source`, `size` (the number of stamps), `loaded_at` and `load_time`."""
+
+    def __init__(self, store, version, source):
+        self.store = store
+        self.version = version
+        self.source = source
+        self.size = store.total([])
+        self.loaded_at = datetime.datetime.now(datetime.timezone.utc)
+        self.load_time = None
+
+    def memory_usage(self):
+        """The catalog takes no memory, besides the page cache of its store."""
+        return 0
+
+
+def load_sqlite(csv_file, fields, use_snapshot=True):
+    """The StoredCatalog of the catalog CSV file `csv_file`, stored in its SQLite database (see
+       sqlite_path()) with the stamps encoded as specified by `fields`. Only if the database is
+       not current, the catalog is loaded as by database.load() to (re)build it, and dropped
+       again. Otherwise only the CSV file's digest is computed."""
+    path = sqlite_path(csv_file)
+    version = database.file_digest(csv_file)
+    if not sqlite_is_current(path, version):
+        catalog = database.load(csv_file, use_snapshot)
+        database.logger.info(f"Building SQLite database '{path}'.")
+        build_sqlite(catalog, fields, path)
+        version = catalog.version
+    return StoredCatalog(SQLiteStore(path), version, "sqlite")
+
+
+def open_store(engine, catalog, csv_file, fields):
+    """The StampStore of the storage `engine` ("pandas" or "sqlite") for the database.Catalog
+       `catalog` read from `csv_file`."""
+    if engine == "pandas":
+        return PandasStore(catalog, fields)
+    elif engine == "sqlite":
+        return sqlite_store(catalog, csv_file, fields)
+    raise ValueError(f"Unknown storage engine '{engine}'. Use one of {', '.join(ENGINES)}.")
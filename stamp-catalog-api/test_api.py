@@ -1,9 +1,22 @@
 # This file contains Pytest-based unit tests for the Faststamps Catalog API
 import pytest
 from fastapi.testclient import TestClient
-from main import app
+from main import app, settings, stamp_json_fields, compressed_cache
+from main import decoded_cursor, encoded_cursor
+import brotli
+import compression
+import database
+import gzip
+import metrics
+import storage
+import numpy as np
+import pandas as pd
 import os
+import io
 import json
+import shutil
+import time
+from PIL import Image
 
 
 # Constants
@@ -11,6 +24,7 @@ API_PORT = 8008
 API_BASE_URL = "http://127.0.0.1:%s" % (API_PORT)
 STAMPS_TEST_DATA_FILE = "./test-data/stamps.json"
 STAMPS_IMAGE_DIR = "./data/images/large"
+STAMPS_CATALOG_CSV_FILE = "./data/french-stamps.csv"
 
 
 @pytest.fixture
@@ -23,40 +37,450 @@ def client():
         yield c
 
 
+@pytest.fixture
+def sqlite_client(tmp_path, monkeypatch):
+    """A client for the API with the SQLite storage engine. The SQLite database is built in
+       `tmp_path`."""
+    csv_file = tmp_path / "french-stamps.csv"
+    shutil.copyfile(STAMPS_CATALOG_CSV_FILE, csv_file)
+    monkeypatch.setattr(settings, "STAMP_CATALOG_CSV_FILE", str(csv_file))
+    monkeypatch.setattr(settings, "STAMP_CATALOG_STORAGE", "sqlite")
+    with TestClient(app) as c:
+        yield c
+
+
 def test_root(client):
     resource = "/"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json() == {'name': 'Faststamps Catalog API.',
                         'version': '0.0.1',
                         'openapi_specification': f'{API_BASE_URL}/docs',
                         'health': f'{API_BASE_URL}/health'}
 
 
+def test_health(client):
+    resource = "/health"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    health = r.json()
+    assert health["status"] == "ok"
+    assert health["catalog"]["stamps"] == 6592
+    assert health["catalog"]["version"] == database.file_digest(STAMPS_CATALOG_CSV_FILE)
+    assert health["reloads"]["in_progress"] is False
+
+
+def test_metrics(client):
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?color=Green&count=5"))
+    timings = dict(metrics.parsed_server_timing(r.headers["Server-Timing"]))
+    assert list(timings)[0] == "API"
+    assert {"store", "body", "total"} <= set(timings)
+    assert timings["total"] >= timings["API"] >= timings["store"]
+    for resource in ["/stamp_titles?q=Mari*", "/stamp_years", "/stamp_colors?counts=true",
+                     "/stamp_values"]:
+        r = client.get('%s%s' % (API_BASE_URL, resource))
+        timings = dict(metrics.parsed_server_timing(r.headers["Server-Timing"]))
+        assert {"API", "query", "encode", "total"} <= set(timings)
+    etag = client.get('%s%s' % (API_BASE_URL, "/stamp_facets?issued=1931")).headers["ETag"]
+    r = client.get('%s%s' % (API_BASE_URL, "/stamp_facets?issued=1931"),
+                   headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    r = client.get('%s%s' % (API_BASE_URL, "/metrics"))
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert "ETag" not in r.headers
+    lines = r.text.splitlines()
+    assert '# TYPE faststamps_request_duration_seconds histogram' in lines
+    assert any(line.startswith('faststamps_request_duration_seconds_count{route="/stamps",'
+                               'phase="store"}') for line in lines)
+    assert any(line.startswith('faststamps_requests_total{route="/stamp_facets",method="GET",'
+                               'status="304"}') for line in lines)
+    assert any(line.startswith('faststamps_result_stamps_bucket{route="/stamps",le="5"}')
+               for line in lines)
+    assert any(line.startswith('faststamps_revalidations_total{result="hit"}') for line in lines)
+    assert any(line.startswith('faststamps_catalog_load_seconds{catalog="french-stamps"}')
+               for line in lines)
+
+
+def test_metrics_exposition():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("route",), [0.1, 1.0])
+    for value in [0.05, 0.5, 5.0]:
+        histogram.observe(value, 'a"b')
+    counter = metrics.Counter("test_total", "Test.")
+    counter.inc()
+    counter.inc(amount=2)
+    assert metrics.exposition([histogram, counter]).splitlines() == [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{route="a\\"b",le="0.1"} 1',
+        'test_seconds_bucket{route="a\\"b",le="1.0"} 2',
+        'test_seconds_bucket{route="a\\"b",le="+Inf"} 3',
+        'test_seconds_sum{route="a\\"b"} 5.55',
+        'test_seconds_count{route="a\\"b"} 3',
+        '# HELP test_total Test.',
+        '# TYPE test_total counter',
+        'test_total 3']
+    assert metrics.parsed_server_timing("API;dur=1.5, cache;desc=hit, total;dur=2") == \
+        [("API", 1.5), ("total", 2.0)]
+
+
+def test_compression():
+    assert compression.negotiated_encoding("gzip, deflate, br") == "br"
+    assert compression.negotiated_encoding("gzip, br;q=0.5") == "gzip"
+    assert compression.negotiated_encoding("*") == "br"
+    assert compression.negotiated_encoding("br;q=0, *;q=0.1") == "gzip"
+    assert compression.negotiated_encoding("identity") is None
+    assert compression.negotiated_encoding("gzip;q=0") is None
+    assert compression.negotiated_encoding(None) is None
+    assert compression.is_compressible("application/json; charset=utf-8")
+    assert not compression.is_compressible("image/jpeg")
+    data = b'{"title_en":"Ceres","title_fr":"C\xc3\xa9r\xc3\xa8s."}' * 100
+    for encoding, decompress in [("br", brotli.decompress), ("gzip", gzip.decompress)]:
+        assert decompress(compression.compressed(data, encoding, 9)) == data
+        compressor = compression.Compressor(encoding, 4)
+        chunks = [compressor.compress(data[i:i+1000]) for i in range(0, len(data), 1000)]
+        assert decompress(b"".join(chunks + [compressor.finish()])) == data
+    cache = compression.CompressedCache(100)
+    cache.put("a", b"x" * 60, {"etag": '"a"'})
+    cache.put("b", b"x" * 30, {"etag": '"b"'})
+    assert cache.get("a") == (b"x" * 60, {"etag": '"a"'})
+    cache.put("c", b"x" * 30, {"etag": '"c"'})
+    cache.put("d", b"x" * 101, {"etag": '"d"'})
+    assert cache.get("b") is None and cache.get("d") is None
+    assert cache.bytes == 90
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_reload(tmp_path, monkeypatch):
+    csv_file = tmp_path / "stamps.csv"
+    shutil.copyfile(STAMPS_CATALOG_CSV_FILE, csv_file)
+    monkeypatch.setattr(settings, "STAMP_CATALOG_CSV_FILE", str(csv_file))
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    with TestClient(app) as client:
+        version = client.get('%s%s' % (API_BASE_URL, "/health")).json()["catalog"]["version"]
+        r = client.get('%s%s' % (API_BASE_URL, "/stamps?count=1"))
+        etag = r.headers["ETag"]
+        next_page = r.links["next"]["url"]
+        with open(csv_file, "a") as f:
+            f.write("99999;;Poste;1999;1999;Test;Test;;;;;;;;\n")
+        url = '%s%s' % (API_BASE_URL, "/admin/reload?wait=true")
+        r = client.post(url)
+        assert r.status_code == 403
+        r = client.post(url, headers={"X-Admin-Token": "wrong"})
+        assert r.status_code == 403
+        r = client.post(url, headers={"X-Admin-Token": "secret"})
+        assert r.status_code == 200
+        assert r.json()["count"] == 1
+        assert r.headers["Cache-Control"] == "no-store"
+        health = client.get('%s%s' % (API_BASE_URL, "/health")).json()
+        assert health["catalog"]["version"] != version
+        assert health["catalog"]["stamps"] == 6593
+        assert client.get('%s%s' % (API_BASE_URL, "/stamps/Poste-99999")).status_code == 200
+        # Without wait, the reload is in progress when the response is sent
+        r = client.post('%s%s' % (API_BASE_URL, "/admin/reload"),
+                        headers={"X-Admin-Token": "secret"})
+        assert r.status_code == 202
+        assert r.json()["in_progress"] is True
+        assert r.headers["Location"] == f"{API_BASE_URL}/health"
+        # The health isn't cached, so it always shows the current catalog
+        r = client.get('%s%s' % (API_BASE_URL, "/health"), headers={"If-None-Match": "*"})
+        assert r.status_code == 200
+        assert r.json()["reloads"]["count"] == 2
+        assert r.json()["reloads"]["in_progress"] is False
+        for resource in ["/", "/health", "/metrics"]:
+            r = client.get('%s%s' % (API_BASE_URL, resource))
+            assert "ETag" not in r.headers
+            assert r.headers["Cache-Control"] == "no-store"
+        r = client.get('%s%s' % (API_BASE_URL, "/stamps?count=1"), headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        # Cursors of the old catalog have expired
+        assert client.get(next_page).status_code == 410
+
+
+def test_reload_on_change(tmp_path, monkeypatch):
+    csv_file = tmp_path / "stamps.csv"
+    shutil.copyfile(STAMPS_CATALOG_CSV_FILE, csv_file)
+    monkeypatch.setattr(settings, "STAMP_CATALOG_CSV_FILE", str(csv_file))
+    monkeypatch.setattr(settings, "STAMP_CATALOG_WATCH_INTERVAL", 0.1)
+    with TestClient(app) as client:
+        with open(csv_file, "a") as f:
+            f.write("99999;;Poste;1999;1999;Test;Test;;;;;;;;\n")
+        for i in range(100):
+            health = client.get('%s%s' % (API_BASE_URL, "/health")).json()
+            if health["catalog"]["stamps"] == 6593:
+                break
+            time.sleep(0.1)
+        assert health["catalog"]["stamps"] == 6593
+
+
+def test_named_catalogs(tmp_path, monkeypatch):
+    db = pd.read_csv(STAMPS_CATALOG_CSV_FILE, delimiter=';', dtype=str, keep_default_na=False)
+    db[:100].to_csv(tmp_path / "first.csv", sep=';', index=False)
+    db[100:300].to_csv(tmp_path / "second.csv", sep=';', index=False)
+    monkeypatch.setattr(settings, "STAMP_CATALOGS_DIR", str(tmp_path))
+    # Room for one of the catalogs only
+    monkeypatch.setattr(settings, "STAMP_CATALOGS_MEMORY_BUDGET", 1)
+    with TestClient(app) as client:
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs"))
+        assert r.status_code == 200
+        assert [c["name"] for c in r.json()["catalogs"]] == ["first", "french-stamps", "second"]
+        assert [c["loaded"] for c in r.json()["catalogs"]] == [False, True, False]
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs/first/stamps"))
+        assert r.status_code == 200
+        assert "ETag" in r.headers
+        assert r.json()["count"] == 100
+        etag = r.headers["ETag"]
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs/first/stamps"),
+                       headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs/second/stamp_years?counts=true"))
+        assert r.status_code == 200
+        assert sum(r.json()["counts"]) == 200
+        first_stamp = db.iloc[0]
+        r = client.get('%s/catalogs/first/stamps/%s-%s' % (API_BASE_URL, first_stamp["type_fr"],
+                                                           first_stamp["id_yt_no"]))
+        assert r.status_code == 200
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs/french-stamps/stamps?count=1"))
+        assert r.json()["count"] == 1
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs/missing/stamps"))
+        assert r.status_code == 404
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs/..%2Fdata%2Ffrench-stamps/stamps"))
+        assert r.status_code == 404
+        r = client.get('%s%s' % (API_BASE_URL, "/catalogs"), headers={"If-None-Match": "*"})
+        assert r.status_code == 200
+        assert "ETag" not in r.headers
+        assert r.headers["Cache-Control"] == "no-store"
+        catalogs = {c["name"]: c for c in r.json()["catalogs"]}
+        assert catalogs["first"]["loads"] == 2
+        assert catalogs["first"]["evictions"] == 1
+        assert catalogs["first"]["hits"] == 0
+        assert catalogs["first"]["loaded"] is True
+        assert catalogs["second"]["loaded"] is False
+        assert catalogs["french-stamps"]["default"] is True
+        assert catalogs["french-stamps"]["memory"] > 0
+        assert catalogs["french-stamps"]["hits"] == 1
+
+
 def test_stamps(client):
     resource = "/stamps"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     with open(STAMPS_TEST_DATA_FILE) as f:
         data = json.load(f)
     assert r.json() == data
 
 
+def test_stamps_sqlite(sqlite_client):
+    for resource, test_data_file in [("/stamps", STAMPS_TEST_DATA_FILE),
+                                     ("/stamps?count=20", "test-data/stamp_count_20.json"),
+                                     ("/stamps?start=20&count=20",
+                                      "test-data/stamp_start_20_count_20.json"),
+                                     ("/stamps/Poste-1", "test-data/stamp_Poste_1.json"),
+                                     ("/stamps/Poste-1-a", "test-data/stamp_Poste_1_a.json"),
+                                     ("/stamp_years", "test-data/stamp_years.json"),
+                                     ("/stamp_colors", "test-data/stamp_colors.json"),
+                                     ("/stamp_values", "test-data/stamp_values.json")]:
+        url = '%s%s' % (API_BASE_URL, resource)
+        r = sqlite_client.get(url)
+        assert r.status_code == 200
+        with open(test_data_file) as f:
+            data = json.load(f)
+        assert r.json() == data
+    r = sqlite_client.get('%s%s' % (API_BASE_URL, "/stamps/Poste-0"))
+    assert r.status_code == 404
+    # The catalog is served from the SQLite database alone, without the catalog in memory
+    r = sqlite_client.get('%s%s' % (API_BASE_URL, "/health"))
+    assert r.json()["catalog"]["source"] == "sqlite"
+    assert r.json()["catalog"]["stamps"] == 6592
+    with open(STAMPS_TEST_DATA_FILE) as f:
+        data = json.load(f)
+    r = sqlite_client.get('%s%s' % (API_BASE_URL, "/stamps?stream=true"))
+    assert r.json() == data
+    r = sqlite_client.get('%s%s' % (API_BASE_URL, "/stamps?count=20&start=21"),
+                          headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line) for line in r.text.splitlines()] == data["stamps"][20:40]
+    for resource, test_data_file in [("/stamp_titles", "test-data/stamp_titles.json"),
+                                     ("/stamp_titles?q=Mari*", None),
+                                     ("/stamp_facets?issued=1931&color=Green", None),
+                                     ("/stamps/Poste-1/image", None)]:
+        r = sqlite_client.get('%s%s' % (API_BASE_URL, resource))
+        assert r.status_code == 200
+        if test_data_file is not None:
+            with open(test_data_file) as f:
+                assert r.json() == json.load(f)
+
+
+def test_stamps_search(client):
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search=ceres 1849"))
+    assert r.status_code == 200
+    result = r.json()
+    assert result["count"] == 25
+    assert all("1849" in stamp["title_fr"] + stamp["description_fr"]
+               for stamp in result["stamps"])
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search=ceres 1849&count=5&start=3"))
+    assert r.json()["stamps"] == result["stamps"][2:7]
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search=ceres 1849&stream=true"))
+    assert r.json() == result
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search=Cérès&issued=1850"))
+    assert r.json()["count"] == 30
+    assert {stamp["issued"] for stamp in r.json()["stamps"]} == {"1850"}
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search=marianne cheffer"))
+    assert r.json()["stamps"][0]["title_fr"] == "Type Marianne de Cheffer"
+    # A search without words returns all stamps
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search= &count=3"))
+    assert r.json()["count"] == 3
+
+
+def test_stamps_sort(client):
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=yt_no&count=12"))
+    assert r.status_code == 200
+    ids = [(stamp["id"]["yt_no"], stamp["id"]["yt_variant"]) for stamp in r.json()["stamps"]]
+    assert ids[:8] == [("1", ""), ("1", "a"), ("1", "b"), ("1", "c"), ("1", "d"), ("1", "e"),
+                       ("1", "f"), ("2", "")]
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=-yt_no&stamp-type=Poste"))
+    numbers = [int(stamp["id"]["yt_no"]) for stamp in r.json()["stamps"]]
+    assert numbers == sorted(numbers, reverse=True)
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=-issued&issued=1850,1931,1849"))
+    years = [stamp["issued"] for stamp in r.json()["stamps"]]
+    assert years == sorted(years, reverse=True)
+    assert years[0] == "1931"
+    resource = "/stamps?sort=-issued&issued=1850,1931,1849&stream=true"
+    r = client.get('%s%s' % (API_BASE_URL, resource))
+    assert [stamp["issued"] for stamp in r.json()["stamps"]] == years
+    # Paging through a sorted result
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=title"))
+    titles = [stamp["title_en"] for stamp in r.json()["stamps"]]
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=title&start=101&count=50"))
+    assert [stamp["title_en"] for stamp in r.json()["stamps"]] == titles[100:150]
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=title&count=3"),
+                   headers={"Accept-Language": "fr"})
+    assert [stamp["title_fr"] for stamp in r.json()["stamps"]][0].startswith("1er")
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?search=marianne&sort=issued"))
+    years = [stamp["issued"] for stamp in r.json()["stamps"]]
+    assert years == sorted(years)
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?sort=color"))
+    assert r.status_code == 400
+
+
+def test_stamps_stream(client):
+    resource = "/stamps?stream=true"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    with open(STAMPS_TEST_DATA_FILE, "rb") as f:
+        data = f.read()
+    assert r.content == data
+    resource = "/stamps?stream=true&title=No such title"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.json() == {"count": 0, "stamps": []}
+
+
+def test_stamps_ndjson(client):
+    resource = "/stamps?start=20&count=20"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url, headers={"Accept": "application/x-ndjson"})
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    assert r.headers["Content-Type"] == "application/x-ndjson"
+    with open("test-data/stamp_start_20_count_20.json") as f:
+        data = json.load(f)
+    assert [json.loads(line) for line in r.text.splitlines()] == data["stamps"]
+
+
+def test_stamps_conditional_get(client):
+    resource = "/stamps?count=20"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    assert "Cache-Control" in r.headers
+    # A matching If-None-Match gets a 304 without a body
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert "Server-Timing" in r.headers
+    assert r.headers["ETag"] == etag
+    assert r.content == b""
+    r = client.get(url, headers={"If-None-Match": f'"other", W/{etag}'})
+    assert r.status_code == 304
+    # Other query parameters or languages are other representations
+    r = client.get(url, headers={"If-None-Match": etag, "Accept-Language": "fr"})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    r = client.get(url + "&start=2", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    # Errors don't get an ETag
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps/Poste-0"))
+    assert r.status_code == 404
+    assert "ETag" not in r.headers
+
+
+def test_stamps_compression(client):
+    with open(STAMPS_TEST_DATA_FILE, "rb") as f:
+        data = f.read()
+    url = '%s%s' % (API_BASE_URL, "/stamps")
+    compressed_cache.clear()
+    etags = set()
+    for encoding in ["br", "gzip"]:
+        # The first response is compressed and cached, the second is answered from the cache
+        for phase in ["compress", "cache"]:
+            r = client.get(url, headers={"Accept-Encoding": encoding})
+            assert r.status_code == 200
+            assert r.headers["Content-Encoding"] == encoding
+            assert "Accept-Encoding" in r.headers["Vary"]
+            assert phase in dict(metrics.parsed_server_timing(r.headers["Server-Timing"]))
+            assert int(r.headers["Content-Length"]) < len(data) / 5
+            assert r.content == data
+            etags.add(r.headers["ETag"])
+        r = client.get(url, headers={"Accept-Encoding": encoding,
+                                     "If-None-Match": r.headers["ETag"]})
+        assert r.status_code == 304
+    r = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in r.headers
+    assert r.content == data
+    # Each content coding is its own representation
+    etags.add(r.headers["ETag"])
+    assert len(etags) == 3
+    # Streamed and small bodies
+    r = client.get(url + "?stream=true", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert r.content == data
+    r = client.get(url + "?count=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in r.headers
+    # Only the responses to requests without query parameters are cached
+    for resource, cached in [("/stamp_titles", True), ("/stamp_titles?q=*a*", False),
+                             ("/stamp_facets?issued=1931", False), ("/stamps?stream=true", False)]:
+        for i in range(2):
+            r = client.get('%s%s' % (API_BASE_URL, resource), headers={"Accept-Encoding": "gzip"})
+            assert r.headers["Content-Encoding"] == "gzip"
+        assert ("cache" in dict(metrics.parsed_server_timing(r.headers["Server-Timing"]))) == \
+            cached
+    # Images are not compressed
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps/Poste-1/image"),
+                   headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in r.headers
+
+
 def test_stamps_bad_start_and_count(client):
     resource = "/stamps?start=-1"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 400
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     resource = "/stamps?count=-1"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 400
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
 
 
 def test_stamps_filter_title(client):
@@ -65,7 +489,7 @@ def test_stamps_filter_title(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 217
 
 
@@ -75,8 +499,28 @@ def test_stamps_filter_year(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
+    assert r.json()["count"] == 54
+
+
+def test_stamps_filter_year_range(client):
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?issued=1931..1933"))
+    assert r.status_code == 200
+    assert r.json()["count"] == 54
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?issued=..1850,1849..1851"))
+    years = {stamp["issued"] for stamp in r.json()["stamps"]}
+    assert years and all(int(year) <= 1851 for year in years)
+    stamps = r.json()["stamps"]
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?issued=..1850,1849..1851&stream=true"))
+    assert r.json()["stamps"] == stamps
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?issued=1990.."))
+    assert all(int(stamp["issued"]) >= 1990 for stamp in r.json()["stamps"])
+    r = client.get('%s%s' % (API_BASE_URL, "/stamp_facets?issued=1931..1933"))
+    assert r.status_code == 200
     assert r.json()["count"] == 54
+    for resource in ["/stamps?issued=1931..x", "/stamp_facets?issued=a..b"]:
+        r = client.get('%s%s' % (API_BASE_URL, resource))
+        assert r.status_code == 400
 
 
 def test_stamps_filter_color(client):
@@ -85,7 +529,7 @@ def test_stamps_filter_color(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 91
 
 
@@ -95,7 +539,7 @@ def test_stamps_filter_value(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 49
 
 
@@ -105,7 +549,7 @@ def test_stamps_filter_stamp_type(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 127
 
 
@@ -119,7 +563,7 @@ def test_stamps_combined_filter(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 3
 
 
@@ -129,7 +573,7 @@ def test_stamps_count_20(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 20
     with open("test-data/stamp_count_20.json") as f:
         data = json.load(f)
@@ -143,19 +587,122 @@ def test_stamps_count_20_start_20(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 20
     with open("test-data/stamp_start_20_count_20.json") as f:
         data = json.load(f)
     assert r.json() == data
 
 
+def test_stamps_cursor(client):
+    for resource in ["/stamps", "/stamps?sort=-issued", "/stamps?color=Green,Black&sort=title",
+                     "/stamps?issued=1849..1900", "/stamps?search=marianne"]:
+        r = client.get('%s%s' % (API_BASE_URL, resource))
+        stamps = r.json()["stamps"]
+        assert "link" not in r.headers
+        url = '%s%s%s' % (API_BASE_URL, resource, "&count=500" if "?" in resource else "?count=500")
+        paged = []
+        while url is not None:
+            r = client.get(url)
+            assert r.status_code == 200
+            assert r.json()["count"] == len(r.json()["stamps"])
+            paged.extend(r.json()["stamps"])
+            url = r.links.get("next", {}).get("url")
+        assert paged == stamps
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps?count=20"))
+    cursor = r.links["next"]["url"].split("cursor=")[1]
+    for resource in ["/stamps?cursor=%s" % cursor,
+                     "/stamps?count=20&start=21&cursor=%s" % cursor,
+                     "/stamps?count=20&stream=true&cursor=%s" % cursor,
+                     "/stamps?count=20&sort=title&cursor=%s" % cursor,
+                     "/stamps?count=20&cursor=invalid"]:
+        r = client.get('%s%s' % (API_BASE_URL, resource))
+        assert r.status_code == 400
+    # A cursor of the right query, but with a position of the wrong shape
+    for resource, after in [("/stamps?count=20", 20), ("/stamps?count=20", [1, 2]),
+                            ("/stamps?count=20&sort=title", [1]),
+                            ("/stamps?count=20&sort=title", [1, -1]),
+                            ("/stamps?count=20&search=marianne", [20])]:
+        r = client.get('%s%s' % (API_BASE_URL, resource))
+        version, query, _ = decoded_cursor(r.links["next"]["url"].split("cursor=")[1])
+        r = client.get('%s%s&cursor=%s' % (API_BASE_URL, resource,
+                                           encoded_cursor(version, query, after)))
+        assert r.status_code == 400
+
+
+@pytest.mark.parametrize("engine_client", ["client", "sqlite_client"])
+def test_stamps_fields(engine_client, request):
+    c = request.getfixturevalue(engine_client)
+    with open(STAMPS_TEST_DATA_FILE) as f:
+        data = json.load(f)
+    projected = [{"id": {"yt_no": stamp["id"]["yt_no"]},
+                  "image": stamp["image"],
+                  "title_en": stamp["title_en"]} for stamp in data["stamps"]]
+    # The fields are in the order of the Stamp model
+    for resource in ["/stamps?fields=title_en,id.yt_no,image",
+                     "/stamps?fields=image,title_en,id.yt_no&stream=true"]:
+        r = c.get('%s%s' % (API_BASE_URL, resource))
+        assert r.status_code == 200
+        assert r.json() == {"count": len(projected), "stamps": projected}
+        assert list(r.json()["stamps"][0]) == ["id", "image", "title_en"]
+    resource = "/stamps?fields=id,issued&count=20&start=21"
+    r = c.get('%s%s' % (API_BASE_URL, resource))
+    assert r.json()["stamps"] == [{"id": stamp["id"], "issued": stamp["issued"]}
+                                  for stamp in data["stamps"][20:40]]
+    url = '%s%s' % (API_BASE_URL, "/stamps?fields=id.yt_no&count=500&sort=-issued")
+    paged = []
+    while url is not None:
+        r = c.get(url)
+        paged.extend(r.json()["stamps"])
+        url = r.links.get("next", {}).get("url")
+    r = c.get('%s%s' % (API_BASE_URL, "/stamps?sort=-issued"))
+    assert paged == [{"id": {"yt_no": stamp["id"]["yt_no"]}} for stamp in r.json()["stamps"]]
+    r = c.get('%s%s' % (API_BASE_URL, "/stamps?search=marianne&fields=url"))
+    assert all(list(stamp) == ["url"] for stamp in r.json()["stamps"])
+    for resource in ["/stamps?fields=", "/stamps?fields=variants", "/stamps?fields=id.no",
+                     "/stamps?fields=id,,title_en"]:
+        r = c.get('%s%s' % (API_BASE_URL, resource))
+        assert r.status_code == 400
+
+
+@pytest.mark.parametrize("engine_client", ["client", "sqlite_client"])
+def test_stamps_variants_and_total(engine_client, request):
+    c = request.getfixturevalue(engine_client)
+    with open(STAMPS_TEST_DATA_FILE) as f:
+        data = json.load(f)
+    stamps = [stamp for stamp in data["stamps"] if stamp["id"]["yt_variant"] == ""]
+    r = c.get('%s%s' % (API_BASE_URL, "/stamps?variants=false"))
+    assert r.status_code == 200
+    assert r.json() == {"count": len(stamps), "stamps": stamps}
+    for resource in ["/stamps?variants=false&start=6&count=5&total=true",
+                     "/stamps?variants=false&start=6&count=5&total=true&stream=true"]:
+        r = c.get('%s%s' % (API_BASE_URL, resource))
+        # The variants left out are counted too
+        assert r.text.startswith('{"count":5,"total":%d,"variants_total":%d,' %
+                                 (len(stamps), data["count"] - len(stamps)))
+        assert r.json()["stamps"] == stamps[5:10]
+    r = c.get('%s%s' % (API_BASE_URL, "/stamps?count=5&total=true"))
+    assert r.json()["total"] == data["count"]
+    assert "variants_total" not in r.json()
+    assert "link" in r.headers
+    ceres = [stamp for stamp in stamps if stamp["title_en"] == "Ceres"]
+    r = c.get('%s%s' % (API_BASE_URL, "/stamps?title=Ceres&variants=false&count=2&total=true"))
+    all_ceres = [stamp for stamp in data["stamps"] if stamp["title_en"] == "Ceres"]
+    assert r.json() == {"count": 2, "total": len(ceres),
+                        "variants_total": len(all_ceres) - len(ceres), "stamps": ceres[:2]}
+    r = c.get('%s%s' % (API_BASE_URL, "/stamps?search=ceres&variants=false&total=true"))
+    assert r.json()["total"] == r.json()["count"]
+    searched = c.get('%s%s' % (API_BASE_URL, "/stamps?search=ceres&total=true")).json()
+    assert r.json()["variants_total"] == searched["total"] - r.json()["total"]
+    assert all(stamp["id"]["yt_variant"] == "" for stamp in r.json()["stamps"])
+
+
 def test_stamp_poste_1(client):
     resource = "/stamps/Poste-1"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     with open("test-data/stamp_Poste_1.json") as f:
         data = json.load(f)
     assert r.json() == data
@@ -170,19 +717,77 @@ def test_stamp_poste_1_image(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.content == image
 
 
+def test_stamp_poste_1_image_renditions(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "STAMP_CATALOG_RENDITIONS_DIR", str(tmp_path))
+    url = '%s%s' % (API_BASE_URL, "/stamps/Poste-1/image")
+    r = client.get(url)
+    assert r.status_code == 200
+    assert "immutable" in r.headers["Cache-Control"]
+    assert "Last-Modified" in r.headers
+    etag = r.headers["ETag"]
+    # Conditional requests
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+    r = client.get(url, headers={"If-Modified-Since": r.headers["Last-Modified"]})
+    assert r.status_code == 304
+    # Smaller renditions
+    for size, max_size in [("thumbnail", (76, 90)), ("medium", (190, 225))]:
+        r = client.get(url + f"?size={size}")
+        assert r.status_code == 200
+        assert r.headers["Content-Type"] == "image/jpeg"
+        assert r.headers["ETag"] != etag
+        with Image.open(io.BytesIO(r.content)) as im:
+            assert im.size[0] <= max_size[0] and im.size[1] <= max_size[1]
+        assert os.path.exists(os.path.join(tmp_path, size, "T01-000-1.jpg"))
+    r = client.get(url + "?size=huge")
+    assert r.status_code == 422
+
+
 def test_stamp_1a(client):
     resource = "/stamps/Poste-1-a"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     with open("test-data/stamp_Poste_1_a.json") as f:
         data = json.load(f)
     assert r.json() == data
+    # The variants of a stamp are shared with the stamp itself
+    r = client.get('%s%s' % (API_BASE_URL, "/stamps/Poste-1"))
+    assert r.json()["variants"] == data["variants"]
+
+
+def test_stamp_without_variants(client):
+    resource = "/stamps/Poste-1000"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    assert r.json()["id"] == {"type": "Poste", "yt_no": "1000", "yt_variant": ""}
+    assert r.json()["url"] == "stamps/Poste-1000"
+    assert r.json()["variants"] is None
+
+
+def test_stamp_batch(client):
+    url = '%s%s' % (API_BASE_URL, "/stamps/batch")
+    r = client.post(url, json={"ids": ["Poste-1", "Poste-0", "Poste-1-a", "0"]})
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    result = r.json()
+    assert result["count"] == 2
+    assert result["missing"] == ["Poste-0", "0"]
+    for stamp, test_data_file in zip(result["stamps"], ["test-data/stamp_Poste_1.json",
+                                                        "test-data/stamp_Poste_1_a.json"]):
+        with open(test_data_file) as f:
+            data = json.load(f)
+        assert stamp == data
+    r = client.post(url, json={"ids": ["Poste-1"] * (settings.MAX_BATCH_SIZE + 1)})
+    assert r.status_code == 400
 
 
 def test_stamp_not_found(client):
@@ -190,7 +795,7 @@ def test_stamp_not_found(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 404
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json() is None
 
 
@@ -200,7 +805,7 @@ def test_stamp_titles(client):
     # First we test that english titles are returned if no explicit Accept-Languages is requested
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.headers["Content-Language"] == "en"
     with open("test-data/stamp_titles.json") as f:
         data = json.load(f)
@@ -208,7 +813,7 @@ def test_stamp_titles(client):
     # Then we test that english titles are returned if Accept-Languages is set to "en"
     r = client.get(url, headers={"Accept-Language": "en"})
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.headers["Content-Language"] == "en"
     with open("test-data/stamp_titles.json") as f:
         data = json.load(f)
@@ -216,7 +821,7 @@ def test_stamp_titles(client):
     # Then we test that french titles are returned if Accept-Languages is set to "fr"
     r = client.get(url, headers={"Accept-Language": "fr"})
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.headers["Content-Language"] == "fr"
     with open("test-data/stamp_titles.fr.json") as f:
         data = json.load(f)
@@ -229,13 +834,13 @@ def test_stamp_titles_wildcard_search(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     wildcard_count = 2685
     assert r.json()["count"] == wildcard_count
     url = '%s%s' % (API_BASE_URL, "/stamp_titles")
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == wildcard_count
 
 
@@ -245,7 +850,7 @@ def test_stamp_titles_prefix_search(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 52
     assert [title.startswith("Ce") for title in r.json()["values"]]
 
@@ -256,7 +861,7 @@ def test_stamp_titles_suffix_search(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 28
     assert [title.endswith("nt") for title in r.json()["values"]]
 
@@ -267,18 +872,31 @@ def test_stamp_titles_combined_prefix_and_suffix_search(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json()["count"] == 44
     assert [title.startswith("C") and title.endswith("s") for title in r.json()["values"]]
 
 
+def test_stamp_titles_infix_search(client):
+    with open("test-data/stamp_titles.json") as f:
+        data = json.load(f)
+    for infix in ["ari", "an", "Marianne de Gandon"]:
+        resource = ("/stamp_titles"
+                    f"?q=*{infix}*")
+        url = '%s%s' % (API_BASE_URL, resource)
+        r = client.get(url)
+        assert r.status_code == 200
+        assert "Server-Timing" in r.headers
+        assert sorted(r.json()["values"]) == [title for title in data["values"] if infix in title]
+
+
 def test_stamp_titles_wildcard_search_multiple_stars(client):
     resource = ("/stamp_titles"
                 "?q=**")
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 400
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     assert r.json() == "Multiple wildcard stars '*' in query is not supported."
 
 
@@ -287,18 +905,53 @@ def test_stamp_years(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     with open("test-data/stamp_years.json") as f:
         data = json.load(f)
     assert r.json() == data
 
 
+def test_stamp_years_counts(client):
+    resource = "/stamp_years?counts=true"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    with open("test-data/stamp_years.json") as f:
+        data = json.load(f)
+    assert r.json()["values"] == data["values"]
+    assert len(r.json()["counts"]) == data["count"]
+    assert sum(r.json()["counts"]) == 6592
+
+
+def test_stamp_facets(client):
+    resource = "/stamp_facets?title=Ceres&color=Green,Olive"
+    url = '%s%s' % (API_BASE_URL, resource)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert "Server-Timing" in r.headers
+    facets = r.json()
+    assert facets["count"] == 4
+    assert set(facets["facets"]) == {"issued", "color", "value", "stamp-type"}
+    # The counts of a facet are the counts with all other filters applied
+    colors = dict(zip(facets["facets"]["color"]["values"], facets["facets"]["color"]["counts"]))
+    for color, count in colors.items():
+        r = client.get('%s%s' % (API_BASE_URL, f"/stamps?title=Ceres&color={color}"))
+        assert r.json()["count"] == count
+    years = dict(zip(facets["facets"]["issued"]["values"], facets["facets"]["issued"]["counts"]))
+    assert sum(years.values()) == facets["count"]
+    for year, count in years.items():
+        resource = f"/stamps?title=Ceres&color=Green,Olive&issued={year}"
+        r = client.get('%s%s' % (API_BASE_URL, resource))
+        assert r.json()["count"] == count
+
+
 def test_stamp_colors(client):
     resource = "/stamp_colors"
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     with open("test-data/stamp_colors.json") as f:
         data = json.load(f)
     assert r.json() == data
@@ -309,7 +962,181 @@ def test_stamp_values(client):
     url = '%s%s' % (API_BASE_URL, resource)
     r = client.get(url)
     assert r.status_code == 200
-    assert "Server-timing" in r.headers
+    assert "Server-Timing" in r.headers
     with open("test-data/stamp_values.json") as f:
         data = json.load(f)
     assert r.json() == data
+
+
+def test_catalog_snapshot(tmp_path):
+    csv_file = tmp_path / "stamps.csv"
+    shutil.copyfile(STAMPS_CATALOG_CSV_FILE, csv_file)
+    # Without a snapshot the catalog is read from the CSV file
+    from_csv = database.load(str(csv_file))
+    assert from_csv.source == "csv"
+    fields = stamp_json_fields()
+    database.build_snapshot(str(csv_file), fields=fields)
+    from_snapshot = database.load(str(csv_file), fields=fields)
+    assert from_snapshot.source == "snapshot"
+    assert from_snapshot.version == from_csv.version
+    pd.testing.assert_frame_equal(from_snapshot.db, from_csv.db)
+    pd.testing.assert_frame_equal(from_snapshot.indexed_db, from_csv.indexed_db)
+    # The indexes are restored from the snapshot and answer queries the same
+    filters = [("color_en", ["Green", "Red"]), ("issued", [(1900, 1950)])]
+    assert (from_snapshot.query(filters) == from_csv.query(filters)).all()
+    assert (from_snapshot.search("mari*", filters) == from_csv.search("mari*", filters)).all()
+    assert (from_snapshot.sorted(None, "title_fr", True) ==
+            from_csv.sorted(None, "title_fr", True)).all()
+    for q in ["Mari*", "*anne", "*ari*", "M*ne"]:
+        assert from_snapshot.titles["fr"].query(q) == from_csv.titles["fr"].query(q)
+    assert from_snapshot.facets["issued"].counted(None) == from_csv.facets["issued"].counted(None)
+    # And so are the encoded stamps and their registry, with shared variants objects
+    from_csv.build_registry(fields)
+    assert list(from_snapshot.json_fragments) == list(from_csv.json_fragments)
+    assert from_snapshot.registry == from_csv.registry
+    stamp, variants = from_snapshot.registry[("Poste", "1", "")]
+    assert from_snapshot.registry[("Poste", "1", "a")][1] is variants
+    # Unless the stamps are encoded with other fields
+    assert database.load(str(csv_file), fields=fields[:2]).registry is None
+    # A stale snapshot is ignored
+    with open(csv_file, "a") as f:
+        f.write("99999;;Poste;1999;1999;Test;Test;;;;;;;;\n")
+    stale = database.load(str(csv_file))
+    assert stale.source == "csv"
+    assert len(stale.db) == len(from_csv.db) + 1
+
+
+def test_catalog_query():
+    catalog = database.load(STAMPS_CATALOG_CSV_FILE)
+    db = catalog.db
+    assert catalog.query([]) is None
+    filters = [("title_en", ["Ceres"]),
+               ("issued", ["1850", "1870", "1872"]),
+               ("color_en", ["Green", "Olive", "No such color"])]
+    mask = (db["title_en"] == "Ceres") & db["issued"].isin(["1850", "1870", "1872"]) \
+        & db["color_en"].isin(["Green", "Olive"])
+    assert catalog.query(filters).tolist() == mask[mask].index.tolist()
+    assert len(catalog.query([("title_en", ["No such title"])])) == 0
+    years = pd.to_numeric(db["issued"], errors="coerce")
+    for values in [[(1931, 1940)], [(None, 1850)], [(1990, None)], [(1940, 1931)],
+                   ["1849", (1931, 1935), (1933, 1940)]]:
+        mask = db["issued"].isin([value for value in values if not isinstance(value, tuple)])
+        for low, high in (value for value in values if isinstance(value, tuple)):
+            mask |= years.between(low if low is not None else -np.inf,
+                                  high if high is not None else np.inf)
+        assert catalog.positions("issued", values).tolist() == mask[mask].index.tolist()
+
+
+def test_storage_engines(tmp_path):
+    catalog = database.load(STAMPS_CATALOG_CSV_FILE)
+    fields = stamp_json_fields()
+    catalog.build_registry(fields)
+    pandas_store = storage.open_store("pandas", catalog, STAMPS_CATALOG_CSV_FILE, fields)
+    sqlite_store = storage.open_store("sqlite", catalog, str(tmp_path / "stamps.csv"), fields)
+    assert os.path.exists(tmp_path / "stamps.sqlite")
+    assert storage.sqlite_is_current(str(tmp_path / "stamps.sqlite"), catalog.version)
+    # An engine has to answer all the queries
+    with pytest.raises(TypeError):
+        type("PartialStore", (storage.StampStore,), {"stamps": lambda self: []})()
+    for filters in [[],
+                    [("issued", ["1931", "1932"])],
+                    [("title_en", ["Ceres"]), ("color_en", ["Green", "Olive"])],
+                    [("title_en", ["No such title"])],
+                    [("issued", ["1849", (1931, 1935), (1933, None)])],
+                    [("issued", [(None, 1850)]), ("color_en", ["Black"])]]:
+        for start, count in [(0, None), (3, 5), (10, None)]:
+            assert pandas_store.stamps(filters, start, count) == \
+                sqlite_store.stamps(filters, start, count)
+    for sort in [("yt_no", True), ("issued", False), ("title_fr", True)]:
+        for filters in [[], [("issued", ["1931", "1850"])]]:
+            assert pandas_store.stamps(filters, 10, 20, sort) == \
+                sqlite_store.stamps(filters, 10, 20, sort)
+    for column in ["issued", "color_en", "color_fr", "value_en", "value_fr", "title_fr"]:
+        assert pandas_store.values(column) == sqlite_store.values(column)
+    for key in [("Poste", "1", ""), ("Poste", "1", "a"), ("Poste", "2", ""), ("Poste", "0", "")]:
+        assert pandas_store.stamp(key) == sqlite_store.stamp(key)
+    # Lists of stamps are built from the same encoded stamps as the registry
+    assert pandas_store.stamps([], 0, 1)[0] is catalog.registry[("Poste", "1", "")][0]
+    for text, filters in [("Marianne", []),
+                          ("CERES 1849", []),
+                          ("cérès", [("issued", ["1850", "1871"])]),
+                          ("mari*", []),
+                          ("l'exposition", []),
+                          ("Type", [("title_en", ["Ceres"])]),
+                          ("AND", []),
+                          ("", [])]:
+        # The engines rank equally good matches differently, but find the same stamps
+        assert sorted(pandas_store.search(text, filters)) == \
+            sorted(sqlite_store.search(text, filters))
+    assert len(sqlite_store.search("ceres 1849", [])) == 25
+    for text, filters in [(None, []), (None, [("id_yt_var", [""])]),
+                          (None, [("issued", [(1931, 1950)]), ("id_yt_var", ["a", "b"])]),
+                          ("ceres", []), ("ceres", [("id_yt_var", [""])]), ("", [])]:
+        assert pandas_store.total(filters, text) == sqlite_store.total(filters, text)
+    assert sqlite_store.search("ceres", [], 2, 3) == sqlite_store.search("ceres", [])[2:5]
+    assert pandas_store.search("ceres", [], 2, 3) == pandas_store.search("ceres", [])[2:5]
+    for sort in [None, ("yt_no", False), ("issued", True)]:
+        for filters in [[], [("issued", [(1931, 1950)])]]:
+            after = None
+            for i in range(3):
+                page = pandas_store.page(filters, 50, sort, after)
+                assert page == sqlite_store.page(filters, 50, sort, after)
+                stamps, after = page
+                assert stamps == pandas_store.stamps(filters, i * 50, 50, sort)
+    projection = [("id", [("yt_no", "id_yt_no")]), ("issued", "issued"), ("title_fr", "title_fr")]
+    for filters in [[], [("issued", [(1931, 1950)])]]:
+        stamps = pandas_store.stamps(filters, 10, 100, ("title_fr", True), projection)
+        assert stamps == sqlite_store.stamps(filters, 10, 100, ("title_fr", True), projection)
+        assert [json.loads(stamp) for stamp in stamps] == \
+            [{"id": {"yt_no": stamp["id"]["yt_no"]}, "issued": stamp["issued"],
+              "title_fr": stamp["title_fr"]}
+             for stamp in map(json.loads,
+                              pandas_store.stamps(filters, 10, 100, ("title_fr", True)))]
+        assert pandas_store.page(filters, 50, None, None, projection) == \
+            sqlite_store.page(filters, 50, None, None, projection)
+    assert sorted(pandas_store.search("ceres", [], 0, None, None, projection)) == \
+        sorted(sqlite_store.search("ceres", [], 0, None, None, projection))
+    for key in [("Poste", "1", ""), ("Poste", "1", "a"), ("Poste", "0", "")]:
+        assert pandas_store.image(key) == sqlite_store.image(key)
+    for language in ["en", "fr"]:
+        for q in [None, "Mari*", "*anne", "*ari*", "M*ne", "Marianne", "*a*", "*[*", "C?r*"]:
+            assert pandas_store.titles(language, q) == sqlite_store.titles(language, q)
+    for column in ["issued", "color_en", "type_fr"]:
+        for filters in [[("issued", ["1931", "1850"])], [("color_en", ["No such color"])]]:
+            assert pandas_store.values(column, filters) == sqlite_store.values(column, filters)
+    for text, start, count, sort in [(None, 0, None, None), (None, 10, 1000, ("issued", True)),
+                                     ("ceres", 2, None, ("yt_no", False)), ("", 0, None, None)]:
+        for store in [pandas_store, sqlite_store]:
+            streamed, chunks = store.stream([], text, start, count, sort, None, 100)
+            stamps = [stamp for chunk in chunks for stamp in chunk]
+            assert streamed == len(stamps)
+            if text is not None:
+                assert stamps == store.search(text, [], start, count, sort)
+            else:
+                assert stamps == store.stamps([], start, count, sort)
+
+
+def test_sort_ranks():
+    db = pd.DataFrame({"type_fr": ["Poste", "Poste", "Poste", "Poste", "Aérienne"],
+                       "id_yt_no": ["10", "2", "2", "1", "1"],
+                       "id_yt_var": ["", "a", "", "b", "A"]})
+    assert database.sort_ranks(db, database.ID_COLUMNS).tolist() == [4, 3, 2, 1, 0]
+    assert database.sort_ranks(db, ["id_yt_no"]).tolist() == [2, 1, 1, 0, 0]
+    assert database.natural_key("Cérès 2") < database.natural_key("ceres 10")
+    assert database.natural_key("") < database.natural_key("a")
+
+
+def test_text_index():
+    db = pd.DataFrame({"title_en": ["Ceres", "Marianne", "Ceres and Marianne", "Sower"],
+                       "title_fr": ["Cérès.", "Marianne de Cheffer", "", "Semeuse"],
+                       "description_fr": ["", "", "Cérès", "Marianne"]})
+    index = database.TextIndex(db, database.TEXT_COLUMNS)
+    # Ceres is in both titles of stamp 0 and in one title and the description of stamp 2
+    assert index.query("ceres").tolist() == [0, 2]
+    assert index.query("CÉRÈS").tolist() == [0, 2]
+    assert index.query("marianne").tolist() == [1, 2, 3]
+    assert index.query("ceres marianne").tolist() == [2]
+    assert index.query("mari*").tolist() == [1, 2, 3]
+    assert sorted(index.query("c*").tolist()) == [0, 1, 2]
+    assert index.query("cer").tolist() == []
+    assert index.query("  ") is None